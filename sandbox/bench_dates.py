@@ -0,0 +1,54 @@
+#! /usr/bin/env python3
+
+# Benchmark for DateParser.  For each format in util.date_formats, makes a
+# column of random dates in that format and compares the time to parse the
+# column with parse_date (which tries the formats in order) and with a
+# DateParser (which detects the format from the first few values).
+#
+#   python sandbox/bench_dates.py [--dates N]
+
+import argparse
+from datetime import date, timedelta
+import random
+from time import perf_counter
+
+from dexter.util import DateParser, date_formats, parse_date
+
+def make_dates(n, fmt):
+    '''
+    Make n strings with random dates in a format.
+    '''
+    start = date(2015, 1, 1)
+    res = []
+    for _ in range(n):
+        d = start + timedelta(days=random.randint(0, 3650))
+        s = d.strftime(fmt)
+        if fmt.startswith('%m'):
+            s = s.removeprefix('0')
+        res.append(s)
+    return res
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dates', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    print(f'{"format":12s}  {"parse_date":>10s}  {"DateParser":>10s}  {"speedup":>7s}  fallbacks')
+    for fmt in date_formats:
+        column = make_dates(args.dates, fmt)
+
+        t0 = perf_counter()
+        expected = [parse_date(s) for s in column]
+        t1 = perf_counter()
+        parse = DateParser()
+        result = [parse(s) for s in column]
+        t2 = perf_counter()
+
+        assert result == expected, f'DateParser changed a result for {fmt}'
+        print(f'{fmt:12s}  {t1-t0:9.3f}s  {t2-t1:9.3f}s  {(t1-t0)/(t2-t1):6.1f}x  {parse.fallbacks}')
+    print(f'{args.dates} dates per format, results identical')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#! /usr/bin/env python3
+
+# Benchmark for the RegExp literal index.  Compares the number of rules
+# tried per description and the time to pair a set of descriptions using
+# an indexed RuleSet and a linear scan.  Rules and descriptions are
+# synthetic, so the benchmark doesn't need a database.
+#
+#   python sandbox/bench_regexp.py [--rules N] [--descriptions N]
+
+import argparse
+import random
+import string
+from time import perf_counter
+from types import SimpleNamespace
+
+from dexter.DB import Action
+from dexter.rules import RuleSet
+
+def random_word(n):
+    return ''.join(random.choices(string.ascii_uppercase, k=n))
+
+def make_rules(n):
+    '''
+    Make n rules with a mix of the pattern styles found in real rule
+    files: plain names, names with a prefix, captured suffixes, and a few
+    patterns without literals.
+    '''
+    names = [random_word(random.randint(4,10)) for _ in range(n)]
+    rules = []
+    for i, name in enumerate(names):
+        action = random.choice([Action.T, Action.T, Action.T, Action.F, Action.X])
+        match i % 10:
+            case 0:
+                expr = f'.*{name}'
+            case 1:
+                expr = f'{name} #(\\d+)'
+            case 2:
+                expr = f'{name[:3]}|{name[3:]}'
+            case _:
+                expr = name
+        rules.append(SimpleNamespace(action=action, expr=expr, repl=name.capitalize(), acct='x'))
+    return rules, names
+
+def make_descriptions(n, names):
+    '''
+    Make n descriptions, about half of which contain one of the names.
+    '''
+    res = []
+    for _ in range(n):
+        parts = [random_word(random.randint(3,8)) for _ in range(3)]
+        if random.random() < 0.5:
+            parts.insert(random.randint(0,3), random.choice(names))
+        res.append(' '.join(parts) + f' {random.randint(1000,99999)}')
+    return res
+
+def pair(rules, descriptions):
+    '''
+    Search the rules the way pair_entries does:  look for a T rule, then
+    an F rule, then an X rule.  Returns the list of matching documents.
+    '''
+    res = []
+    for s in descriptions:
+        m = rules.find_first(s, Action.T) or rules.find_first(s, Action.F) or rules.find_first(s, Action.X)
+        res.append(m)
+    return res
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rules', type=int, default=800)
+    parser.add_argument('--descriptions', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    docs, names = make_rules(args.rules)
+    descriptions = make_descriptions(args.descriptions, names)
+
+    results = {}
+    for label, indexed in [('linear', False), ('indexed', True)]:
+        t0 = perf_counter()
+        rules = RuleSet(docs, indexed=indexed)
+        t1 = perf_counter()
+        matches = pair(rules, descriptions)
+        t2 = perf_counter()
+        results[label] = matches
+        print(f'{label:8s}  build {t1-t0:7.3f}s  pair {t2-t1:7.3f}s  rules tried per description {rules.tried/rules.searches:8.1f}')
+
+    assert all(x is y for x, y in zip(results['linear'], results['indexed'])), 'index changed a result'
+    print(f'{args.descriptions} descriptions, {args.rules} rules, results identical')
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,31 @@
 # Database schema and API
 
+from collections import namedtuple
 from enum import Enum
+from functools import wraps
 from datetime import datetime
 from hashlib import md5
 import logging
 import os
+from pathlib import Path
 import re
-import string
 
+from bson import DBRef, ObjectId, json_util
+from bson.json_util import LEGACY_JSON_OPTIONS
 from mongoengine import *
+from mongoengine.base import BaseList
+from pymongo import InsertOne, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError
 
 # from .config import Config, Tag
+from .cache import ResultCache
 from .config import Config
+from .directory import AccountDirectory
+from .monitor import CommandMonitor, explain
+from .planner import plan_match
+from .rules import RuleSet, compile_rule, PLACEHOLDER, TRANSFORMS
+from .snapshots import MonthlySnapshots
+from .util import UIDSet, Amount, cents
 
 ### Database Schema, defined using MongoEngine
 
@@ -52,8 +66,35 @@ class Tag(Enum):
     X = '#xfer'
     Z = '#payment'
 
+class AmountField(FloatField):
+    '''
+    A dollar amount stored in the database as an integer number of cents.
+    Values read from the database are Amount objects.  Documents written
+    before amounts were stored in cents have doubles, which are converted
+    when the database is upgraded (see DB.upgrade).
+    '''
+
+    def to_python(self, value):
+        if value is None or isinstance(value, Amount):
+            return value
+        if isinstance(value, int):
+            return Amount.from_cents(value)
+        try:
+            return Amount(value)
+        except (TypeError, ValueError):
+            return value
+
+    def to_mongo(self, value):
+        return cents(value)
+
+    def prepare_query_value(self, op, value):
+        if value is None:
+            return value
+        return cents(value)
+
 class Dexter(Document):
     date = DateField(required=True)
+    schema = IntField(default=1)
 
     def __str__(self):
         return f'<DB created {self.date}>'
@@ -86,18 +127,52 @@ class Account(Document):
     def nominal_accounts(doc_cls, queryset):
         return queryset.filter(category__in=['E','I'])
 
+    def save(self, *args, **kwargs):
+        '''
+        Extend the base class save method to invalidate the account directory
+        and cached query results.
+        '''
+        if DB.store:
+            return DB.save_records([self])
+        res = super().save(*args, **kwargs)
+        DB.accounts.invalidate()
+        DB.results.invalidate('account')
+        return res
+
+    def delete(self, *args, **kwargs):
+        '''
+        Extend the base class delete method to invalidate the account directory
+        and cached query results.
+        '''
+        DB.require_mongodb('Account.delete')
+        super().delete(*args, **kwargs)
+        DB.accounts.invalidate()
+        DB.results.invalidate('account')
+
 class Entry(Document):
     uid = StringField(required=True, unique=True)
     date = DateField(required=True)
     description = StringField()
     account = StringField(required=True)
     column = EnumField(Column, required=True) 
-    amount = FloatField(required=True)
+    amount = AmountField(required=True)
     # tags = ListField(EnumField(Tag))
     tags = ListField(StringField())
     tref = ReferenceField('Transaction')
 
-    meta = {'strict': False}
+    # Indexes for the common queries:  balances and reports (account, column,
+    # and date range), selections by date, tags (pair, reconcile), and
+    # transaction references (audit)
+
+    meta = {
+        'strict': False,
+        'indexes': [
+            ('account', 'column', 'date'),
+            'date',
+            ('tags', 'date'),
+            'tref',
+        ],
+    }
 
     # These dictionaries map command line arguments to names of 
     # object attributes 
@@ -118,6 +193,10 @@ class Entry(Document):
         'delete': None,          # placeholder, will be filled by app
     }
 
+    # Fields where the query planner replaces regular expressions
+
+    planned = {'account'}
+
     updaters = {
         'date':  'set__date',
         'description': 'set__description',
@@ -151,9 +230,13 @@ class Entry(Document):
             self.tref.id if self.tref else 'None',
         ]
 
+    @property
+    def cents(self):
+        return cents(self.amount)
+
     @property
     def value(self):
-        return self.amount if self.column == Column.dr else -self.amount
+        return Amount.from_cents(self.cents if self.column == Column.dr else -self.cents)
 
     @property
     def hash(self):
@@ -168,6 +251,42 @@ class Entry(Document):
             self.uid = self.hash
             logging.debug(f'Entry.uid: {self.uid}')
 
+    # Entries written with save, update, or delete also update the monthly 
+    # balance snapshots and invalidate cached query results
+
+    def save(self, *args, **kwargs):
+        '''
+        Extend the base class save method to update the snapshots.  The
+        old version of the document is fetched only if a field that affects
+        balances was changed.
+        '''
+        if DB.store:
+            return DB.save_records([self])
+        created = self._created or self.pk is None
+        changed = {f.split('.')[0] for f in self._get_changed_fields()}
+        old = []
+        if not created and changed & MonthlySnapshots.FIELDS:
+            old = DB.snapshots.fetch(Entry._get_collection(), {'_id': self.pk})
+        res = super().save(*args, **kwargs)
+        DB.results.invalidate('entry', 'transaction')
+        if created or old:
+            DB.snapshots.update(old, [self.to_mongo()])
+        return res
+
+    def update(self, **kwargs):
+        '''
+        Extend the base class update method to update the snapshots.
+        '''
+        DB.require_mongodb('Entry.update')
+        return DB.tracked_write({'_id': self.pk}, lambda: super(Entry, self).update(**kwargs))
+
+    def delete(self, *args, **kwargs):
+        '''
+        Extend the base class delete method to update the snapshots.
+        '''
+        DB.require_mongodb('Entry.delete')
+        return DB.tracked_write({'_id': self.pk}, lambda: super(Entry, self).delete(*args, **kwargs))
+
 class Transaction(Document):
     description = StringField(required=True)
     comment = StringField()
@@ -176,7 +295,20 @@ class Transaction(Document):
     pdate = DateField()
     pdebit = StringField()
     pcredit = StringField()
-    pamount = FloatField()
+    pamount = AmountField()
+
+    # Indexes for selections by date, debit or credit account, and tags,
+    # and for finding the transaction that has a given entry
+
+    meta = {
+        'indexes': [
+            'pdate',
+            ('pdebit', 'pdate'),
+            ('pcredit', 'pdate'),
+            ('tags', 'pdate'),
+            'entries',
+        ],
+    }
     
     constraints = {
         'description': 'description__iregex',
@@ -195,6 +327,10 @@ class Transaction(Document):
         'delete': None,          # placeholder, will be filled by app
     }
 
+    # Fields where the query planner replaces regular expressions
+
+    planned = {'pdebit', 'pcredit'}
+
     updaters = {
         'description': 'set__description',
         'comment':  'set__comment',
@@ -263,7 +399,7 @@ class Transaction(Document):
         if len(self.entries) == 0:    # possible if transaction imported previously
             return
         self.pdate = min(e.date for e in self.entries)
-        self.pamount = sum(e.amount for e in self.entries if e.column == Column.cr)
+        self.pamount = Amount.from_cents(sum(e.cents for e in self.entries if e.column == Column.cr))
         self.pcredit = '/'.join(a.account for a in self.credits)
         self.pdebit = '/'.join(a.account for a in self.debits)
 
@@ -277,10 +413,23 @@ class Transaction(Document):
         if len(self.entries) == 0:
             logging.debug(f'Transaction.save: transaction has no entries, skipping {self}')
             return
+        if DB.store:
+            return DB.save_records([self])
         for e in self.entries:
             logging.debug(f'  entry: {e}')
             e.save()
         super().save()
+        DB.results.invalidate('transaction')
+
+    def delete(self, *args, **kwargs):
+        '''
+        Extend the base class delete method to invalidate cached query
+        results.  Entries of the transaction keep their references to it,
+        so results that depend on entries are also discarded.
+        '''
+        DB.require_mongodb('Transaction.delete')
+        super().delete(*args, **kwargs)
+        DB.results.invalidate('entry', 'transaction')
 
 class RegExp(Document):
     action = EnumField(Action, required=True) 
@@ -300,13 +449,15 @@ class RegExp(Document):
             self.acct,
         ]
     
-    placeholder = r'{(\d+)(\.\w+)?}'
+    placeholder = PLACEHOLDER
+    transforms = TRANSFORMS
 
-    transforms = {
-        '': lambda s: s,
-        '.lower':  lambda s: s.lower(),
-        '.capwords':  lambda s: string.capwords(s),
-    }
+    @property
+    def rule(self):
+        '''
+        The compiled form of the expression and replacement string.
+        '''
+        return compile_rule(self.expr, self.repl)
 
     def matches(self, s):
         '''
@@ -315,7 +466,7 @@ class RegExp(Document):
         Arguments:
             s: the string to match
         '''
-        return bool(re.search(self.expr, s, re.I))
+        return self.rule.matches(s)
 
     def apply(self, s: str):
         '''
@@ -325,19 +476,85 @@ class RegExp(Document):
         Arguments:
             s: the string to match
         '''
-        repl = None
+        return self.rule.apply(s)
 
-        if m := re.search(self.expr, s, re.I):
-            repl = self.repl
-            logging.debug(f'  match {m} repl "{repl}"')
-            for i, f in re.findall(RegExp.placeholder, self.repl, re.I):
-                if f:
-                    repl = repl.replace(f,'')
-                repl = repl.replace(f'{{{i}}}', RegExp.transforms[f](m[int(i)+1]))
+### Database API
 
-        return repl    
+def ref_id(x):
+    '''
+    Return the ObjectId in a reference field value, which can be a document,
+    a DBRef, or an ObjectId.
+    '''
+    if isinstance(x, (Document, DBRef)):
+        return x.id
+    return x
 
-### Database API
+# Result type for DB.balances
+
+Balance = namedtuple('Balance', ['starting', 'debits', 'credits'])
+
+def storage(fn):
+    '''
+    Decorator for the DB methods that make up the storage interface.  When
+    the database uses a backend other than MongoDB (DB.store is not None) a
+    call is passed to the backend method with the same name.
+    '''
+    @wraps(fn)
+    def dispatch(*args, **kwargs):
+        if DB.store is not None:
+            return getattr(DB.store, fn.__name__)(*args, **kwargs)
+        return fn(*args, **kwargs)
+    return dispatch
+
+def cached(*depends, plans=False):
+    '''
+    Decorator for DB methods whose results can be saved in the result cache
+    (DB.results).  The arguments are the names of the collections the results
+    are computed from.  Calls that update records (select with an update
+    constraint) are never cached.
+
+    A QuerySet is read into a list before it is saved, so using a cached
+    result does not send the query to the server again.  Callers get a copy
+    of the list, but the objects in it are shared and should not be modified.
+
+    If plans is True the method sets DB.plans.  The plans are saved with the
+    result and restored when the result is found in the cache.
+    '''
+    def decorator(fn):
+        @wraps(fn)
+        def lookup(*args, **kwargs):
+            if not DB.results.enabled or kwargs.get('update'):
+                return fn(*args, **kwargs)
+            if (key := ResultCache.key(fn.__name__, args, kwargs)) is None:
+                return fn(*args, **kwargs)
+            found, saved = DB.results.lookup(key)
+            if found:
+                res, saved_plans = saved
+                if plans:
+                    DB.plans = list(saved_plans)
+            else:
+                res = fn(*args, **kwargs)
+                if isinstance(res, QuerySet):
+                    res = list(res)
+                DB.results.save(key, (res, list(DB.plans) if plans else None), depends)
+            return list(res) if isinstance(res, list) else res
+        return lookup
+    return decorator
+
+def writes(*collections):
+    '''
+    Decorator for DB methods that write to the database.  After the method
+    returns, cached results that depend on the collections are discarded.
+    '''
+    def decorator(fn):
+        @wraps(fn)
+        def write(*args, **kwargs):
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                DB.results.invalidate(*collections)
+        return write
+    return decorator
 
 class DB:
     '''
@@ -346,16 +563,31 @@ class DB:
     '''
 
     dexters = set()
+    scanned = False
     server = None
+    store = None
     connection = None
     database = None
     dbname = None
+    accounts = AccountDirectory(lambda: DB.load_accounts())
+    snapshots = MonthlySnapshots(lambda: DB.database)
+    results = ResultCache()
+    monitor = CommandMonitor()
+    ruleset = None
 
     @staticmethod
     def info():
         '''
-        Return information about the databases on the server.
+        Return information about the databases on the server.  Always
+        scans the server, which also updates the registry.
+
+        With the SQLite backend the databases are the files that match
+        Config.DB.path.
         '''
+        DB.scan()
+        if Config.DB.backend == 'sqlite':
+            from .sqlstore import SQLiteStore
+            return { db: SQLiteStore.table_sizes(DB.sqlite_path(db)) for db in sorted(DB.dexters) }
         dct = {}
         for db in DB.server.list_database_names():
             if db not in DB.dexters:
@@ -369,27 +601,101 @@ class DB:
     @staticmethod
     def init():
         '''
-        Connect to the MongoDB server, make a list of Dexter databases.
+        Connect to the MongoDB server, make a list of Dexter databases.  The
+        list comes from the registry file if there is one, otherwise from a
+        scan of every database on the server.  Names in the registry are 
+        verified when the database is opened (see DB.exists).
+
+        Nothing is done if the configuration says to use SQLite.
         '''
+        if Config.DB.backend == 'sqlite':
+            return
         pm = connect(alias = 'pm', timeoutMS=100)
-        for dbname in pm.list_database_names():
-            if 'dexter' in pm[dbname].list_collection_names():
-                coll = pm[dbname].dexter
-                n = coll.count_documents({})
-                obj = coll.find_one()
-                if n == 1 and 'date' in obj:
-                    DB.dexters.add(dbname)
         DB.server = pm
+        if (names := DB.read_registry()) is not None:
+            logging.debug(f'DB.init: registry {names}')
+            DB.dexters = names
+        else:
+            DB.scan()
+
+    @staticmethod
+    def scan():
+        '''
+        Check every database on the server to find the Dexter databases,
+        save their names in the registry.  With the SQLite backend the
+        names come from the files that match Config.DB.path.
+        '''
+        if Config.DB.backend == 'sqlite':
+            DB.dexters = set(DB.sqlite_names())
+            DB.scanned = True
+            return
+        DB.dexters = { dbname for dbname in DB.server.list_database_names() if DB.is_dexter(dbname) }
+        DB.scanned = True
+        DB.write_registry()
+
+    @staticmethod
+    def is_dexter(dbname):
+        '''
+        Return True if a database on the server has the collection that
+        identifies it as a Dexter database.
+        '''
+        db = DB.server[dbname]
+        if 'dexter' not in db.list_collection_names():
+            return False
+        coll = db.dexter
+        n = coll.count_documents({})
+        obj = coll.find_one()
+        return n == 1 and 'date' in obj
+
+    @staticmethod
+    def read_registry():
+        '''
+        Return the set of database names saved in the registry file, or
+        None if there is no registry.
+        '''
+        if not Config.DB.registry:
+            return None
+        p = Path(Config.DB.registry).expanduser()
+        if not p.is_file():
+            return None
+        return set(p.read_text().split())
+
+    @staticmethod
+    def write_registry():
+        '''
+        Save the names of the known Dexter databases in the registry file.
+        '''
+        if not Config.DB.registry:
+            return
+        p = Path(Config.DB.registry).expanduser()
+        try:
+            p.parent.mkdir(parents=True, exist_ok=True)
+            p.write_text(''.join(f'{name}\n' for name in sorted(DB.dexters)))
+        except OSError as err:
+            logging.debug(f'DB: cannot write registry {p}: {err}')
 
     @staticmethod
     def exists(dbname):
         '''
         Return True if dbname is the name of a Dexter database on the server.
+        A name found in the registry is verified by checking that one database;
+        if the name is not in the registry the server is scanned again in case
+        the database was created by another client.
         '''
+        if Config.DB.backend == 'sqlite':
+            return DB.sqlite_path(dbname).is_file()
+        if dbname in DB.dexters:
+            if DB.scanned or DB.is_dexter(dbname):
+                return True
+            logging.debug(f'DB.exists: removing {dbname} from registry')
+            DB.dexters.discard(dbname)
+            DB.write_registry()
+        elif not DB.scanned:
+            DB.scan()
         return dbname in DB.dexters
     
     @staticmethod
-    def open(dbname: str):
+    def open(dbname: str, upgrade: bool = False):
         '''
         Connect to a Dexter database, making sure the database exists.  Saves 
         the connection info in static variables that are accessible outside the
@@ -397,16 +703,25 @@ class DB:
 
         If `dbname` is None use the name in the envionment variable DEX_DB.
 
+        A database with an older schema can only be opened by the upgrade
+        command (see DB.upgrade).
+
         Arguments:
             dbname:  name of the database
+            upgrade:  True if the database can have an older schema
         '''
         dbname = dbname or os.getenv('DEX_DB') or Config.DB.name
         if dbname is None:
             raise ValueError('DB.open: specify a database name with --db or DEX_DB')   
-        if dbname not in DB.dexters:
+        if not DB.exists(dbname):
             raise ValueError(f'DB.open: no Dexter database named {dbname} on the server')
         logging.debug(f'DB.open {dbname}')
 
+        if Config.DB.backend == 'sqlite':
+            DB.open_store(dbname)
+            return
+        DB.store = None
+
         DB.connection = connect(dbname, UuidRepresentation='standard')
         DB.database = DB.connection[dbname]
 
@@ -414,8 +729,92 @@ class DB:
         DB.models = [cls for cls in Document.__subclasses__() if hasattr(cls, 'objects')]
         DB.collections = { cls._meta["collection"]: cls for cls in DB.models }
 
-        DB.real_accounts = { a.name for a in Account.objects(category=Category.L) }
-        DB.real_accounts |= { a.name for a in Account.objects(category=Category.A) }
+        DB.results = ResultCache(Config.DB.cache_size)
+        DB.accounts.invalidate()
+        DB.reload_regexps()
+        DB.real_accounts = { a.name for a in DB.accounts.accounts(Category.L) }
+        DB.real_accounts |= { a.name for a in DB.accounts.accounts(Category.A) }
+
+        if (schema := DB.schema()) < DB.SCHEMA:
+            if not upgrade:
+                raise ValueError(f'DB.open: {dbname} has schema {schema}, run "dex upgrade" to convert it to schema {DB.SCHEMA}')
+            return
+
+        if DB.snapshots.is_empty() and Entry._get_collection().find_one({}, {'_id': 1}):
+            DB.rebuild_snapshots()
+
+    # Version of the database layout.  Version 2 stores amounts as integer
+    # numbers of cents.
+
+    SCHEMA = 2
+
+    @staticmethod
+    def schema():
+        '''
+        Return the schema version of the open database.
+        '''
+        rec = Dexter.objects.first()
+        return DB.SCHEMA if rec is None else rec.schema
+
+    @staticmethod
+    def upgrade(preview: bool = False):
+        '''
+        Bring an older database up to the current schema.  Returns a dictionary
+        that maps the names of converted fields to the number of documents
+        changed (or, in preview mode, the number that would be changed).
+        The monthly snapshots are rebuilt after an upgrade.
+
+        Arguments:
+            preview:  if True count the documents but don't change them
+        '''
+        rec = Dexter.objects.first()
+        if rec is None or rec.schema >= DB.SCHEMA:
+            return {}
+        logging.info(f'DB: upgrading {DB.dbname} from schema {rec.schema} to {DB.SCHEMA}')
+        counts = DB.migrate_amounts(preview)
+        if not preview:
+            rec.schema = DB.SCHEMA
+            rec.save()
+            DB.rebuild_snapshots()
+            DB.results.invalidate()
+        return counts
+
+    @staticmethod
+    def migrate_amounts(preview: bool = False):
+        '''
+        Convert amounts stored as doubles to integer numbers of cents.  The
+        documents are read with a projected cursor and updated in batches of
+        BATCH_SIZE documents.  Documents that already have integer amounts
+        are not selected, so the migration can be run again if it is interrupted.
+
+        Returns a dictionary that maps collection and field names (e.g.
+        "entry.amount") to the number of values converted.
+
+        Arguments:
+            preview:  if True count the values but don't change them
+        '''
+        counts = {}
+        for cls, field in [(Entry, 'amount'), (Transaction, 'pamount')]:
+            collection = cls._get_collection()
+            name = f'{collection.name}.{field}'
+            if preview:
+                counts[name] = collection.count_documents({field: {'$type': 'double'}})
+                continue
+            cursor = collection.find({field: {'$type': 'double'}}, {field: 1}, batch_size=DB.BATCH_SIZE)
+            batch = []
+            n = 0
+            for doc in cursor:
+                batch.append(UpdateOne({'_id': doc['_id']}, {'$set': {field: cents(doc[field])}}))
+                if len(batch) == DB.BATCH_SIZE:
+                    collection.bulk_write(batch, ordered=False)
+                    n += len(batch)
+                    batch = []
+            if batch:
+                collection.bulk_write(batch, ordered=False)
+                n += len(batch)
+            logging.info(f'DB.migrate_amounts: converted {n} {field} values in {collection.name}')
+            counts[name] = n
+        return counts
 
     @staticmethod
     def create(dbname: str):
@@ -429,24 +828,88 @@ class DB:
         '''
         logging.debug(f'DB.create {dbname}')
 
+        if Config.DB.backend == 'sqlite':
+            DB.open_store(dbname, create=True)
+            return
+
         DB.connection = connect(dbname, UuidRepresentation='standard')
         if dbname in DB.dexters:
             DB.connection.drop_database(dbname)
         DB.database = DB.connection[dbname]
 
-        rec = Dexter(date = datetime.now())
+        rec = Dexter(date = datetime.now(), schema = DB.SCHEMA)
         rec.save()
         DB.dexters.add(dbname)
+        DB.write_registry()
 
         disconnect()
         DB.open(dbname)
 
+    @staticmethod
+    def sqlite_path(dbname):
+        '''
+        Return the path to the SQLite file for a database, made by inserting
+        the database name in Config.DB.path.
+        '''
+        return Path(Config.DB.path.format(name=dbname)).expanduser()
+
+    @staticmethod
+    def sqlite_names():
+        '''
+        Return the names of the SQLite databases, found by matching file
+        names in the directory named in Config.DB.path.
+        '''
+        pattern = Path(Config.DB.path).expanduser()
+        prefix, _, suffix = pattern.name.partition('{name}')
+        if not pattern.parent.is_dir():
+            return []
+        return [
+            p.name[len(prefix):len(p.name)-len(suffix)]
+            for p in pattern.parent.glob(f'{prefix}*{suffix}')
+            if p.is_file()
+        ]
+
+    @staticmethod
+    def require_mongodb(operation):
+        '''
+        Raise ValueError if the database uses a backend other than MongoDB.
+        Called at the start of operations that are implemented only for
+        MongoDB, before they change anything.
+
+        Arguments:
+            operation:  name of the command or method, used in the message
+        '''
+        if DB.store is not None or Config.DB.backend == 'sqlite':
+            raise ValueError(f'{operation} requires the MongoDB backend')
+
+    @staticmethod
+    def open_store(dbname, create=False):
+        '''
+        Open (or create) a database that uses the SQLite backend.  After this
+        call the methods in the storage interface use DB.store.
+        '''
+        # imported here because sqlstore imports the document classes from this module
+        from .sqlstore import SQLiteStore
+
+        if DB.store is not None:
+            DB.store.close()
+        DB.store = SQLiteStore(DB.sqlite_path(dbname), create=create)
+        DB.dbname = dbname
+        DB.results = ResultCache(Config.DB.cache_size)
+        DB.accounts.invalidate()
+        DB.reload_regexps()
+        DB.real_accounts = { a.name for a in DB.accounts.accounts(Category.L) }
+        DB.real_accounts |= { a.name for a in DB.accounts.accounts(Category.A) }
+
     @staticmethod
     def erase_database():
         '''
         Erase the database.
         '''
+        DB.require_mongodb('DB.erase_database')
         DB.connection.drop_database(DB.dbname)
+        DB.accounts.invalidate()
+        DB.results.invalidate()
 
     @staticmethod
     def restore_from_json(collection: str, doc: str, save=True):
@@ -465,20 +928,148 @@ class DB:
         else:
             return obj
 
+    BATCH_SIZE = 1000
+
     @staticmethod
     def save_as_json(f):
         '''
         Iterate over collections, write each record along with its 
-        collection name.
+        collection name.  Documents are read from a pymongo cursor and
+        written as they arrive, without creating MongoEngine objects.
 
         Arguments:
             f: file object for the output
         '''
+        DB.require_mongodb('save')
 
-        for collection, cls in DB.collections.items():
+        for collection in DB.collections:
             logging.debug(f'saving {collection}')
-            for obj in cls.objects:
-                print(f'{collection}: {obj.to_json()}', file=f)
+            for doc in DB.database[collection].find(batch_size=DB.BATCH_SIZE):
+                print(f'{collection}: {json_util.dumps(doc, json_options=LEGACY_JSON_OPTIONS)}', file=f)
+
+    @staticmethod
+    def restore_from_file(f):
+        '''
+        Read lines written by save_as_json and insert the documents.  Documents
+        are collected in batches for each collection and written with insert_many,
+        so memory use does not depend on the size of the file.  Indexes are
+        created after all the documents are loaded.
+
+        Arguments:
+            f: file object for the input
+        '''
+        DB.require_mongodb('restore')
+        batches = {}
+        for line in f:
+            try:
+                sep = line.find(':')
+                collection = line[:sep]
+                if collection not in DB.collections:
+                    raise ValueError(f'restore: unknown collection: {collection}')
+                batch = batches.setdefault(collection, [])
+                batch.append(json_util.loads(line[sep+1:], json_options=LEGACY_JSON_OPTIONS))
+                if len(batch) >= DB.BATCH_SIZE:
+                    DB.insert_batch(collection, batch)
+                    batch.clear()
+            except Exception as err:
+                logging.error(err)
+        for collection, batch in batches.items():
+            DB.insert_batch(collection, batch)
+        DB.create_indexes()
+        if not DB.upgrade():
+            DB.rebuild_snapshots()
+        DB.accounts.invalidate()
+        DB.results.invalidate()
+        DB.reload_regexps()
+
+    @staticmethod
+    def insert_batch(collection, docs):
+        '''
+        Helper function for restore_from_file.  Insert a list of documents,
+        logging any that could not be inserted.
+        '''
+        if not docs:
+            return
+        logging.debug(f'DB: restoring {len(docs)} {collection} documents')
+        try:
+            DB.database[collection].insert_many(docs, ordered=False)
+        except BulkWriteError as bwe:
+            for err in bwe.details['writeErrors']:
+                logging.error(f'DB: {err['errmsg']} restoring {collection}')
+
+    # Index management
+
+    @staticmethod
+    def indexed_models():
+        '''
+        Return the list of document classes that declare indexes.
+        '''
+        return [cls for cls in [Account, Entry, Transaction, RegExp] if cls._meta.get('index_specs')]
+
+    @staticmethod
+    def create_indexes():
+        '''
+        Create any of the declared indexes that are not already defined.
+        '''
+        DB.require_mongodb('index')
+        for cls in DB.indexed_models():
+            logging.debug(f'DB: creating indexes for {cls._get_collection_name()}')
+            cls.ensure_indexes()
+
+    @staticmethod
+    def rebuild_indexes():
+        '''
+        Drop all indexes (except the one on _id) and create the declared indexes.
+        '''
+        DB.require_mongodb('index')
+        for cls in DB.indexed_models():
+            logging.debug(f'DB: rebuilding indexes for {cls._get_collection_name()}')
+            cls._get_collection().drop_indexes()
+            cls.ensure_indexes()
+
+    @staticmethod
+    def missing_indexes():
+        '''
+        Return a dictionary that maps collection names to lists of declared
+        indexes that have not been created.  Uses the pymongo collection
+        since MongoEngine creates indexes when a collection is first accessed.
+        '''
+        DB.require_mongodb('index')
+        res = {}
+        for cls in DB.indexed_models():
+            name = cls._get_collection_name()
+            existing = [spec['key'] for spec in DB.database[name].index_information().values()]
+            res[name] = [keys for keys in cls.list_indexes() if keys not in existing]
+        return res
+
+    @staticmethod
+    def explain():
+        '''
+        Stop recording queries and run explain on each query in the current
+        database recorded by DB.monitor (see monitor.py).  Returns a list of
+        tuples with the Query object and a dictionary with the results of explain.
+        '''
+        DB.monitor.capture = False
+        client = DB.database.client
+        return [(q, explain(client, q)) for q in DB.monitor.queries if q.database == DB.dbname]
+
+    @staticmethod
+    def index_info():
+        '''
+        Return a list of descriptions of the indexes in the database.  Each
+        description is a tuple with the collection name, index name, list of
+        keys, and index size in bytes.
+        '''
+        DB.require_mongodb('index')
+        res = []
+        for cls in DB.indexed_models():
+            coll = DB.database[cls._get_collection_name()]
+            stats = next(coll.aggregate([{'$collStats': {'storageStats': {}}}]))
+            sizes = stats['storageStats'].get('indexSizes', {})
+            for name, spec in coll.index_information().items():
+                keys = [k for k, _ in spec['key']]
+                res.append((coll.name, name, keys, sizes.get(name, 0)))
+        return res
 
     @staticmethod
     def add_message(s):
@@ -493,64 +1084,210 @@ class DB:
         return sorted(Message.objects, key=lambda m: m.date)
 
     @staticmethod
+    @writes('account', 'entry', 'transaction')
+    @storage
     def save_records(lst):
         '''
-        Save records in the database.  Makes two passes.  On the first pass 
-        every object is saved.  On the second pass, the Entry objects in any
-        Transactions found in the first pass are updated to refer to the
-        Transaction.
+        Save records in the database.  New objects are given ObjectIds before
+        anything is written so the references between Transactions and their
+        Entry objects (the entries list and the tref field) can be filled in
+        first.  Documents are then written with one bulk_write call per
+        collection, Entry objects before Transactions.  A Transaction is not
+        written if one of its entries could not be saved.
+        '''
+        docs = {}
+        parents = {}
+        for obj in lst:
+            if isinstance(obj, Transaction):
+                if len(obj.entries) == 0:
+                    logging.debug(f'DB.save_records: transaction has no entries, skipping {obj}')
+                    continue
+                for e in obj.entries:
+                    docs.setdefault(Entry, {})[id(e)] = e
+                    parents[id(e)] = obj
+            docs.setdefault(type(obj), {})[id(obj)] = obj
+
+        new = set()
+        for dct in docs.values():
+            for key, obj in dct.items():
+                if obj.pk is None:
+                    new.add(key)
+                    obj.id = ObjectId()
+        for key, t in parents.items():
+            docs[Entry][key].tref = t
+
+        failed = set()
+        for cls in sorted(docs, key=lambda c: c != Entry):
+            if cls == Transaction:
+                for key, t in parents.items():
+                    if key in failed and id(t) not in failed:
+                        logging.error(f'DB: entry not saved, skipping {t}')
+                        failed.add(id(t))
+            objs = [obj for key, obj in docs[cls].items() if key not in failed]
+            failed |= DB.bulk_save(cls, objs, new)
+            if cls == Transaction:
+                DB.unlink_entries([t for key, t in docs[cls].items() if key in failed])
+            elif cls == Account:
+                DB.accounts.invalidate()
+            elif cls == RegExp:
+                DB.reload_regexps()
+
+        for dct in docs.values():
+            for key, obj in dct.items():
+                if key in failed and key in new:
+                    obj.id = None
+
+    @staticmethod
+    def bulk_save(cls, lst, new):
+        '''
+        Helper function for save_records.  Validate the objects, then send
+        the new ones as inserts and the modified ones as updates in a single
+        bulk write.  Returns the set of ids (Python object ids) of the objects
+        that could not be saved.
+
+        Arguments:
+            cls:  the document class
+            lst:  a list of objects of that class
+            new:  ids of objects that are not in the database yet
         '''
-        tlist = []
+        failed = set()
+        ops = []
+        saved = []
+        tracked = []
         for obj in lst:
             logging.debug(f'DB.save_records: saving {obj}')
             try:
-                obj.save()
+                obj.validate()
+                if id(obj) in new:
+                    ops.append(InsertOne(obj.to_mongo()))
+                    tracked.append(obj)
+                else:
+                    updates, removals = obj._delta()
+                    if not (updates or removals):
+                        continue
+                    if {f.split('.')[0] for f in (updates | removals)} & MonthlySnapshots.FIELDS:
+                        tracked.append(obj)
+                    doc = {}
+                    if updates:
+                        doc['$set'] = updates
+                    if removals:
+                        doc['$unset'] = removals
+                    ops.append(UpdateOne({'_id': obj.pk}, doc))
+                saved.append(obj)
             except Exception as err:
                 logging.error(f'DB: {err} saving {obj}')
-            if isinstance(obj, Transaction):
-                tlist.append(obj)
+                failed.add(id(obj))
+        if not ops:
+            return failed
+        if cls is not Entry:
+            tracked = []
+        ids = [obj.pk for obj in tracked if id(obj) not in new]
+        old = DB.snapshots.fetch(cls._get_collection(), {'_id': {'$in': ids}}) if ids else []
+        try:
+            cls._get_collection().bulk_write(ops, ordered=False)
+        except BulkWriteError as bwe:
+            for err in bwe.details['writeErrors']:
+                obj = saved[err['index']]
+                logging.error(f'DB: {err['errmsg']} saving {obj}')
+                failed.add(id(obj))
+        for obj in saved:
+            if id(obj) not in failed:
+                obj._clear_changed_fields()
+                obj._created = False
+        if tracked:
+            saved_ids = {obj.pk for obj in tracked if id(obj) not in failed}
+            DB.snapshots.update(
+                [doc for doc in old if doc['_id'] in saved_ids],
+                [obj.to_mongo() for obj in tracked if id(obj) not in failed],
+            )
+        return failed
+
+    @staticmethod
+    @writes('entry', 'transaction')
+    def tracked_write(query, write):
+        '''
+        Run a function that modifies or deletes entries, then update the monthly
+        snapshots using the versions of the entries before and after the write.
+        Returns the value returned by the write function.
+
+        Arguments:
+            query:  a pymongo query that selects the entries the function will change
+            write:  a function with no arguments that writes to the database
+        '''
+        collection = Entry._get_collection()
+        old = DB.snapshots.fetch(collection, query)
+        res = write()
+        if old:
+            new = DB.snapshots.fetch(collection, {'_id': {'$in': [doc['_id'] for doc in old]}})
+            DB.snapshots.update(old, new)
+        return res
+
+    @staticmethod
+    def unlink_entries(tlist):
+        '''
+        Helper function for save_records.  Clear the tref field in the Entry
+        objects of Transactions that were not saved.
+        '''
+        ids = []
         for t in tlist:
             for e in t.entries:
-                logging.debug(f'DB.save_records: updating {e}')
-                e.tref = t
-                try:
-                    e.save()
-                except Exception as err:
-                    logging.error(f'DB: {err} saving {e}')
+                e.tref = None
+                ids.append(e.pk)
+        if ids:
+            Entry._get_collection().update_many({'_id': {'$in': ids}}, {'$unset': {'tref': 1}})
 
     MAX_DUPS = 10
 
     @staticmethod
-    def assign_uids(recs):
+    def assign_uids(recs, uids=None):
         '''
         Handle duplicates in new records by modifying the description so the 
-        UID is different from the other copies.
+        UID is different from the other copies.  If a record already has a
+        UID (computed by an import worker) it is used instead of the hash, and
+        it is updated when the description changes.
 
         Arguments:
             recs:  a list of Entry objects
+            uids:  hashes of records from earlier batches of the same file
+                (the set is updated with the hashes of the new records)
         '''
-        uids = set()
+        if uids is None:
+            uids = set()
         for obj in recs:
             logging.debug(f'assign UID to {obj}')
             desc = obj.description
+            h = obj.uid or obj.hash
             n = 0
-            while obj.hash in uids:
+            while h in uids:
                 n += 1
                 if n > DB.MAX_DUPS:
                     logging.error(f'add: max {DB.MAX_DUPS} copies exceeded for {obj}')
                     raise ValueError(f'save_records: no uid: {obj}')
                 obj.description = f'{desc} ({n})'
+                h = obj.hash
                 logging.debug(f'  {obj.description}')
             # obj.save()
-            uids.add(obj.hash)
+            if obj.uid:
+                obj.uid = h
+            uids.add(h)
 
     @staticmethod
-    def uids():
+    @storage
+    def uids(compact=None):
         '''
         Return the set of unique identifiers (uids) on all Entry
-        documents in the database. 
+        documents in the database.  The query projects only the uid
+        field so it can be answered from the uid index.
+
+        Arguments:
+            compact:  if True return a UIDSet instead of a Python set
+                (the default is the compact_uids setting in the config file)
         '''
-        return {e.uid for e in Entry.objects}
+        if compact is None:
+            compact = Config.DB.compact_uids
+        cursor = Entry._get_collection().find({}, {'uid': 1, '_id': 0})
+        uids = (doc['uid'] for doc in cursor)
+        return UIDSet(uids) if compact else set(uids)
 
     @staticmethod
     def fullname(s: str):
@@ -558,9 +1295,7 @@ class DB:
         The argument s is an account name that could be a full name or abbreviated
         name.  Return the full account name or None if the name isn't defined.
         '''
-        if lst := Account.objects(name__exact=s) or Account.objects(abbrev__exact=s):
-            return lst[0].name
-        return None
+        return DB.accounts.fullname(s)
     
     @staticmethod
     def display_name(s: str, markdown=False):
@@ -585,34 +1320,24 @@ class DB:
         Should only be called in contexts where s is known to be a valid account name
         (e.g. a report generator).
         '''
-        try:
-            acct = Account.objects.get(name=s)
-            res = acct.abbrev or s
-        except Account.DoesNotExist:
-            res = None
-        return res
+        return DB.accounts.abbrev(s)
     
     @staticmethod
     def find_account(s: str):
         '''
-        Return a list of account names that contain a string.
+        Return a list of accounts with names that contain a string.
 
         Arguments:
             s:  the string to search for
         '''
-        return Account.objects(name__contains=s)
+        return DB.accounts.find(s)
     
     @staticmethod
     def account_name_parts(category=None):
         '''
         Return all the strings that appear as part of an account name.
         '''
-        res = set()
-        for acct in Account.objects:
-            if category and acct.category != category:
-                continue
-            res |= set(acct.name.split(':'))
-        return res
+        return DB.accounts.name_parts(category)
     
     @staticmethod
     def account_names(category=None, with_parts=True):
@@ -628,18 +1353,7 @@ class DB:
             category:  an account type (assets, expenses, ...)
             with_parts:  if True include node names
         '''
-        dct = {}
-        for acct in Account.objects:
-            if category and acct.category != category:
-                continue
-            dct[acct.name] = { acct.name }
-            if acct.abbrev:
-                dct[acct.abbrev] = { acct.name }
-            if with_parts:
-                for p in acct.name.split(':'):
-                    grp = dct.setdefault(p, set())
-                    grp.add(acct.name)
-        return dct
+        return DB.accounts.names(category, with_parts)
     
     @staticmethod
     def expand_node(spec):
@@ -647,18 +1361,34 @@ class DB:
         A command line argument had an account name and level.  Return the
         list of accounts below to the specified level.  Each list element is
         a pattern that will match an account and all accounts below it.
+        The name can be any node in the account tree, e.g. "expenses:2" or 
+        "car:1".
         '''
         node, n = re.match(r'(.*):(\d+)',spec).groups()
-        level = int(n)
-        res = []
-        for acct in Account.objects(name__iregex=node):
-            name = acct.name
-            pre, post = name.split(node)
-            if post.count(':') < level:
-                res.append(name + '$')
-            elif post.count(':') == level:
-                res.append(name)
-        return res
+        return DB.accounts.expand(node, int(n))
+
+    @staticmethod
+    def complete_account(prefix):
+        '''
+        Return a sorted list of account names that start with a prefix.
+        '''
+        return DB.accounts.complete(prefix)
+
+    @staticmethod
+    def subaccounts(name):
+        '''
+        Return the names of an account and all the accounts below it in the
+        account tree.  The name can be an interior node that is not an account.
+        '''
+        return [a.name for a in DB.accounts.subtree(name)]
+
+    @staticmethod
+    def rollup(totals):
+        '''
+        Given a dictionary that maps account names to amounts, return
+        a dictionary with totals for every node in the account tree.
+        '''
+        return DB.accounts.rollup(totals)
     
     @staticmethod
     def card_accounts():
@@ -666,9 +1396,11 @@ class DB:
         Return a list of credit card accounts -- liability accounts that have a 
         parser.
         '''
-        return [a for a in Account.objects(category='liabilities') if a.parser]
+        return [a for a in DB.accounts.accounts(Category.L) if a.parser]
 
     @staticmethod
+    @cached('account', 'entry')
+    @storage
     def column_sum(account, column, starting=None, ending=None, nobudget=False):
         '''
         Compute the sum of amounts for Entry objects based on account name and column type.
@@ -689,28 +1421,144 @@ class DB:
             tagged = Entry.objects(**kwargs).sum('amount')
             logging.debug(f'   tagged: {tagged}')
             total -= tagged
-        return total
+        return Amount.from_cents(total)
     
     @staticmethod
     def balance(account, ending=None, nobudget=False):
-        debits = DB.column_sum(account, Column.dr, ending=ending, nobudget=nobudget)
-        credits = DB.column_sum(account, Column.cr, ending=ending, nobudget=nobudget)
-        return debits - credits
+        '''
+        Compute the balance (debits minus credits) of entries for accounts
+        that match a pattern, optionally up to an ending date.
+        '''
+        b = DB.balances([account], ending=ending, nobudget=nobudget)[account]
+        return Amount.from_cents(b.debits.cents - b.credits.cents)
+
+    @staticmethod
+    @cached('account', 'entry')
+    @storage
+    def balances(accounts, starting=None, ending=None, nobudget=False):
+        '''
+        Compute balances for a list of account patterns.  Totals for complete
+        months come from the snapshot collection, and entries are read only
+        for the partial months at the start and end of the period.  Both
+        aggregations group amounts by account name, column, and whether the
+        date is before the starting date.  The groups are then added up
+        for each pattern that matches the account name.
+
+        Returns a dictionary that maps each pattern to a Balance tuple with
+        the balance before the starting date and the sums of debits and
+        credits from the starting date through the ending date.  If no
+        starting date is given every entry is in the period.
+
+        Arguments:
+            accounts:  a list of account name patterns
+            starting:  first date in the period
+            ending:  last date in the period
+            nobudget:  if True leave out entries tagged #budget
+        '''
+        date = Entry._fields['date']
+        starting = date.to_mongo(starting) if starting else None
+        ending = date.to_mongo(ending) if ending else None
+        names = {'$in': [re.compile(p, re.I) for p in accounts]}
+        snaps, raw, first = MonthlySnapshots.split(starting, ending)
+
+        snaps['account'] = names
+        if nobudget:
+            snaps['budget'] = False
+        pipelines = [(DB.snapshots.collection, [
+            {'$match': snaps},
+            {'$group': {
+                '_id': {'account': '$account', 'column': '$column', 'before': {'$lt': ['$month', first]} if first else False},
+                'total': {'$sum': '$total'},
+            }},
+        ])]
+        if raw:
+            match = {'$and': [raw, {'account': names}]}
+            if nobudget:
+                match['tags'] = {'$ne': Tag.B.value}
+            pipelines.append((Entry._get_collection(), [
+                {'$match': match},
+                {'$group': {
+                    '_id': {'account': '$account', 'column': '$column', 'before': {'$lt': ['$date', starting]} if starting else False},
+                    'total': {'$sum': '$amount'},
+                }},
+            ]))
+
+        totals = {p: [0, 0, 0] for p in accounts}
+        patterns = [(p, re.compile(p, re.I)) for p in accounts]
+        for collection, pipeline in pipelines:
+            logging.debug(f'DB.balances: {collection.name} pipeline {pipeline}')
+            for rec in collection.aggregate(pipeline):
+                key = rec['_id']
+                amount = rec['total']
+                for p, expr in patterns:
+                    if not expr.search(key['account']):
+                        continue
+                    t = totals[p]
+                    if key['before']:
+                        t[0] += amount if key['column'] == Column.dr.value else -amount
+                    elif key['column'] == Column.dr.value:
+                        t[1] += amount
+                    else:
+                        t[2] += amount
+        return {p: Balance(*(Amount.from_cents(n) for n in t)) for p, t in totals.items()}
+
+    @staticmethod
+    def rebuild_snapshots():
+        '''
+        Recompute the monthly balance snapshots from the Entry collection.
+        '''
+        DB.require_mongodb('snapshot')
+        DB.snapshots.rebuild(Entry._get_collection())
 
     # RegExp management -- delete old records so new ones can be
     # imported
 
     @staticmethod
+    @storage
+    def load_accounts():
+        '''
+        Return all the Account documents (used to load the account directory).
+        '''
+        return Account.objects
+
+    @staticmethod
+    @storage
+    def load_regexps():
+        '''
+        Return all the RegExp documents, in the order they were defined.
+        '''
+        return RegExp.objects
+
+    @staticmethod
+    @storage
     def delete_regexps():
         '''
         Delete all the RegExp documents
         '''
         res = RegExp.objects.delete()
         logging.debug(f'DB: deleted {res} existing regular expressions')
+        DB.reload_regexps()
 
-    # RegExp search.  The first version is a simple linear search.
-    # TBD: implement an indexing scheme based on the first letter
-    # in the string.
+    # RegExp search.  The RegExp collection is fetched and compiled once
+    # (by DB.rules) and the searches are done in memory.
+
+    @staticmethod
+    def reload_regexps():
+        '''
+        Discard the compiled rules so they are fetched again the next time
+        they are used.  Call this after RegExp documents are added or deleted.
+        '''
+        DB.ruleset = None
+
+    @staticmethod
+    def rules():
+        '''
+        Return the RuleSet with the compiled RegExp documents, creating
+        it if necessary.
+        '''
+        if DB.ruleset is None:
+            DB.ruleset = RuleSet(DB.load_regexps())
+        return DB.ruleset
 
     @staticmethod
     def find_first_regexp(s: str, a: Action):
@@ -722,10 +1570,7 @@ class DB:
             s: the string to match
             a: the action category
         '''
-        for e in RegExp.objects(action=a):
-            if e.matches(s):
-                return e
-        return None
+        return DB.rules().find_first(s, a)
 
     @staticmethod
     def apply_all_regexp(s: str):
@@ -735,74 +1580,377 @@ class DB:
         Arguments:
             s: the string to match.
         '''
-        for e in RegExp.objects(action=Action.S):
-            logging.debug(f'apply_all_regexp "{s}" {e}')
-            if r := e.apply(s):
-                s = r
-        return s
+        return DB.rules().apply_all(s, Action.S)
 
     @staticmethod
+    @cached('account', 'entry', 'transaction', plans=True)
+    @storage
     def select(collection, **constraints):
         '''
         Fetch transactions that match constraints.
 
+        Account names and tags are regular expressions that can match anywhere
+        in a name, but an account constraint that is an abbreviation (e.g.
+        "groceries") is replaced by the account's full name and matches only
+        that account:  it is no longer also a pattern for other names that
+        contain the same string.
+
         Arguments:
             collection:  the collection to search (Entry or Transaction)
             constraints:  a dictionary of field names and values
         '''
+        res = DB.queryset(collection, **constraints)
+        if spec := constraints.get('update'):
+            DB.bulk_update(collection, res._query, spec)
+            res = []
+        return res
+
+    @staticmethod
+    def queryset(collection, **constraints):
+        '''
+        Helper function for select and query.  Returns the (uncached)
+        QuerySet for the documents that match constraints.
+        '''
         logging.debug(f'DB.select: {constraints}')
+        DB.plans = []
         if collection not in [Entry, Transaction]:
             raise ValueError('select: collection must be Entry or Transaction')
         
         mapping = Transaction.constraints if collection == Transaction else Entry.constraints
         dct = {}
+        raw = {}
         for field, value in constraints.items():
             if field not in mapping:
                 raise ValueError(f'select: unknown constraint: {field}')
             if field == 'tag':
                 if value.startswith('^'):
-                    dct['tags__not__iregex'] = value[1:]
+                    raw['tags'] = DB.plan(collection, 'tags', value[1:], negate=True)
                 else:
-                    dct['tags__iregex'] = value
-            elif field not in ['update', 'delete']:
+                    raw['tags'] = DB.plan(collection, 'tags', value)
+            elif field in ['update', 'delete']:
+                continue
+            elif (name := (mapping[field] or '').removesuffix('__iregex')) in collection.planned:
+                raw[name] = DB.plan(collection, name, value)
+            else:
                 dct[mapping[field]] = value
-        if spec := constraints.get('update'):
-            upfield, upvalue = spec
-            if upfield not in collection.updaters:
-                raise ValueError(f'select: cannot update {upfield} in {collection._class_name}')
-            if upfield == 'tag':
-                if upvalue.startswith('^'):
-                    cmnd = 'pull__tags'
-                    upvalue = upvalue[1:]
-                else:
-                    cmnd = 'push__tags'
+        if raw:
+            dct['__raw__'] = raw
+        logging.debug(f'  objects {dct}')
+        return collection.objects(Q(**dct))
+
+    @staticmethod
+    def query(collection, **constraints):
+        '''
+        Return the pymongo filter for the documents that match constraints
+        (see DB.select).
+        '''
+        DB.require_mongodb('select --update and --delete')
+        return DB.queryset(collection, **constraints)._query
+
+    @staticmethod
+    def update_spec(collection, upfield, upvalue):
+        '''
+        Helper function for bulk_update.  Returns the pymongo update document
+        for a field and value from the command line and a filter that selects
+        the documents the update would change.  A tag is added with $addToSet
+        so it is not added again to documents that already have it, and a tag
+        that starts with ^ is removed.
+        '''
+        if upfield not in collection.updaters:
+            raise ValueError(f'select: cannot update {upfield} in {collection._class_name}')
+        if upfield == 'tag':
+            if upvalue.startswith('^'):
+                return {'$pull': {'tags': upvalue[1:]}}, {'tags': upvalue[1:]}
+            return {'$addToSet': {'tags': upvalue}}, {'tags': {'$ne': upvalue}}
+        field = collection._fields[collection.updaters[upfield].removeprefix('set__')]
+        value = field.prepare_query_value('set', upvalue)
+        return {'$set': {field.db_field: value}}, {field.db_field: {'$ne': value}}
+
+    @staticmethod
+    @writes('entry', 'transaction')
+    def bulk_update(collection, query, spec, preview=False):
+        '''
+        Update all documents that match a query with a single update_many.
+        Returns a tuple with the number of documents that match the query and the
+        number that were (or, in preview mode, would be) changed.  In preview
+        mode the numbers are computed with count_documents, without fetching
+        any documents.
+
+        Arguments:
+            collection:  the collection to update (Entry or Transaction)
+            query:  a pymongo filter (see DB.query)
+            spec:  a tuple with the name of the field to update and the new value
+            preview:  if True count the documents but don't update them
+        '''
+        DB.require_mongodb('DB.bulk_update')
+        update, changes = DB.update_spec(collection, *spec)
+        coll = collection._get_collection()
+        logging.debug(f'DB.bulk_update: {query} {update}')
+        if preview:
+            return coll.count_documents(query), coll.count_documents({'$and': [query, changes]})
+        if collection is Entry:
+            res = DB.tracked_write(query, lambda: coll.update_many(query, update))
+        else:
+            res = coll.update_many(query, update)
+        return res.matched_count, res.modified_count
+
+    @staticmethod
+    @writes('entry', 'transaction')
+    def bulk_delete(collection, query, preview=False, cascade=False):
+        '''
+        Delete all documents that match a query with delete_many.  Deleting
+        a Transaction unlinks its entries:  their tref fields are cleared and
+        they are tagged #unpaired again.
+
+        Deleting an Entry removes it from the entries list of its Transaction
+        and updates the transaction's summary fields.  A transaction left with
+        no entries is deleted.  If cascade is True the Transaction an Entry
+        belongs to is deleted as well, so the other entries in that transaction
+        are unlinked.
+
+        Returns a dictionary with the number of transactions and entries
+        deleted, the number of entries unlinked, and the number of transactions
+        updated.  In preview mode nothing is deleted and only document ids
+        are fetched.
+
+        Arguments:
+            collection:  the collection (Entry or Transaction)
+            query:  a pymongo filter (see DB.query)
+            preview:  if True count the documents but don't delete them
+            cascade:  if True also delete the transactions of deleted entries
+        '''
+        DB.require_mongodb('DB.bulk_delete')
+        entries = Entry._get_collection()
+        transactions = Transaction._get_collection()
+        counts = {'transaction': 0, 'entry': 0, 'unlinked': 0, 'updated': 0}
+        eids = []
+        tids = []
+        updated = []
+        if collection is Entry:
+            parents = set()
+            for doc in entries.find(query, {'tref': 1}):
+                eids.append(doc['_id'])
+                if tref := doc.get('tref'):
+                    parents.add(tref)
+            if cascade:
+                tids = list(parents)
             else:
-                cmnd = collection.updaters[upfield]
-            upargs = {cmnd: upvalue}
-            logging.debug(f'  objects {dct} update {upargs}')
-            collection.objects(Q(**dct)).update(**upargs)
-            res = []
+                deleted = set(eids)
+                for doc in transactions.find({'_id': {'$in': list(parents)}}, {'entries': 1}):
+                    if all(x in deleted for x in doc.get('entries', [])):
+                        tids.append(doc['_id'])
+                    else:
+                        updated.append(doc['_id'])
         else:
-            logging.debug(f'  objects {dct}')
-            res = collection.objects(Q(**dct))
+            tids = transactions.distinct('_id', query)
+        linked = {'tref': {'$in': tids}, '_id': {'$nin': eids}}
+        counts['entry'] = len(eids)
+        counts['transaction'] = len(tids)
+        counts['updated'] = len(updated)
+        logging.debug(f'DB.bulk_delete: {len(tids)} transactions, {len(eids)} entries, {len(updated)} updated')
+        if preview:
+            counts['unlinked'] = entries.count_documents(linked) if tids else 0
+            return counts
+        if eids:
+            DB.tracked_write({'_id': {'$in': eids}}, lambda: entries.delete_many({'_id': {'$in': eids}}))
+        if updated:
+            transactions.update_many({'_id': {'$in': updated}}, {'$pull': {'entries': {'$in': eids}}})
+            DB.update_summaries(updated)
+        if tids:
+            res = entries.update_many(linked, {'$unset': {'tref': 1}, '$addToSet': {'tags': Tag.U.value}})
+            counts['unlinked'] = res.modified_count
+            transactions.delete_many({'_id': {'$in': tids}})
+        return counts
+
+    @staticmethod
+    def update_summaries(tids):
+        '''
+        Helper function for bulk_delete.  Recompute the summary fields (pdate,
+        pamount, pdebit, and pcredit) of transactions after entries were
+        removed from them, and write the new values with one bulk_write.
+
+        Arguments:
+            tids:  a list of Transaction ids
+        '''
+        ops = []
+        for t in DB.prefetch(Transaction.objects(id__in=tids)):
+            t.clean()
+            doc = t.to_mongo()
+            ops.append(UpdateOne({'_id': t.id}, {'$set': {f: doc.get(f) for f in ['pdate', 'pamount', 'pdebit', 'pcredit']}}))
+        if ops:
+            Transaction._get_collection().bulk_write(ops, ordered=False)
+
+    @staticmethod
+    def plan(collection, field, pattern, negate=False):
+        '''
+        Helper function for select.  Translate a pattern for an account name
+        or tag into a query condition that can use an index (see planner.py).
+        The distinct values of the field are read from the index (see
+        DB.distinct).  Abbreviations are replaced by full account names.  The
+        plans are saved in DB.plans and logged at the info level.
+
+        Arguments:
+            collection:  the collection to search (Entry or Transaction)
+            field:  the name of the field
+            pattern:  a regular expression
+            negate:  if True select documents that do not match
+        '''
+        if field != 'tags' and (name := DB.accounts.fullname(pattern)) and name != pattern:
+            pattern = re.escape(name)
+        values = DB.distinct(collection, field)
+        p = plan_match(field, pattern, values, negate)
+        logging.info(f'select: {collection.__name__}.{field} ~ {pattern!r}: {p.kind} {p.condition}')
+        DB.plans.append(p)
+        return p.condition
+
+    plans = []
+
+    @staticmethod
+    @cached('entry', 'transaction')
+    @storage
+    def distinct(collection, field):
+        '''
+        Helper function for plan.  Return a list of the distinct values of a
+        field.  The list is saved in the result cache, so a select with several
+        patterns, or one that updates or deletes documents, does not read the
+        index again until entries or transactions are written.
+
+        Arguments:
+            collection:  the collection to search (Entry or Transaction)
+            field:  the name of the field
+        '''
+        return collection._get_collection().distinct(field)
+
+    @staticmethod
+    @storage
+    def prefetch(recs):
+        '''
+        Load the documents referred to by a list of Entry or Transaction objects
+        (similar to select_related in other ORMs).  Fetches every Transaction 
+        named in a tref field and every Entry in the entries list of those
+        transactions with one $in query per collection, then attaches the
+        objects so later references to e.tref or t.entries do not query
+        the database.  Returns the objects in a list.
+
+        Arguments:
+            recs:  a list or QuerySet of Entry or Transaction objects
+        '''
+        recs = list(recs)
+        entries = {e.id: e for e in recs if isinstance(e, Entry)}
+        transactions = {t.id: t for t in recs if isinstance(t, Transaction)}
+
+        ids = {ref_id(e._data.get('tref')) for e in entries.values()} - set(transactions) - {None}
+        if ids:
+            transactions |= {t.id: t for t in Transaction.objects(id__in=list(ids))}
+
+        ids = {ref_id(x) for t in transactions.values() for x in t._data.get('entries') or []} - set(entries) - {None}
+        if ids:
+            entries |= {e.id: e for e in Entry.objects(id__in=list(ids))}
+
+        for e in entries.values():
+            if (tid := ref_id(e._data.get('tref'))) in transactions:
+                e._data['tref'] = transactions[tid]
+        for t in transactions.values():
+            lst = BaseList([entries.get(ref_id(x), x) for x in t._data.get('entries') or []], t, 'entries')
+            lst._dereferenced = True
+            t._data['entries'] = lst
+        logging.debug(f'DB.prefetch: {len(entries)} entries, {len(transactions)} transactions')
+        return recs
+
+    @staticmethod
+    @storage
+    def frame(**constraints):
+        '''
+        Load the entries that match constraints into a columnar Frame (see
+        frame.py) for analysis with NumPy.  Only the fields stored in the
+        frame are fetched, with a single projected cursor, and no Entry
+        objects are created.  Requires NumPy (pip install dexter[analytics]).
+
+        Arguments:
+            constraints:  Entry constraints (see DB.select)
+        '''
+        from .frame import Frame
+        query = DB.query(Entry, **constraints)
+        projection = {'_id': 0, 'date': 1, 'amount': 1, 'account': 1, 'column': 1, 'tags': 1}
+        cursor = Entry._get_collection().find(query, projection, batch_size=10000)
+        res = Frame.from_records(cursor)
+        logging.debug(f'DB.frame: {len(res)} entries')
         return res
-    
+
     @staticmethod
     def validate(cls):
         '''
         Run consistenct checks on Transactions or Entries.  Returns a list tuples with
         objects that don't satisfy their constraints and the reason for the failure.
+
+        The checks are the ones in validate_transaction and validate_entry, but
+        instead of loading every object (and dereferencing its links) the method
+        reads the fields it needs from two projected cursors and joins them in
+        memory.  Only the objects that fail a check are fetched as documents.
         '''
+        DB.require_mongodb('audit')
         assert cls in [Transaction, Entry]
-        validator = DB.validate_transaction if cls == Transaction else DB.validate_entry
+        entries = Entry._get_collection().find({}, {'amount': 1, 'column': 1, 'tags': 1, 'tref': 1})
+        transactions = Transaction._get_collection().find({}, {'entries': 1})
+        if cls == Transaction:
+            reasons = DB.audit_transactions(transactions, entries)
+        else:
+            reasons = DB.audit_entries(entries, transactions)
         failed = []
-        for t in cls.objects():
-            try:
-                validator(t)
-            except AssertionError as reason:
-                failed.append((t,reason.args[0]))
+        for obj in DB.prefetch(cls.objects(id__in=list(reasons))):
+            failed.append((obj, reasons[obj.id]))
         return failed
 
+    @staticmethod
+    def audit_transactions(transactions, entries):
+        '''
+        Helper function for validate.  Returns a dictionary that maps the id
+        of each Transaction that fails a check to the reason for the failure.
+
+        Arguments:
+            transactions:  an iterable of Transaction documents with entries
+            entries:  an iterable of Entry documents with amount and column
+        '''
+        values = {}
+        for doc in entries:
+            values[doc['_id']] = doc['amount'] if doc['column'] == Column.dr.value else -doc['amount']
+        res = {}
+        for doc in transactions:
+            lst = doc.get('entries', [])
+            if len(lst) < 2:
+                res[doc['_id']] = "fewer than two entries"
+            elif sum(values.get(e, 0) for e in lst) != 0:
+                res[doc['_id']] = "unbalanced"
+        return res
+
+    @staticmethod
+    def audit_entries(entries, transactions):
+        '''
+        Helper function for validate.  Returns a dictionary that maps the id
+        of each Entry that fails a check to the reason for the failure.
+
+        Arguments:
+            entries:  an iterable of Entry documents with amount, tags, and tref
+            transactions:  an iterable of Transaction documents with entries
+        '''
+        links = set()
+        for doc in transactions:
+            for e in doc.get('entries', []):
+                links.add((doc['_id'], e))
+        res = {}
+        for doc in entries:
+            tref = doc.get('tref')
+            if not isinstance(doc['amount'], int):
+                res[doc['_id']] = "amount not stored in cents"
+            elif Tag.U.value in doc.get('tags', []):
+                if tref is not None:
+                    res[doc['_id']] = "tref in unpaired entry"
+            elif tref is None:
+                res[doc['_id']] = "missing tref in entry"
+            elif (tref, doc['_id']) not in links:
+                res[doc['_id']] = "not linked to parent transaction"
+        return res
+
     @staticmethod
     def validate_transaction(t):
         '''
@@ -813,7 +1961,7 @@ class DB:
         '''
         logging.debug(f'validating {t}')
         assert len(t.entries) >= 2, "fewer than two entries"
-        assert round(sum(e.value for e in t.entries), 2) == 0, "unbalanced"
+        assert sum(e.value.cents for e in t.entries) == 0, "unbalanced"
 
     @staticmethod
     def validate_entry(e):
@@ -823,7 +1971,7 @@ class DB:
         * the transaction reference in a paired Entry refers to a valid Transaction
         '''
         logging.debug(f'validating {e}')
-        assert e.value == round(e.value,2), "roundoff error"
+        assert e.amount == cents(e.amount) / 100, "roundoff error"
         if Tag.U.value in e.tags:
             assert e.tref is None, "tref in unpaired entry"
         else:
@@ -862,3 +2010,6 @@ class DB:
             trans.description += note
         trans.save()
 
+# Listeners have to be registered before clients are created
+
+monitoring.register(DB.monitor)
@@ -0,0 +1,137 @@
+#
+# Query result cache
+#
+# Results of DB methods marked with the @cached decorator are saved in an
+# LRU cache, keyed by the name of the method and a normalized copy of its
+# arguments.  Each result is tagged with the collections it was computed
+# from, and methods that write to the database invalidate the results for
+# the collections they change.
+#
+
+from collections import OrderedDict
+from datetime import date
+from enum import Enum
+import logging
+
+def normalize(x):
+    '''
+    Return a hashable version of a method argument:  lists and tuples become
+    tuples, dictionaries become sorted tuples of pairs, sets become frozensets,
+    datetimes are reduced to dates, and classes are replaced by their names.
+    Raises TypeError if an argument can't be used in a key.
+    '''
+    match x:
+        case dict():
+            return tuple(sorted((k, normalize(v)) for k, v in x.items()))
+        case list() | tuple():
+            return tuple(normalize(v) for v in x)
+        case set() | frozenset():
+            return frozenset(normalize(v) for v in x)
+        case type():
+            return x.__name__
+        case Enum():
+            return x.value
+        case date():
+            return x if type(x) is date else date(x.year, x.month, x.day)
+        case _:
+            hash(x)
+            return x
+
+class ResultCache:
+    '''
+    A size-bounded cache of query results.  When the cache is full the least
+    recently used result is evicted.  A cache with size 0 is disabled.
+
+    The hits and misses attributes count lookups, evictions counts results
+    dropped to make room, and invalidations counts results dropped because
+    a collection they depend on was written.
+    '''
+
+    def __init__(self, size=0):
+        '''
+        Arguments:
+            size:  the maximum number of results to keep
+        '''
+        self.size = size
+        self._results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+    @staticmethod
+    def key(name, args, kwargs):
+        '''
+        Make a cache key from a method name and its arguments.  Returns None
+        if an argument is not hashable.
+        '''
+        try:
+            return (name, normalize(args), normalize(kwargs))
+        except TypeError:
+            return None
+
+    def lookup(self, key):
+        '''
+        Return a tuple with a Boolean that is True if a key is in the cache and
+        the saved result (None if the key is not found).  A result that is found
+        becomes the most recently used one.
+        '''
+        if key in self._results:
+            self.hits += 1
+            self._results.move_to_end(key)
+            return True, self._results[key][1]
+        self.misses += 1
+        return False, None
+
+    def save(self, key, result, depends):
+        '''
+        Save a result, evicting the least recently used ones if the cache
+        is full.
+
+        Arguments:
+            key:  the key made by ResultCache.key
+            result:  the value to save
+            depends:  names of the collections the result was computed from
+        '''
+        self._results[key] = (frozenset(depends), result)
+        self._results.move_to_end(key)
+        while len(self._results) > self.size:
+            self._results.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, *collections):
+        '''
+        Discard the results that depend on any of the collections, or every
+        result if no collections are specified.
+        '''
+        if not self._results:
+            return
+        if collections:
+            names = set(collections)
+            stale = [k for k, (depends, _) in self._results.items() if depends & names]
+        else:
+            stale = list(self._results)
+        for k in stale:
+            del self._results[k]
+        self.invalidations += len(stale)
+        if stale:
+            logging.debug(f'ResultCache: invalidated {len(stale)} results for {collections or "all collections"}')
@@ -5,6 +5,7 @@
 # variable that can be imported by other modules.
 #
 
+import ast
 from collections import namedtuple
 from enum import Enum
 import logging
@@ -60,12 +61,18 @@ class Config:
     class DB:
         name = 'dexter'
         start_date = parse_date('1970-01-01')
+        compact_uids = False
+        registry = '~/.cache/dexter/databases'
+        backend = 'mongodb'
+        path = '{name}.sqlite'
+        cache_size = 0
 
     class Budget:
         specs = None
 
     class CSV:
         colmaps = { }
+        specs = { }
         fullname = { }
 
     class Select:
@@ -148,11 +155,67 @@ def compile_specs(fmt, specs):
     Python functions that can be called by the parser.
     '''
     Config.CSV.colmaps[fmt] = { }
+    Config.CSV.specs[fmt] = dict(specs)
     for field, expr in specs.items():
         e = f'lambda rec: {expr}'
         f = eval(e, locals={}, globals={})
         Config.CSV.colmaps[fmt][field] = f
 
+# Fields in the tuples made by the functions returned by compile_extractor
+
+EXTRACTED_FIELDS = ['date', 'description', 'amount', 'credit', 'payment']
+
+class ColumnIndexer(ast.NodeTransformer):
+    '''
+    Replace references to columns by name (rec["Amount"]) with references
+    by position (row[3]).
+    '''
+
+    def __init__(self, fmt, index):
+        self.fmt = fmt
+        self.index = index
+
+    def visit_Subscript(self, node):
+        self.generic_visit(node)
+        key = node.slice
+        if isinstance(node.value, ast.Name) and node.value.id == 'rec' and isinstance(key, ast.Constant) and isinstance(key.value, str):
+            if key.value not in self.index:
+                raise ValueError(f'colmap {self.fmt}: no column named {key.value!r} in CSV header')
+            return ast.Subscript(ast.Name('row', ast.Load()), ast.Constant(self.index[key.value]), ast.Load())
+        return node
+
+def compile_extractor(fmt, header, card=False):
+    '''
+    Combine the column mapping specs for a CSV format into a single function
+    for a file with a given header line.  The function is called with a row
+    of the file (a list of strings) and returns a tuple with the values of the
+    fields in EXTRACTED_FIELDS.  Column names in the specs are replaced by
+    column numbers, so rows don't have to be converted to dictionaries.  If
+    a spec uses rec in some other way (e.g. rec.get) the function makes a
+    dictionary for each row.
+
+    Arguments:
+        fmt:  the name of the format (a [csv.*] section in the config file)
+        header:  the list of column names in the first line of the file
+        card:  if False the payment spec is not used (the value is always False)
+    '''
+    specs = Config.CSV.specs[fmt]
+    index = {name: i for i, name in enumerate(header)}
+    exprs = []
+    for field in EXTRACTED_FIELDS:
+        if field == 'payment' and not card:
+            exprs.append('False')
+            continue
+        if field not in specs:
+            raise ValueError(f'colmap {fmt}: no spec for {field}')
+        tree = ColumnIndexer(fmt, index).visit(ast.parse(specs[field], mode='eval'))
+        exprs.append(ast.unparse(tree))
+    body = f'({", ".join(exprs)},)'
+    if any(isinstance(node, ast.Name) and node.id == 'rec' for e in exprs for node in ast.walk(ast.parse(e, mode='eval'))):
+        body = f'(lambda rec: {body})(dict(zip(header, row)))'
+    logging.debug(f'Config: extractor for {fmt}: {body}')
+    return eval(f'lambda row: {body}', {'header': header})
+
 def add_attributes(cls, specs):
     '''
     Helper method for initialize_config.  Iterate over a section of the
@@ -240,6 +240,47 @@ def print_info_table(dct):
     print()
     console.print(tbl)
     
+def print_index_table(lst):
+    tbl = Table(
+        TableColumn(header='collection', width=12),
+        TableColumn(header='index', width=30),
+        TableColumn(header='keys', width=30),
+        TableColumn(header='size', justify='right'),
+        title='Indexes',
+        title_justify='left',
+        title_style='table_header',
+    )
+    for collection, name, keys, size in lst:
+        tbl.add_row(collection, name, ', '.join(keys), f'{size:,}')
+    print()
+    console.print(tbl)
+    
+def print_explain_table(lst):
+    '''
+    Print the query plans collected by the --explain option.  The argument is
+    the list of (query, plan) pairs returned by DB.explain.
+    '''
+    tbl = Table(
+        TableColumn(header='collection', width=12),
+        TableColumn(header='operation', width=10),
+        TableColumn(header='condition', width=40, overflow='ellipsis', no_wrap=True),
+        TableColumn(header='index', width=24),
+        TableColumn(header='examined', justify='right'),
+        TableColumn(header='returned', justify='right'),
+        TableColumn(header='ms', justify='right'),
+        title='Queries',
+        title_justify='left',
+        title_style='table_header',
+    )
+    for q, plan in lst:
+        examined = '' if plan['examined'] is None else f'{plan["examined"]:,}'
+        tbl.add_row(
+            q.collection, q.operation, escape(str(q.condition)), plan['index'],
+            examined, f'{plan["returned"]:,}', f'{q.elapsed / 1000:.1f}',
+        )
+    print()
+    console.print(tbl)
+
 def print_grid(recs: list, name: str = None, count: int = 0):
     if name:
         title = f'[bold blue]{name}'
@@ -0,0 +1,349 @@
+#
+# In-memory directory of account names
+#
+
+import logging
+import re
+
+class AccountNode:
+    '''
+    A node in the account hierarchy.  The path is the full name of the node
+    (the parts from the root down to this node, separated by colons) and
+    account is the Account object with that name, or None for an interior
+    node that is not defined as an account (e.g. "liabilities:chase" when
+    only "liabilities:chase:visa" is defined).  The order attribute is the
+    position of the account in the collection, used to return results in
+    the same order as a query.
+    '''
+
+    def __init__(self, part, parent=None):
+        self.part = part
+        self.parent = parent
+        self.path = f'{parent.path}:{part}' if parent and parent.path else part
+        self.depth = parent.depth + 1 if parent else 0
+        self.account = None
+        self.order = None
+        self.children = {}
+
+    def __repr__(self):
+        return f'<AccountNode {self.path}>'
+
+    def walk(self, depth=None):
+        '''
+        Generate this node and the nodes below it, in preorder, optionally
+        stopping at a given number of levels below this node.
+        '''
+        yield self
+        if depth is None or depth > 0:
+            for child in self.children.values():
+                yield from child.walk(None if depth is None else depth-1)
+
+    def accounts(self):
+        '''
+        Return a list of Account objects for this node and every node below it.
+        '''
+        return [n.account for n in self.walk() if n.account]
+
+class AccountDirectory:
+    '''
+    An in-memory copy of the Account collection.  The directory is loaded
+    (with a single query) the first time it is used after being created or
+    invalidated.  It has dictionaries that map full names, abbreviations,
+    and name parts to Account objects so the DB API can look up names
+    without querying the database.
+
+    The hits and misses attributes count the lookups answered from memory
+    and the lookups that had to (re)load the directory, i.e. the number of
+    queries made for Account documents.
+    '''
+
+    def __init__(self, loader):
+        '''
+        Initialize an empty directory.
+
+        Arguments:
+            loader:  a function that returns an iterable of Account objects
+        '''
+        self._loader = loader
+        self._accounts = None
+        self._abbrevs = None
+        self._parts = None
+        self._root = None
+        self._nodes = None
+        self._names = None
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        '''
+        Discard the current contents so the directory will be reloaded
+        the next time it is used.  Called when an Account is saved or
+        deleted and when a new database is opened.
+        '''
+        logging.debug('AccountDirectory: invalidated')
+        self._accounts = None
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _fetch(self):
+        '''
+        Make sure the directory is loaded, updating the hit and miss counters.
+        '''
+        if self._accounts is None:
+            self.misses += 1
+            self._load()
+        else:
+            self.hits += 1
+
+    def _load(self):
+        '''
+        Fetch all the Account objects, build the dictionaries.
+        '''
+        logging.debug('AccountDirectory: loading accounts')
+        self._accounts = {}
+        self._abbrevs = {}
+        self._parts = {}
+        self._root = AccountNode('')
+        self._nodes = {}
+        self._names = {}
+        for acct in self._loader():
+            self._accounts[acct.name] = acct
+            if acct.abbrev:
+                self._abbrevs.setdefault(acct.abbrev, acct)
+            for p in acct.name.split(':'):
+                self._parts.setdefault(p, []).append(acct)
+            self._insert(acct)
+
+    def _insert(self, acct):
+        '''
+        Add the nodes for an account name to the tree.  Every node is also
+        added to the _nodes dictionary, which maps a name part (in lower case)
+        to the list of nodes with that part.
+        '''
+        node = self._root
+        for p in acct.name.split(':'):
+            if (child := node.children.get(p)) is None:
+                child = node.children[p] = AccountNode(p, node)
+                self._nodes.setdefault(p.lower(), []).append(child)
+            node = child
+        node.account = acct
+        node.order = len(self._accounts) - 1
+
+    def get(self, name):
+        '''
+        Return the Account object with a full name, or None if
+        there is no account with that name.
+        '''
+        self._fetch()
+        return self._accounts.get(name)
+
+    def fullname(self, s):
+        '''
+        Return the full name for a string that is either a full account
+        name or an abbreviation, or None if s is not defined.
+        '''
+        self._fetch()
+        if acct := self._accounts.get(s) or self._abbrevs.get(s):
+            return acct.name
+        return None
+
+    def abbrev(self, name):
+        '''
+        Return the abbreviation of an account, or the full name if the account
+        does not have an abbreviation, or None if the account is not defined.
+        '''
+        self._fetch()
+        if acct := self._accounts.get(name):
+            return acct.abbrev or name
+        return None
+
+    def accounts(self, category=None):
+        '''
+        Return a list of all Account objects, optionally restricted to
+        a single category.
+        '''
+        self._fetch()
+        return [a for a in self._accounts.values() if category is None or a.category == category]
+
+    def find(self, s):
+        '''
+        Return a list of Account objects with names that contain a string.
+        '''
+        self._fetch()
+        return [a for name, a in self._accounts.items() if s in name]
+
+    def name_parts(self, category=None):
+        '''
+        Return the set of strings that appear as part of an account name.
+        '''
+        self._fetch()
+        if category is None:
+            return set(self._parts)
+        return {p for p, lst in self._parts.items() if any(a.category == category for a in lst)}
+
+    def names(self, category=None, with_parts=True):
+        '''
+        Return a dictionary that maps full names, abbreviations, and (optionally)
+        name parts to sets of full account names.  See DB.account_names.
+        The dictionary is built once for each combination of arguments and
+        shared by all callers, so it should not be modified.
+        '''
+        self._fetch()
+        key = (category, with_parts)
+        if (dct := self._names.get(key)) is None:
+            dct = self._names[key] = self._make_names(category, with_parts)
+        return dct
+
+    def _make_names(self, category, with_parts):
+        dct = {}
+        for acct in self.accounts(category):
+            dct[acct.name] = { acct.name }
+            if acct.abbrev:
+                dct[acct.abbrev] = { acct.name }
+            if with_parts:
+                for p in acct.name.split(':'):
+                    grp = dct.setdefault(p, set())
+                    grp.add(acct.name)
+        return dct
+
+    def node(self, name):
+        '''
+        Return the AccountNode for a full name (which can be an interior
+        node), or None if the name is not in the tree.
+        '''
+        self._fetch()
+        node = self._root
+        for p in name.split(':'):
+            if (node := node.children.get(p)) is None:
+                return None
+        return node
+
+    def find_nodes(self, s, partial=False):
+        '''
+        Return a list of nodes with paths that end with a string, which can
+        be a single name part ("car") or several ("expenses:car").  The
+        comparison ignores case.
+
+        Arguments:
+            s:  the string to look for
+            partial:  if True, also return the nodes where s ends in the
+                middle of a name, i.e. the first part of s can be the end of
+                a name part and the last part of s can be the start of one
+                (or anywhere in a name part if s has only one part)
+        '''
+        self._fetch()
+        *parts, last = s.lower().split(':')
+        if not partial:
+            candidates = self._nodes.get(last, [])
+        elif parts:
+            candidates = [n for p, lst in self._nodes.items() if p.startswith(last) for n in lst]
+        else:
+            candidates = [n for p, lst in self._nodes.items() if last in p for n in lst]
+        res = []
+        for node in candidates:
+            n = node
+            for i, p in enumerate(reversed(parts)):
+                n = n.parent
+                if n is None or n.parent is None:
+                    break
+                part = n.part.lower()
+                if not (part == p or (partial and i == len(parts)-1 and part.endswith(p))):
+                    break
+            else:
+                res.append(node)
+        return res
+
+    def expand(self, s, level):
+        '''
+        Return a list of patterns for the accounts below the nodes that
+        match s, down to the specified level (see DB.expand_node).  The
+        results are the same as a regular expression search of the Account
+        collection:  s is a case-insensitive pattern that can match anywhere
+        in a name, and the level is counted from the end of the match.  Only
+        account names are returned.  Accounts above the level have a '$' so
+        the pattern matches only that account, and accounts at the level
+        match that account and everything below it.
+
+        When s is a plain string the matching nodes are found in the tree
+        and only their subtrees are visited.  If there is more than one match
+        in a name the first one is used, so a node below another match is
+        skipped.  A pattern with regular expression metacharacters is
+        compared to every account name.
+        '''
+        self._fetch()
+        if re.escape(s) != s:
+            return self._expand_regexp(s, level)
+        nodes = self.find_nodes(s, partial=True)
+        matched = set(nodes)
+        res = []
+        for node in nodes:
+            n = node.parent
+            while n is not None and n not in matched:
+                n = n.parent
+            if n is not None:
+                continue
+            for n in node.walk(level):
+                if n.account is None:
+                    continue
+                name = n.path + '$' if n.depth - node.depth < level else n.path
+                res.append((n.order, name))
+        return [name for _, name in sorted(res)]
+
+    def _expand_regexp(self, s, level):
+        expr = re.compile(s, re.I)
+        res = []
+        for name in self._accounts:
+            if (m := expr.search(name)) is None:
+                continue
+            depth = name[m.end():].count(':')
+            if depth < level:
+                res.append(name + '$')
+            elif depth == level:
+                res.append(name)
+        return res
+
+    def complete(self, prefix):
+        '''
+        Return a sorted list of full account names that start with a string.
+        Complete name parts in the prefix are followed down the tree, so only
+        the subtrees that can match are visited.
+        '''
+        self._fetch()
+        *parts, last = prefix.split(':')
+        node = self._root
+        for p in parts:
+            if (node := node.children.get(p)) is None:
+                return []
+        res = []
+        for p, child in node.children.items():
+            if p.startswith(last):
+                res += [a.name for a in child.accounts()]
+        return sorted(res)
+
+    def subtree(self, name):
+        '''
+        Return a list of Account objects for a node and all the nodes below it.
+        '''
+        node = self.node(name)
+        return node.accounts() if node else []
+
+    def rollup(self, totals):
+        '''
+        Add up values for accounts at every level of the tree.  Returns a
+        dictionary that maps the path of every node (including interior
+        nodes) to the sum of the values of the accounts in its subtree.
+
+        Arguments:
+            totals:  a dictionary that maps full account names to numbers
+        '''
+        self._fetch()
+        res = {}
+        def visit(node):
+            t = totals.get(node.path, 0) + sum(visit(child) for child in node.children.values())
+            res[node.path] = t
+            return t
+        for child in self._root.children.values():
+            visit(child)
+        return res
@@ -8,6 +8,7 @@ import tomllib
 from .DB import DB, Transaction, Entry, Column, Tag
 from .config import Config
 from .console import console, print_journal_transactions, print_csv_transactions
+from .util import Amount, cents
 
 def fill(args):
     '''
@@ -89,13 +90,13 @@ def budget_transaction(date, dct):
     trans = Transaction(
         description = 'fill envelopes',
     )
-    available = sum(t.pamount for t in deposits)
+    available = Amount.from_cents(sum(cents(t.pamount) for t in deposits))
     logging.debug(f'fill: available to distribute: {available}')
     add_debits(trans, deposits, date)
     dist = add_credits(trans, dct['allocation'], date, available)
     logging.debug(f'fill: distributed {dist}')
     if available > dist:
-        rem = round(available-dist,2)
+        rem = Amount.from_cents(cents(available) - cents(dist))
         logging.debug(f'fill: remainder {rem}')
         spec = [{ 'category': dct['remainder'], 'amount': rem}]
         add_credits(trans, spec, date, available)
@@ -145,8 +146,8 @@ def add_credits(trans, lst, date, avail):
     '''
     alloc = 0
     for rec in lst:
-        if alloc + rec['amount'] > avail:
-            console.print(f'[red]fill: allocation {rec} exceeds available {avail-alloc}, skipped')
+        if alloc + cents(rec['amount']) > cents(avail):
+            console.print(f'[red]fill: allocation {rec} exceeds available {Amount.from_cents(cents(avail) - alloc)}, skipped')
             continue
         credit = DB.fullname(rec['category'])
         if credit is None:
@@ -161,6 +162,6 @@ def add_credits(trans, lst, date, avail):
             tags = [Tag.B.value],
         )
         trans.entries.append(e)
-        alloc += rec['amount']
+        alloc += cents(rec['amount'])
         logging.debug(f'fill: credit: {e}')
-    return alloc
+    return Amount.from_cents(alloc)
@@ -0,0 +1,138 @@
+#
+# Columnar snapshot of the Entry collection
+#
+# A Frame holds the fields of a set of entries in NumPy arrays, one array
+# per field, so analysis over large numbers of entries can be done with
+# vectorized operations instead of Python loops over Entry objects.
+#
+# NumPy is an optional dependency (pip install dexter[analytics]), and this
+# module is imported only when DB.frame is called.
+#
+
+import numpy as np
+
+from .util import cents
+
+DEBIT = 'debit'
+CREDIT = 'credit'
+
+class Frame:
+    '''
+    Entries stored in parallel arrays:
+
+        date:     datetime64[D]
+        amount:   int64, amount in cents (always positive)
+        account:  int32, an index into the accounts list
+        column:   int8, an index into the columns list
+        tags:     uint64, bit i is set if the entry has tag i in the tag_names list
+
+    '''
+
+    columns = [DEBIT, CREDIT]
+
+    def __init__(self, date, amount, account, column, tags, accounts, tag_names):
+        self.date = date
+        self.amount = amount
+        self.account = account
+        self.column = column
+        self.tags = tags
+        self.accounts = accounts
+        self.tag_names = tag_names
+
+    def __len__(self):
+        return len(self.date)
+
+    def __repr__(self):
+        return f'<Frame {len(self)} entries, {len(self.accounts)} accounts>'
+
+    @staticmethod
+    def from_records(docs):
+        '''
+        Build a frame from an iterable of raw Entry documents (dictionaries
+        with date, amount, account, column, and tags).  Account names and
+        tags are given codes in the order they are first seen.
+        '''
+        dates, amounts, accounts, columns, tags = [], [], [], [], []
+        account_codes = {}
+        tag_bits = {}
+        for doc in docs:
+            dates.append(doc['date'])
+            amt = doc['amount']
+            amounts.append(amt if isinstance(amt, int) else cents(amt))
+            accounts.append(account_codes.setdefault(doc['account'], len(account_codes)))
+            columns.append(0 if doc['column'] == DEBIT else 1)
+            mask = 0
+            for t in doc.get('tags', []):
+                if (bit := tag_bits.get(t)) is None:
+                    if len(tag_bits) == 64:
+                        raise ValueError('DB.frame: more than 64 different tags')
+                    bit = tag_bits[t] = len(tag_bits)
+                mask |= 1 << bit
+            tags.append(mask)
+        return Frame(
+            np.array(dates, dtype='datetime64[D]'),
+            np.array(amounts, dtype=np.int64),
+            np.array(accounts, dtype=np.int32),
+            np.array(columns, dtype=np.int8),
+            np.array(tags, dtype=np.uint64),
+            list(account_codes),
+            list(tag_bits),
+        )
+
+    def subset(self, mask):
+        '''
+        Return a new frame with the rows selected by a boolean array.  The
+        new frame shares the account and tag lists.
+        '''
+        return Frame(
+            self.date[mask], self.amount[mask], self.account[mask], self.column[mask], self.tags[mask],
+            self.accounts, self.tag_names,
+        )
+
+    @property
+    def value(self):
+        '''
+        Amounts in cents with the sign used in balances:  debits are positive
+        and credits are negative.
+        '''
+        return np.where(self.column == 0, self.amount, -self.amount)
+
+    def has_tag(self, tag):
+        '''
+        Return a boolean array that is True for entries with a tag.
+        '''
+        if tag not in self.tag_names:
+            return np.zeros(len(self), dtype=bool)
+        bit = np.uint64(1 << self.tag_names.index(tag))
+        return (self.tags & bit) != 0
+
+    def by_account(self, values=None):
+        '''
+        Add up values (by default the signed amounts) for each account.  Returns
+        a dictionary that maps account names to totals in cents.
+        '''
+        values = self.value if values is None else values
+        totals = np.zeros(len(self.accounts), dtype=np.int64)
+        np.add.at(totals, self.account, values)
+        return {name: int(totals[i]) for i, name in enumerate(self.accounts)}
+
+    def by_period(self, unit='M', values=None):
+        '''
+        Add up values (by default the signed amounts) for each period.  Returns
+        an array of periods (datetime64 with the specified unit, e.g. 'M' for
+        months or 'Y' for years) in order and an array of totals in cents.
+        '''
+        values = self.value if values is None else values
+        periods, index = np.unique(self.date.astype(f'datetime64[{unit}]'), return_inverse=True)
+        totals = np.zeros(len(periods), dtype=np.int64)
+        np.add.at(totals, index, values)
+        return periods, totals
+
+    def running_balance(self, values=None):
+        '''
+        Sort the entries by date and compute the balance after each one.
+        Returns the array of dates and the array of balances in cents.
+        '''
+        values = self.value if values is None else values
+        order = np.argsort(self.date, kind='stable')
+        return self.date[order], np.cumsum(values[order])
@@ -7,7 +7,9 @@
 # and miscellaneous helper functions are at the end.
 #
 
+from concurrent.futures import ProcessPoolExecutor
 import csv
+from itertools import batched
 import logging
 import os
 from pathlib import Path
@@ -15,10 +17,10 @@ from pathlib import Path
 from pypdf import PdfReader
 
 from .DB import DB, Account, Entry, Transaction, RegExp, Tag
-from .config import Config
-from .console import print_records, print_grid, print_info_table
+from .config import Config, initialize_config, compile_extractor
+from .console import print_records, print_grid, print_info_table, print_index_table
 from .journal import JournalParser
-from .util import parse_date
+from .util import DateParser
 
 #######################
 #
@@ -39,6 +41,82 @@ def print_info(args):
     recs = DB.info()
     print_info_table(recs)
 
+#######################
+#
+# Top level method for index command
+#
+#######################
+
+def manage_indexes(args):
+    '''
+    The top level function, called from main when the command is "index".
+    Creates or rebuilds the indexes declared in the database schema, then
+    prints a table with the current indexes and their sizes.
+
+    Arguments:
+        args: Namespace object with command line arguments.
+    '''
+    open_db(args)
+
+    if args.create or args.rebuild:
+        if args.preview:
+            for collection, lst in DB.missing_indexes().items():
+                for keys in lst:
+                    print(f'{collection}: {keys}')
+            return
+        if args.rebuild:
+            logging.info('index: rebuilding indexes')
+            DB.rebuild_indexes()
+        else:
+            logging.info('index: creating indexes')
+            DB.create_indexes()
+
+    print_index_table(DB.index_info())
+
+def manage_snapshots(args):
+    '''
+    The top level function, called from main when the command is "snapshot".
+    Rebuilds the monthly balance snapshots from the entries in the database,
+    then prints the number of snapshots.
+
+    Arguments:
+        args: Namespace object with command line arguments.
+    '''
+    open_db(args)
+    DB.require_mongodb('snapshot')
+
+    if args.rebuild and not args.preview:
+        logging.info('snapshot: rebuilding monthly balances')
+        DB.rebuild_snapshots()
+
+    print(f'{DB.snapshots.count()} monthly balance snapshots')
+
+def upgrade_database(args):
+    '''
+    The top level function, called from main when the command is "upgrade".
+    Converts a database with an older schema to the current schema and
+    prints the number of values changed in each field.  In preview mode
+    the values are counted but not changed.
+
+    Arguments:
+        args: Namespace object with command line arguments.
+    '''
+    if Config.DB.backend == 'sqlite':
+        print('upgrade: SQLite databases do not need to be upgraded')
+        return
+    open_db(args, upgrade=True)
+
+    schema = DB.schema()
+    if schema >= DB.SCHEMA:
+        print(f'upgrade: {DB.dbname} already has schema {DB.SCHEMA}')
+        return
+    counts = DB.upgrade(args.preview)
+    verb = 'would convert' if args.preview else 'converted'
+    for field, n in counts.items():
+        print(f'upgrade: {verb} {n} values in {field}')
+    if not args.preview:
+        print(f'upgrade: {DB.dbname} upgraded from schema {schema} to {DB.SCHEMA}')
+
 #######################
 #
 # Top level method for init command
@@ -117,34 +195,39 @@ def import_records(args):
             DB.delete_regexps()
     else:
         anames = set(DB.account_names(with_parts=False).keys())
+        uids = DB.uids()
         recs = []
+        saved = 0
+        tasks = []
         for path in paths:
             logging.debug(f'arg: {path}')
             match path.suffix:
                 case '.journal':
-                    _, new_recs = parse_journal(path, anames, DB.uids())
+                    _, new_recs = parse_journal(path, anames, uids)
                 case '.csv' | '.CSV':
-                    # if args.account:
-                    #     alist = DB.
-                    basename = args.account or path.stem
-                    alist = DB.find_account(basename)
-                    logging.debug(f'alist: {alist}')
-                    if len(alist) == 0:
-                        logging.error(f'import: no account name matches {basename}')
-                        continue
-                    if len(alist) > 1:
-                        logging.error(f'import: ambiguous account name {basename}')
+                    if (spec := csv_account(path, args.account)) is None:
                         continue
-                    account = alist[0].name
-                    parser = alist[0].parser
-                    if parser not in Config.CSV.colmaps.keys():
-                        logging.error(f'import: no parser for {account}')
+                    account, parser = spec
+                    if args.jobs > 1:
+                        tasks.append((path, parser, account))
                         continue
-                    new_recs = parse_csv_transactions(path, parser, account, args.start_date, args.end_date, DB.uids())
+                    new_recs = iter_csv_transactions(path, parser, account, args.start_date, args.end_date, uids)
                 case _:
                     logging.error(f'import: unknown file type: {path.suffix}')
                     new_recs = []
-            recs += new_recs
+            if args.preview:
+                recs += new_recs
+            else:
+                saved += save_batches(new_recs)
+        if tasks:
+            new_recs = parallel_csv_transactions(tasks, args, uids)
+            if args.preview:
+                recs += new_recs
+            else:
+                saved += save_batches(new_recs)
+        if not args.preview:
+            logging.info(f'import: {saved} new records')
+            return
 
     if args.preview:
         print_records(recs)
@@ -187,7 +270,8 @@ def save_records(args):
     logging.debug(f'save {vars(args)}')
 
     open_db(args)
-    
+    DB.require_mongodb('save')
+
     try:
         mode = 'w' if args.force else 'x'
         f = open(args.file, mode)
@@ -214,6 +298,7 @@ def restore_records(args):
         args: Namespace object with command line arguments.
     '''
     logging.debug(f'restore {vars(args)}')
+    DB.require_mongodb('restore')
 
     get_names_and_create_db(args)
 
@@ -221,17 +306,11 @@ def restore_records(args):
     DB.erase_database()
 
     with open(args.file) as f:
-        for line in f:
-            try:
-                sep = line.find(':')
-                collection = line[:sep]
-                doc = line[sep+1:].strip()
-                if args.preview:
-                    print(doc)
-                else:
-                    DB.restore_from_json(collection, doc)
-            except Exception as err:
-                logging.error(err)
+        if args.preview:
+            for line in f:
+                print(line[line.find(':')+1:].strip())
+        else:
+            DB.restore_from_file(f)
 
 
 #######################
@@ -241,6 +320,40 @@ def restore_records(args):
 #######################
 
 
+def save_batches(recs):
+    '''
+    Helper function for import_records.  Save records in batches of
+    DB.BATCH_SIZE, return the number of records.
+    '''
+    n = 0
+    for batch in batched(recs, DB.BATCH_SIZE):
+        DB.save_records(batch)
+        n += len(batch)
+    return n
+
+def csv_account(path, name=None):
+    '''
+    Helper function for import_records.  Find the account for a CSV file,
+    using the name from the command line or the file name.  Returns a tuple
+    with the full account name and the name of its parser, or None if there is
+    no unique account or the account has no parser.
+    '''
+    basename = name or path.stem
+    alist = DB.find_account(basename)
+    logging.debug(f'alist: {alist}')
+    if len(alist) == 0:
+        logging.error(f'import: no account name matches {basename}')
+        return None
+    if len(alist) > 1:
+        logging.error(f'import: ambiguous account name {basename}')
+        return None
+    account = alist[0].name
+    parser = alist[0].parser
+    if parser not in Config.CSV.colmaps.keys():
+        logging.error(f'import: no parser for {account}')
+        return None
+    return account, parser
+
 def parse_journal(fn: Path, accounts: set, uids: set):
     '''
     Helper function for init and import commands.  Parses a Journal file,
@@ -322,42 +435,128 @@ def parse_csv_transactions(fn, pname, account, starting, ending, previous):
     Returns:
         a list of Entry objects
     '''
+    return list(iter_csv_transactions(fn, pname, account, starting, ending, previous))
+
+# The CSV import pipeline.  Each stage is a generator, so records are read,
+# converted, and filtered one at a time, and the caller can save them in
+# batches without keeping the whole file in memory.
+
+def iter_csv_transactions(fn, pname, account, starting, ending, previous, batch_size=None):
+    '''
+    Generate new Entry objects for the records in a CSV file (see
+    parse_csv_transactions).  UIDs are assigned in batches of batch_size
+    entries (the default is DB.BATCH_SIZE), and duplicates in later batches
+    are compared with entries from all the earlier batches in the file.
+    '''
     logging.info(f'importing transaction CSV, file: {fn} account: {account}')
-    res = []
-    cmap = Config.CSV.colmaps[pname]
-    logging.debug(f'  parser {pname} colmap {cmap}')
+    logging.debug(f'  parser {pname} colmap {Config.CSV.specs[pname]}')
     cards = { a.name for a in DB.card_accounts() }
     logging.debug(f'  credit card accounts: {cards}')
-    with(open(fn, newline='', encoding='utf-8-sig')) as csvfile:
-        reader = csv.DictReader(csvfile)
-        for rec in reader:
-            if list(rec.values()) == reader.fieldnames:
-                continue
-            rec_date = parse_date(cmap['date'](rec))
-            if starting and rec_date < starting:
-                continue
-            if ending and rec_date > ending:
-                continue
-            desc = {
-                'date': rec_date,
-                'description': cmap['description'](rec),
-                'amount': cmap['amount'](rec),
-                'column': 'credit' if cmap['credit'](rec) else 'debit',
-                'account': account,
-                'tags': [Tag.U.value],
-            }
-            if account in cards:
-                tag = Tag.Z.value if cmap['payment'](rec) else Tag.P.value
-                desc['tags'].append(tag)
-            e = Entry(**desc)
-            if e.hash in previous:
-                continue
-            res.append(e)
+    rows = read_csv_rows(fn)
+    entries = csv_entries(rows, pname, account, account in cards, starting, ending)
+    entries = (e for e in entries if e.hash not in previous)
+    hashes = set()
+    for batch in batched(entries, batch_size or DB.BATCH_SIZE):
+        DB.assign_uids(batch, hashes)
+        for e in batch:
             logging.debug(f'  new entry: {e}')
+            yield e
 
-    DB.assign_uids(res)
+def parallel_csv_transactions(tasks, args, previous):
+    '''
+    Parse CSV files in worker processes (import --jobs N).  Workers read their
+    own copy of the configuration, so they use the same column mappings as
+    this process.  Returns a single list of new entries from all the files,
+    in the order of the files on the command line:  entries already in the
+    database are skipped and UIDs are assigned with one set of hashes for
+    all the files, so an entry with the same UID as one in an earlier file
+    is numbered after it (see DB.assign_uids) and the result does not depend
+    on the order the workers finish.
+
+    Arguments:
+        tasks:  a list of (path, parser name, account name) tuples
+        args:  Namespace object with command line arguments
+        previous:  set of UIDs of entries in the database
+    '''
+    cards = { a.name for a in DB.card_accounts() }
+    res = []
+    hashes = set()
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=initialize_config, initargs=(args.config,)) as pool:
+        futures = [
+            pool.submit(parse_csv_file, path, parser, account, account in cards, args.start_date, args.end_date)
+            for path, parser, account in tasks
+        ]
+        for (path, _, account), future in zip(tasks, futures):
+            logging.info(f'importing transaction CSV, file: {path} account: {account}')
+            entries = [e for e in future.result() if e.uid not in previous]
+            DB.assign_uids(entries, hashes)
+            for e in entries:
+                logging.debug(f'  new entry: {e}')
+            res += entries
+    return res
+
+def parse_csv_file(fn, pname, account, card, starting, ending):
+    '''
+    Worker function for parallel_csv_transactions.  Returns a list of Entry
+    objects for the records in a CSV file, with each UID set to the entry's hash.
+    '''
+    res = []
+    for e in csv_entries(read_csv_rows(fn), pname, account, card, starting, ending):
+        e.uid = e.hash
+        res.append(e)
     return res
 
+def read_csv_rows(fn):
+    '''
+    Generate the rows in a CSV file as lists of strings.  The first row is
+    the header line.  Blank lines and copies of the header are skipped, and
+    short rows are padded with None.
+    '''
+    with(open(fn, newline='', encoding='utf-8-sig')) as csvfile:
+        reader = csv.reader(csvfile)
+        if (header := next(reader, None)) is None:
+            return
+        yield header
+        for row in reader:
+            if not row or row == header:
+                continue
+            if len(row) < len(header):
+                row += [None] * (len(header) - len(row))
+            yield row
+
+def csv_entries(rows, pname, account, card, starting, ending):
+    '''
+    Use a column mapping to make an Entry object for each CSV record with
+    a date between the starting and ending dates.  Entries for credit card
+    accounts (when card is True) are tagged as payments or purchases.  The
+    first row is the header, used to compile the column mapping into a
+    single function for the file (see config.compile_extractor).  The format
+    of the dates is detected from the first few rows (see util.DateParser).
+    '''
+    if (header := next(rows, None)) is None:
+        return
+    extract = compile_extractor(pname, header, card)
+    parse = DateParser()
+    for row in rows:
+        date, description, amount, credit, payment = extract(row)
+        rec_date = parse(date)
+        if starting and rec_date < starting:
+            continue
+        if ending and rec_date > ending:
+            continue
+        desc = {
+            'date': rec_date,
+            'description': description,
+            'amount': amount,
+            'column': 'credit' if credit else 'debit',
+            'account': account,
+            'tags': [Tag.U.value],
+        }
+        if card:
+            tag = Tag.Z.value if payment else Tag.P.value
+            desc['tags'].append(tag)
+        yield Entry(**desc)
+
 
 def get_names_and_create_db(args):
     '''
@@ -380,7 +579,7 @@ def get_names_and_create_db(args):
             raise ValueError(f'database {dbname} exists; use --force to replace it')
         DB.create(dbname)    
 
-def open_db(args):
+def open_db(args, upgrade=False):
     '''
     Helper function used by import and restore.  Gets database name,
     opens database.
@@ -388,7 +587,7 @@ def open_db(args):
     dbname = args.dbname or os.getenv('DEX_DB') or Config.DB.name
     if dbname is None:
         raise ValueError(f'specify a database name')
-    DB.open(dbname)
+    DB.open(dbname, upgrade)
 
 def make_balance_transaction(rec, lst):
     '''
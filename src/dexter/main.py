@@ -11,12 +11,12 @@ import sys
 from pymongo.errors import ServerSelectionTimeoutError
 
 from .config import Config, initialize_config, setup
-from .console import console
+from .console import console, print_explain_table
 from .DB import DB, Transaction, Entry
-from .util import setup_logging, parse_date, date_range
+from .util import setup_logging, parse_date, date_range, debugging
 
 from .fill import fill
-from .io import print_info, init_database, save_records, restore_records, import_records, export_records
+from .io import print_info, manage_indexes, manage_snapshots, upgrade_database, init_database, save_records, restore_records, import_records, export_records
 from .pair import pair_entries
 from .reconcile import reconcile_statements
 from .report import print_audit_report, print_balance_report
@@ -38,6 +38,8 @@ def init_cli():
     parser.add_argument('--log', metavar='X', choices=['quiet','info','debug'], default='info')
     parser.add_argument('--preview', action='store_true')
     parser.add_argument('--config', metavar='F', help='TOML file with configuration settings')
+    parser.add_argument('--explain', action='store_true', help='print plans and timings of database queries')
+    parser.add_argument('--stats', action='store_true', help='count database round trips and repeated queries')
     
     subparsers = parser.add_subparsers(title='subcommands', dest='command')
 
@@ -69,6 +71,21 @@ def init_cli():
     import_parser.add_argument('--month', metavar='M', choices=months, help='add records only for this month')
     import_parser.add_argument('--regexp', action='store_true', help='CSV files have regular expression definitions')
     import_parser.add_argument('--extract_text', action='store_true', help='print lines of text in a PDF file')
+    import_parser.add_argument('--jobs', metavar='N', type=int, default=1, help='parse CSV files in N worker processes')
+
+    index_parser = subparsers.add_parser('index', help='create or list database indexes')
+    index_parser.set_defaults(dispatch=manage_indexes)
+    actions = index_parser.add_mutually_exclusive_group()
+    actions.add_argument('--create', action='store_true', help='create missing indexes')
+    actions.add_argument('--rebuild', action='store_true', help='drop and recreate all indexes')
+    actions.add_argument('--list', action='store_true', help='list indexes and their sizes (default)')
+
+    snapshot_parser = subparsers.add_parser('snapshot', help='manage monthly balance snapshots')
+    snapshot_parser.set_defaults(dispatch=manage_snapshots)
+    snapshot_parser.add_argument('--rebuild', action='store_true', help='recompute snapshots from entries')
+
+    upgrade_parser = subparsers.add_parser('upgrade', help='convert a database to the current schema')
+    upgrade_parser.set_defaults(dispatch=upgrade_database)
 
     info_parser = subparsers.add_parser('info', help='print DB status')
     info_parser.set_defaults(dispatch=print_info)
@@ -131,6 +148,7 @@ def init_cli():
     select_parser.add_argument('--order_by', metavar='C', choices=orders, default='date', help='sort order')
     select_parser.add_argument('--total', action='store_true', help='show total amount of selected transactions')
     select_parser.add_argument('--unpaired', action='store_true', help='set --entry and --tag #unpaired')
+    select_parser.add_argument('--cascade', action='store_true', help='with --delete, also delete the transactions of deleted entries')
     actions = select_parser.add_mutually_exclusive_group()
     actions.add_argument('--update', metavar='F V', nargs=2, help='update fields')
     actions.add_argument('--delete', action='store_true', help='delete selected records')
@@ -183,7 +201,21 @@ def main():
     try:
         initialize_config(args.config)
         DB.init()
+        DB.monitor.capture = args.explain
+        DB.monitor.count = args.stats or debugging()
         args.dispatch(args)
+        if DB.monitor.count:
+            report = logging.info if args.stats else logging.debug
+            for line in DB.monitor.summary():
+                report(line)
+        if args.explain:
+            if DB.store:
+                logging.error('--explain requires the MongoDB backend')
+            else:
+                print_explain_table(DB.explain())
+        logging.debug(f'account directory: {DB.accounts.stats}')
+        if DB.results.enabled:
+            logging.debug(f'result cache: {DB.results.stats}')
     except ServerSelectionTimeoutError:
         logging.error("Can't connect to MongoDB server")
     except (ValueError, FileNotFoundError, ModuleNotFoundError) as err:
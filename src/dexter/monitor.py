@@ -0,0 +1,258 @@
+#
+# MongoDB command monitoring
+#
+# A pymongo CommandListener that records the queries sent to the server
+# (find, aggregate, count, and distinct commands) so they can be analyzed
+# with explain after a command finishes (the --explain option), and counts
+# every command by collection and call site to find code that makes a
+# round trip for each row of a result (the --stats option).
+#
+
+from collections import Counter
+import logging
+from pathlib import Path
+import sys
+
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+
+# Names of commands that read documents
+
+QUERIES = {'find', 'aggregate', 'count', 'distinct'}
+
+# Fields added to commands by the driver that can't be passed to explain
+
+DRIVER_FIELDS = {'lsid', 'txnNumber', 'cursor', 'batchSize', 'singleBatch'}
+
+# The part of a command that determines the shape of a query
+
+CONDITIONS = {
+    'find': 'filter', 'aggregate': 'pipeline', 'count': 'query', 'distinct': 'query',
+    'update': 'updates', 'delete': 'deletes', 'findAndModify': 'query',
+}
+
+# A query shape sent this many times from the same call site is reported
+# as a likely N+1 pattern
+
+REPEATS = 5
+
+# Modules skipped when looking for the code that sent a command
+
+LIBRARIES = ('pymongo', 'mongoengine', 'bson', __name__)
+
+class Query:
+    '''
+    A query sent to the server.  The elapsed time (in microseconds) and the
+    number of documents returned include any getMore commands used to read
+    the rest of the results.
+    '''
+
+    __slots__ = ('database', 'collection', 'operation', 'command', 'elapsed', 'returned')
+
+    def __init__(self, database, operation, command):
+        self.database = database
+        self.operation = operation
+        self.collection = command[operation]
+        self.command = {k: v for k, v in command.items() if not k.startswith('$') and k not in DRIVER_FIELDS}
+        if operation == 'aggregate':
+            self.command['cursor'] = {}
+        self.elapsed = 0
+        self.returned = 0
+
+    def __repr__(self):
+        return f'<Query {self.operation} {self.collection} {self.condition}>'
+
+    @property
+    def condition(self):
+        '''
+        The part of the command that selects documents:  the filter for find,
+        the pipeline for aggregate, or the query for count and distinct.
+        '''
+        if self.operation == 'find':
+            return self.command.get('filter', {})
+        if self.operation == 'aggregate':
+            return self.command.get('pipeline', [])
+        return self.command.get('query', {})
+
+    @property
+    def writes(self):
+        '''
+        True if the query is an aggregation that writes its output to a collection.
+        '''
+        return self.operation == 'aggregate' and any('$out' in s or '$merge' in s for s in self.command['pipeline'])
+
+def shape(x):
+    '''
+    Replace the values in a query condition by the names of their types, so
+    queries that differ only in their values (e.g. a find by _id for each
+    object in a list) have the same shape.
+    '''
+    match x:
+        case dict():
+            return {k: shape(v) for k, v in x.items()}
+        case list() | tuple():
+            return sorted({repr(shape(v)) for v in x})
+        case _:
+            return type(x).__name__
+
+def call_site():
+    '''
+    Return a description (file, line, and function name) of the innermost
+    frame on the stack that is not in the database drivers or this module.
+    '''
+    frame = sys._getframe(2)
+    while frame:
+        if not frame.f_globals.get('__name__', '').startswith(LIBRARIES):
+            return f'{Path(frame.f_code.co_filename).name}:{frame.f_lineno} ({frame.f_code.co_name})'
+        frame = frame.f_back
+    return '-'
+
+class CommandMonitor(monitoring.CommandListener):
+    '''
+    Record the queries sent to MongoDB while the capture attribute is True,
+    and count the commands sent while the count attribute is True.
+
+    The commands counter maps (command name, collection, call site) to the
+    number of commands, and the shapes counter maps (command name, collection,
+    call site, query shape) to the number of times a query with that shape
+    was sent from that call site.
+    '''
+
+    def __init__(self):
+        self.capture = False
+        self.count = False
+        self.queries = []
+        self.commands = Counter()
+        self.shapes = Counter()
+        self._pending = {}
+        self._cursors = {}
+
+    def reset(self):
+        self.queries = []
+        self.commands = Counter()
+        self.shapes = Counter()
+        self._pending = {}
+        self._cursors = {}
+
+    @property
+    def round_trips(self):
+        return self.commands.total()
+
+    def repeated(self, threshold=REPEATS):
+        '''
+        Return a list of query shapes sent at least threshold times from
+        the same call site (likely N+1 patterns), most frequent first.  Each
+        item is a tuple with the number of times, the command name, the
+        collection, the call site, and the shape.
+        '''
+        return [(n, *key) for key, n in self.shapes.most_common() if n >= threshold]
+
+    def summary(self, threshold=REPEATS):
+        '''
+        Return a list of lines that describe the commands counted since the
+        last reset, grouped by collection and call site, followed by
+        warnings about repeated queries.
+        '''
+        lines = [f'{self.round_trips} MongoDB round trips']
+        for (name, collection, site), n in self.commands.most_common():
+            lines.append(f'  {n:5d} {name} {collection} from {site}')
+        for n, name, collection, site, condition in self.repeated(threshold):
+            lines.append(f'possible N+1:  {n} {name} {collection} {condition} from {site}')
+        return lines
+
+    def started(self, event):
+        if self.count:
+            self.tally(event)
+        if not self.capture:
+            return
+        if event.command_name in QUERIES:
+            q = Query(event.database_name, event.command_name, event.command)
+            self.queries.append(q)
+            self._pending[event.request_id] = q
+        elif event.command_name == 'getMore' and (q := self._cursors.get(event.command['getMore'])):
+            self._pending[event.request_id] = q
+
+    def tally(self, event):
+        '''
+        Count a command, using the call site and query shape as keys.
+        '''
+        name = event.command_name
+        collection = event.command.get(name)
+        if name == 'getMore':
+            collection = event.command.get('collection')
+        if not isinstance(collection, str):
+            collection = '-'
+        site = call_site()
+        self.commands[(name, collection, site)] += 1
+        if (field := CONDITIONS.get(name)) is not None:
+            self.shapes[(name, collection, site, repr(shape(event.command.get(field, {}))))] += 1
+
+    def succeeded(self, event):
+        if (q := self._pending.pop(event.request_id, None)) is None:
+            return
+        q.elapsed += event.duration_micros
+        reply = event.reply
+        if cursor := reply.get('cursor'):
+            q.returned += len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+            if cursor.get('id'):
+                self._cursors[cursor['id']] = q
+        elif 'values' in reply:
+            q.returned += len(reply['values'])
+        elif 'n' in reply:
+            q.returned += 1
+
+    def failed(self, event):
+        self._pending.pop(event.request_id, None)
+
+def explain(client, query):
+    '''
+    Run explain on a recorded query.  Returns a dictionary with the names of
+    the indexes used (or COLLSCAN if a collection was scanned), the number
+    of documents examined, and the number returned.  Queries that write
+    ($out and $merge aggregations) are not run.
+
+    Arguments:
+        client:  a pymongo MongoClient
+        query:  a Query recorded by CommandMonitor
+    '''
+    res = {'index': '', 'examined': None, 'returned': query.returned}
+    if query.writes:
+        res['index'] = '(not explained: writes to a collection)'
+        return res
+    try:
+        plan = client[query.database].command('explain', query.command, verbosity='executionStats')
+    except PyMongoError as err:
+        logging.error(f'explain: {err}')
+        res['index'] = '(explain failed)'
+        return res
+    indexes = []
+    stats = []
+    walk_plan(plan, indexes, stats)
+    res['index'] = ', '.join(dict.fromkeys(indexes)) or 'none'
+    if stats:
+        res['examined'] = sum(s.get('totalDocsExamined', 0) for s in stats)
+    return res
+
+def walk_plan(doc, indexes, stats):
+    '''
+    Helper function for explain.  Collect the index names (or COLLSCAN) from
+    the stages of the winning plans and the executionStats sections of an
+    explain result, which can be nested inside the stages of an aggregation.
+    '''
+    if isinstance(doc, list):
+        for x in doc:
+            walk_plan(x, indexes, stats)
+        return
+    if not isinstance(doc, dict):
+        return
+    if doc.get('stage') == 'COLLSCAN':
+        indexes.append('COLLSCAN')
+    if 'indexName' in doc:
+        indexes.append(doc['indexName'])
+    for k, v in doc.items():
+        if k in ['rejectedPlans', 'allPlansExecution', 'executionStages']:
+            continue
+        if k == 'executionStats':
+            stats.append(v)
+        else:
+            walk_plan(v, indexes, stats)
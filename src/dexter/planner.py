@@ -0,0 +1,62 @@
+#
+# Query planner for DB.select
+#
+# Command line constraints on account names and tags are case-insensitive
+# regular expressions that can match anywhere in a name.  A query with an
+# unanchored regexp can't use an index, so the planner evaluates the pattern
+# in Python against the distinct values of the field (a small list that
+# MongoDB reads from an index) and replaces it with a condition that has the
+# same result and can use the index.
+#
+
+from collections import namedtuple
+import re
+
+# A plan has the name of the field, the kind of plan, and the condition to
+# use in the query.  The kinds are
+#   exact:   the pattern is a complete value, the condition is a list with that value
+#   prefix:  the pattern is the start of every value it matches, the condition is
+#            an anchored (case-sensitive) regexp
+#   in:      the condition is a list of the values the pattern matches
+#   regex:   the original pattern, used when there are too many matching values
+
+Plan = namedtuple('Plan', ['field', 'kind', 'condition'])
+
+# The longest list of values to put in an $in condition
+
+MAX_IN = 500
+
+SPECIAL = set('.^$*+?{}[]\\|()')
+
+def is_literal(pattern):
+    '''
+    Return True if a pattern does not have any regular expression operators.
+    '''
+    return not any(ch in SPECIAL for ch in pattern)
+
+def plan_match(field, pattern, values, negate=False):
+    '''
+    Make a plan for a case-insensitive regular expression match.
+
+    Arguments:
+        field:  the name of the field in the database
+        pattern:  the regular expression from the command line
+        values:  a list of the distinct values of the field
+        negate:  if True the query should select documents that don't match
+    '''
+    expr = re.compile(pattern, re.I)
+    matched = sorted(v for v in values if isinstance(v, str) and expr.search(v))
+    if len(matched) > MAX_IN:
+        kind, cond = 'regex', {'$regex': pattern, '$options': 'i'}
+    elif is_literal(pattern) and len(matched) == 1 and matched[0].lower() == pattern.lower():
+        kind, cond = 'exact', {'$in': matched}
+    elif is_literal(pattern) and matched and len({v[:len(pattern)] for v in matched}) == 1 and matched[0].lower().startswith(pattern.lower()):
+        kind, cond = 'prefix', {'$regex': '^' + re.escape(matched[0][:len(pattern)])}
+    else:
+        kind, cond = 'in', {'$in': matched}
+    if negate:
+        if '$in' in cond:
+            cond = {'$nin': cond['$in']}
+        else:
+            cond = {'$not': re.compile(cond['$regex'], re.I if cond.get('$options') else 0)}
+    return Plan(field, kind, cond)
@@ -28,7 +28,7 @@ def collect_card_transactions(cardname):
 
     def find_payment(card):
         lst = []
-        for e in DB.select(Entry, account=card, tag=Tag.Z.value):
+        for e in DB.prefetch(DB.select(Entry, account=card, tag=Tag.Z.value)):
             if Tag.U.value not in e.tags:
                 lst.append(e)
         if lst:
@@ -39,7 +39,7 @@ def collect_card_transactions(cardname):
         return pmt
     
     def find_purchases(card, cutoff):
-        plist = DB.select(Entry, account=card, tag=Tag.P.value, end_date=cutoff)
+        plist = DB.prefetch(DB.select(Entry, account=card, tag=Tag.P.value, end_date=cutoff))
         return sorted(plist, key=lambda rec: rec.date)
     
     cards = [cardname] if cardname else [c.name for c in sorted(DB.card_accounts(), key=lambda a: a.abbrev)]
@@ -67,12 +67,11 @@ def subset_sum(card):
     Convert transaction amounts to integer number of cents, call the subset sum
     method to find a subset of purchases that total to the sum of payments.
 
-    To prevent roundoff errors, all amounts are rounded to the nearest integer
-    and converted to an integer number of cents.
+    Amounts are stored as integer numbers of cents, so the values are exact.
     '''
     logging.debug(f'subset sum {card}')
-    target = int(round(100*card['payment'].amount))
-    purchases = [int(round(-100*e.value)) for e in card['entries']]
+    target = card['payment'].cents
+    purchases = [-e.value.cents for e in card['entries']]
     logging.debug(f'{target} {purchases}')
     node = find_subset(purchases, target)
     return node.members() if node else []
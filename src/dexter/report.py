@@ -1,6 +1,6 @@
 # Report generators
 
-from datetime import date, timedelta
+from datetime import date
 import logging
 import re
 
@@ -9,6 +9,7 @@ from rich.table import Table, Column
 from .DB import DB, Transaction, Entry, Column as ColType, Tag
 from .console import console, format_amount
 from .config import Config
+from .util import Amount, cents
 
 
 def print_balance_report(args):
@@ -37,7 +38,8 @@ def print_balance_report(args):
 
 def print_grouped_report(args, accounts):
     '''
-    Print a one-line summary of the balance of each account.
+    Print a one-line summary of the balance of each account.  The columns
+    are kept in cents so the ending balances and totals are exact.
     '''
     start_date = args.start_date or Config.DB.start_date
     end_date = args.end_date or date.today()
@@ -46,11 +48,13 @@ def print_grouped_report(args, accounts):
     debits = []
     credits = []
     ends = []
-    
+
+    balances = DB.balances(accounts, starting=start_date, ending=end_date, nobudget=args.no_budget)
     for aname in accounts:
-        starts.append(DB.balance(aname, ending=start_date-timedelta(days=1), nobudget=args.no_budget))
-        debits.append(DB.column_sum(aname, ColType.dr, starting=start_date, ending=end_date, nobudget=args.no_budget))
-        credits.append(-DB.column_sum(aname, ColType.cr, starting=start_date, ending=end_date, nobudget=args.no_budget))
+        b = balances[aname]
+        starts.append(cents(b.starting))
+        debits.append(cents(b.debits))
+        credits.append(-cents(b.credits))
         ends.append(starts[-1] + debits[-1] + credits[-1])
 
     title = f'Account Balances   {start_date} to {end_date}'
@@ -74,15 +78,13 @@ def print_grouped_report(args, accounts):
         if name.endswith('$'):
             name = name[:-1]
         row = [name]
-        row.append(format_amount(starts[i], dollar_sign=True))
-        row.append(format_amount(debits[i], dollar_sign=True))
-        row.append(format_amount(credits[i], dollar_sign=True))
-        row.append(format_amount(ends[i], dollar_sign=True))
+        for col in [starts, debits, credits, ends]:
+            row.append(format_amount(Amount.from_cents(col[i]), dollar_sign=True))
         t.add_row(*row)
     t.add_section()
     row = ['[blue italic]total']
     for col in [starts, debits, credits, ends]:
-        row.append(format_amount(sum(col), dollar_sign=True))
+        row.append(format_amount(Amount.from_cents(sum(col)), dollar_sign=True))
     t.add_row(*row)
     console.print()
     console.print(t)
@@ -97,7 +99,8 @@ def print_detailed_report(args, accounts):
     entries = {}
 
     for aname in accounts:
-        entries[aname] = DB.select(Entry, account=aname, start_date=start_date, end_date=end_date).order_by('date')
+        lst = DB.prefetch(DB.select(Entry, account=aname, start_date=start_date, end_date=end_date))
+        entries[aname] = sorted(lst, key=lambda e: e.date)
 
     for acct, elist in entries.items():
         print_detail_table(acct, elist, start_date, args.no_budget)
@@ -105,7 +108,8 @@ def print_detailed_report(args, accounts):
 def print_detail_table(acct, entries, start, nobudget):
     '''
     Helper function for expense report.  Uses rich to print a table
-    with one line per record, updating balance.
+    with one line per record, updating balance.  The balance is
+    kept in cents so it doesn't accumulate rounding errors.
 
     Arguments:
         acct:  account name
@@ -131,7 +135,7 @@ def print_detail_table(acct, entries, start, nobudget):
         title_style='table_header',
         # show_header=False
     )
-    bal = DB.balance(acct, start)
+    bal_c = DB.balance(acct, start).cents
 
     fills = []
     nonfills = []
@@ -144,23 +148,23 @@ def print_detail_table(acct, entries, start, nobudget):
     logging.debug(f'fills {fills}')
     logging.debug(f'nonfills {nonfills}')
 
-    t.add_row(f'[blue italic]{start}','[blue italic]starting balance','','','',format_amount(bal, dollar_sign=True))
+    t.add_row(f'[blue italic]{start}','[blue italic]starting balance','','','',format_amount(Amount.from_cents(bal_c), dollar_sign=True))
 
     if not nobudget:
         for e in fills:
             row = []
-            bal += e.value
+            bal_c += e.value.cents
             row.append(f'[blue italic]{str(e.date)}')
             row.append(f'[blue italic]{e.tref.description}')
             row.append(DB.display_name(acct, markdown=True))
             row.append(DB.display_name(e.tref.pdebit, markdown=True))
             row.append(format_amount(e.value, dollar_sign=True))
-            row.append(format_amount(bal, dollar_sign=True))
+            row.append(format_amount(Amount.from_cents(bal_c), dollar_sign=True))
             t.add_row(*row)
 
     for e in nonfills:
         row = []
-        bal += e.value
+        bal_c += e.value.cents
         debit = credit = ''
         row.append(str(e.date))
         if trans := e.tref:
@@ -175,7 +179,7 @@ def print_detail_table(acct, entries, start, nobudget):
         row.append(credit)
         row.append(debit)
         row.append(format_amount(e.value, dollar_sign=True))
-        row.append(format_amount(bal, dollar_sign=True))
+        row.append(format_amount(Amount.from_cents(bal_c), dollar_sign=True))
         t.add_row(*row)
     console.print()
     console.print(t)
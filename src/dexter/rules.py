@@ -0,0 +1,244 @@
+#
+# Compiled regular expression rules.
+#
+# RegExp documents are stored in the database as strings.  The classes
+# here compile the patterns and parse the replacement templates once so
+# the pairing and review commands can match thousands of descriptions
+# without recompiling or re-querying the database.
+#
+
+from functools import lru_cache
+import logging
+import re
+from re import _parser as sre_parse, _constants as sre
+import string
+
+# A placeholder in a replacement string has a group number and an optional
+# transform, e.g. "{0}" or "{1.capwords}"
+
+PLACEHOLDER = r'{(\d+)(\.\w+)?}'
+
+TRANSFORMS = {
+    '': lambda s: s,
+    '.lower':  lambda s: s.lower(),
+    '.capwords':  lambda s: string.capwords(s),
+}
+
+class Rule:
+    '''
+    The compiled form of a regular expression and its replacement string.
+    The replacement is split into a list of parts, where a part is either a
+    literal string or a tuple with a group number and a transform function.
+    '''
+
+    def __init__(self, expr: str, repl: str):
+        self.pattern = re.compile(expr, re.I)
+        self.template = Rule.parse_template(repl)
+        self.literal = Rule.longest_literal(expr)
+
+    @staticmethod
+    def parse_template(repl: str):
+        '''
+        Split a replacement string into literal strings and placeholders.
+        Placeholder group numbers start at 0, so "{0}" refers to the
+        first group in the match.
+        '''
+        parts = []
+        tokens = re.split(PLACEHOLDER, repl or '')
+        for i in range(0, len(tokens)-1, 3):
+            lit, n, f = tokens[i:i+3]
+            if lit:
+                parts.append(lit)
+            if (fn := TRANSFORMS.get(f or '')) is None:
+                raise ValueError(f'RegExp: unknown transform {f} in "{repl}"')
+            parts.append((int(n)+1, fn))
+        if tokens[-1]:
+            parts.append(tokens[-1])
+        return parts
+
+    @staticmethod
+    def longest_literal(expr: str):
+        '''
+        Return the longest string that has to appear (ignoring case) in any
+        text the pattern matches, converted to lower case, or an empty string
+        if the pattern does not have a required literal.  Only ASCII literals
+        are used, so the test is not affected by Unicode case folding.
+        '''
+        try:
+            runs = required_literals(sre_parse.parse(expr, re.I).data)
+        except Exception:
+            return ''
+        runs = [r.lower() for r in runs if r.isascii()]
+        return max(runs, key=len, default='')
+
+    def matches(self, s: str):
+        '''
+        Return True if the pattern matches a string.
+        '''
+        return self.pattern.search(s) is not None
+
+    def apply(self, s: str):
+        '''
+        If the pattern matches the string s return the replacement
+        string (after substituting parts), otherwise return None
+        '''
+        if m := self.pattern.search(s):
+            return ''.join(p if isinstance(p, str) else p[1](m[p[0]]) for p in self.template)
+        return None
+
+def required_literals(data):
+    '''
+    Helper function for Rule.longest_literal.  Walk the parse tree of a
+    regular expression and return a list of literal strings that must
+    appear in any matching text.  Alternatives and optional parts end a
+    run of literals and are not searched.
+
+    Arguments:
+        data:  the list of (opcode, argument) pairs in a parsed pattern
+    '''
+    runs = []
+    chars = []
+    for op, av in data:
+        if op is sre.LITERAL:
+            chars.append(chr(av))
+            continue
+        if chars:
+            runs.append(''.join(chars))
+            chars = []
+        if op is sre.SUBPATTERN:
+            runs += required_literals(av[3].data)
+        elif op is sre.ATOMIC_GROUP:
+            runs += required_literals(av.data)
+        elif op in (sre.MAX_REPEAT, sre.MIN_REPEAT, sre.POSSESSIVE_REPEAT) and av[0] > 0:
+            runs += required_literals(av[2].data)
+        elif op is sre.ASSERT:
+            runs += required_literals(av[1].data)
+    if chars:
+        runs.append(''.join(chars))
+    return runs
+
+class LiteralIndex:
+    '''
+    A prefilter for a list of rules.  Each rule with a required literal
+    of at least three characters is put in a table indexed by one of the 
+    trigrams in the literal.  To find the rules that might match a string,
+    look up each trigram in the string and keep the rules whose literal
+    occurs in the string, plus the rules that don't have a literal.
+    Candidates are returned in their original order, so the first rule
+    that matches is the same one a linear scan would find.
+    '''
+
+    N = 3
+
+    def __init__(self, rules):
+        '''
+        Build the index.
+
+        Arguments:
+            rules:  a list of Rule objects
+        '''
+        self._size = len(rules)
+        self._always = []
+        self._table = {}
+        for i, rule in enumerate(rules):
+            key = rule.literal
+            if len(key) < self.N:
+                self._always.append(i)
+                continue
+            grams = [key[j:j+self.N] for j in range(len(key)-self.N+1)]
+            g = min(grams, key=lambda x: len(self._table.get(x, [])))
+            self._table.setdefault(g, []).append((i, key))
+
+    def candidates(self, s: str):
+        '''
+        Return the indexes of rules that might match a string, in order.
+        Strings with non-ASCII characters are not filtered.
+        '''
+        if not s.isascii():
+            return range(self._size)
+        text = s.lower()
+        res = set(self._always)
+        for j in range(len(text)-self.N+1):
+            if bucket := self._table.get(text[j:j+self.N]):
+                res.update(i for i, key in bucket if key in text)
+        return sorted(res)
+
+@lru_cache(maxsize=None)
+def compile_rule(expr: str, repl: str):
+    '''
+    Return the Rule for a pattern and replacement, compiling it the
+    first time it is used.
+    '''
+    return Rule(expr, repl)
+
+class RuleSet:
+    '''
+    An in-memory copy of the RegExp collection.  Documents are grouped by
+    action, in the order they were defined, and each document is paired
+    with its compiled Rule.  Each group has a LiteralIndex so a search
+    only tries the rules that can possibly match.
+
+    The searches and tried attributes count calls to find_first and the
+    number of patterns tested, so the average number of rules tried per
+    description is tried/searches.
+    '''
+
+    def __init__(self, regexps, indexed=True):
+        '''
+        Compile the rules.  A document with an invalid pattern or an unknown
+        transform in its replacement string is logged and skipped.
+
+        Arguments:
+            regexps:  an iterable of RegExp documents
+            indexed:  if False search every rule (linear scan)
+        '''
+        self._groups = {}
+        self._index = {}
+        self.skipped = []
+        n = 0
+        for doc in regexps:
+            try:
+                rule = compile_rule(doc.expr, doc.repl)
+            except (re.error, ValueError) as err:
+                logging.error(f'RuleSet: skipping {doc}: {err}')
+                self.skipped.append(doc)
+                continue
+            self._groups.setdefault(doc.action, []).append((rule, doc))
+            n += 1
+        if indexed:
+            for action, lst in self._groups.items():
+                self._index[action] = LiteralIndex([rule for rule, _ in lst])
+        self.searches = 0
+        self.tried = 0
+        logging.debug(f'RuleSet: compiled {n} regular expressions')
+
+    def rules(self, action):
+        '''
+        Return the list of (rule, document) pairs for an action.
+        '''
+        return self._groups.get(action, [])
+
+    def find_first(self, s: str, action):
+        '''
+        Return the first document with the specified action that matches
+        a string, or None if there is no match.
+        '''
+        lst = self.rules(action)
+        index = self._index.get(action)
+        self.searches += 1
+        for i in (index.candidates(s) if index else range(len(lst))):
+            self.tried += 1
+            rule, doc = lst[i]
+            if rule.pattern.search(s):
+                return doc
+        return None
+
+    def apply_all(self, s: str, action):
+        '''
+        Apply every rule with the specified action to a string, in order,
+        using the output of one rule as the input to the next.
+        '''
+        for rule, _ in self.rules(action):
+            if r := rule.apply(s):
+                s = r
+        return s
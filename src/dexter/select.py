@@ -10,6 +10,7 @@ from .config import Config
 from .console import console, print_transaction_table, print_csv_transactions, print_journal_transactions, get_account_name
 from .gui.app import start_gui
 from .repl import repl
+from .util import Amount, cents
 
 
 def validate_options(args):
@@ -74,14 +75,18 @@ def print_unpaired_csv(recs, args):
         row = [rec.date, DB.abbrev(rec.account), -rec.value, 'fill me', desc,'']
         writer.writerow(dict(zip(colnames,row)))
 
-# Delete selected records
+# Update or delete selected records with bulk operations.  The query
+# is sent to the database without fetching the records.
 
-def delete(recs, args):
-    console.print('[blue]Delete Records')
-    for obj in recs:
-        console.print(f'  {obj.row()}')
-        if not args.preview:
-            obj.delete()
+def bulk_update(cls, query, args):
+    matched, changed = DB.bulk_update(cls, query, args.update, preview=args.preview)
+    verb = 'would change' if args.preview else 'changed'
+    console.print(f'[blue]Update: {matched} {cls.__name__} records selected, {verb} {changed}')
+
+def bulk_delete(cls, query, args):
+    counts = DB.bulk_delete(cls, query, preview=args.preview, cascade=args.cascade)
+    verb = 'would delete' if args.preview else 'deleted'
+    console.print(f'[blue]Delete: {verb} {counts["transaction"]} transactions and {counts["entry"]} entries, unlinked {counts["unlinked"]} entries, updated {counts["updated"]} transactions')
 
 # Split a transaction by adding a new debit
 
@@ -140,7 +145,7 @@ def split(recs, args):
         console.print(f'[blue]exit')
         return
     
-    diff = round(trans.pamount-amount, 2)
+    diff = Amount.from_cents(cents(trans.pamount) - cents(amount))
     DB.split_transaction(trans, account, amount, diff)
 
 # Table mapping action names (from the command line) with functions that
@@ -151,7 +156,6 @@ actions = {
     'journal':    print_journal_transactions,       # defined in .console
     'repl':       repl,                             # defined in .repl
     'gui':        start_gui,                        # defined in .gui
-    'delete':     delete,
     'split':      split,
 }
 
@@ -173,6 +177,11 @@ def select(args):
         --tag               add or remove a tag on all selected records
         --delete            delete all selected records
 
+    With --preview, --update and --delete print the number of records that
+    would be changed or deleted.  Deleted entries are removed from their
+    transactions; with --cascade the transactions are deleted too and their
+    other entries are unlinked.
+
     Constraints:
 
         --description S     description must include string S
@@ -204,13 +213,27 @@ def select(args):
 
     logging.debug(f'kwargs {str(kwargs)}')
 
+    if args.update or args.delete:
+        kwargs.pop('update', None)
+        kwargs.pop('delete', None)
+        if (cls == Transaction) and ('account' in kwargs):
+            acct = kwargs.pop('account')
+            query = {'$or': [DB.query(cls, **(kwargs | {'debit': acct})), DB.query(cls, **(kwargs | {'credit': acct}))]}
+        else:
+            query = DB.query(cls, **kwargs)
+        if args.update:
+            bulk_update(cls, query, args)
+        else:
+            bulk_delete(cls, query, args)
+        return
+
     if (cls == Transaction) and ('account' in kwargs):
         acct = kwargs.pop('account')
         debits = DB.select(cls, **(kwargs | {'debit': acct}))
         credits = DB.select(cls, **(kwargs | {'credit': acct}))
-        recs = list(debits) + list(credits)
+        recs = DB.prefetch(list(debits) + list(credits))
     else:
-        recs = list(DB.select(cls, **kwargs))
+        recs = DB.prefetch(DB.select(cls, **kwargs))
 
     if len(recs) == 0:
         return
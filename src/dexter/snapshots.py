@@ -0,0 +1,161 @@
+#
+# Monthly balance snapshots
+#
+# The snapshot collection is derived from the Entry collection.  It has one
+# document for each combination of account, month, column, and budget flag,
+# with the sum of the amounts of the entries in that group.  Balances over
+# long periods can be computed from the monthly totals, and only the entries
+# in partial months at the ends of the period need to be read.
+#
+
+from datetime import datetime, timedelta
+import logging
+
+from pymongo import ASCENDING, UpdateOne
+
+BUDGET = '#budget'
+
+def month_start(d):
+    '''
+    Return a datetime for the first day of the month of a date.
+    '''
+    return datetime(d.year, d.month, 1)
+
+def next_month(d):
+    '''
+    Return a datetime for the first day of the month after a date.
+    '''
+    return datetime(d.year + 1, 1, 1) if d.month == 12 else datetime(d.year, d.month + 1, 1)
+
+class MonthlySnapshots:
+    '''
+    Manage the snapshot collection.  The collection is kept up to date by
+    calling update with the old and new versions of Entry documents each time
+    entries are written, or it can be rebuilt from scratch with a single
+    aggregation.
+
+    Documents passed to update are raw (pymongo) documents, so dates are
+    datetime objects and columns are strings.
+    '''
+
+    COLLECTION = 'snapshot'
+
+    # Entry fields that affect a snapshot
+
+    FIELDS = {'account', 'date', 'column', 'amount', 'tags'}
+
+    KEY = ['account', 'month', 'column', 'budget']
+
+    def __init__(self, database):
+        '''
+        Arguments:
+            database:  a function that returns the current pymongo database
+        '''
+        self._database = database
+        self.updates = 0
+
+    @property
+    def collection(self):
+        return self._database()[self.COLLECTION]
+
+    @property
+    def projection(self):
+        return {f: 1 for f in self.FIELDS}
+
+    def fetch(self, collection, query):
+        '''
+        Return the Entry documents that match a query, with only the fields
+        needed to compute snapshots.
+        '''
+        return list(collection.find(query, self.projection))
+
+    @staticmethod
+    def key(doc):
+        '''
+        Return the snapshot key for an Entry document.
+        '''
+        return (doc['account'], month_start(doc['date']), doc['column'], BUDGET in doc.get('tags', []))
+
+    def update(self, old, new):
+        '''
+        Subtract the amounts in the old versions of documents, add the amounts
+        in the new versions, and write the changes with one bulk write.
+
+        Arguments:
+            old:  a list of Entry documents before the write (deleted or updated)
+            new:  a list of Entry documents after the write (inserted or updated)
+        '''
+        deltas = {}
+        for sign, lst in ((-1, old), (1, new)):
+            for doc in lst:
+                k = self.key(doc)
+                deltas[k] = deltas.get(k, 0) + sign * doc['amount']
+        ops = [
+            UpdateOne(dict(zip(self.KEY, k)), {'$inc': {'total': t}}, upsert=True)
+            for k, t in deltas.items() if t
+        ]
+        if ops:
+            logging.debug(f'MonthlySnapshots: updating {len(ops)} snapshots')
+            self.collection.bulk_write(ops, ordered=False)
+            self.updates += len(ops)
+
+    def rebuild(self, entries):
+        '''
+        Replace the snapshot collection with totals computed from all entries.
+
+        Arguments:
+            entries:  the pymongo Entry collection
+        '''
+        logging.debug('MonthlySnapshots: rebuilding')
+        pipeline = [
+            {'$group': {
+                '_id': {
+                    'account': '$account',
+                    'month': {'$dateFromParts': {'year': {'$year': '$date'}, 'month': {'$month': '$date'}}},
+                    'column': '$column',
+                    'budget': {'$in': [BUDGET, {'$ifNull': ['$tags', []]}]},
+                },
+                'total': {'$sum': '$amount'},
+            }},
+            {'$project': {'_id': 0, **{f: f'$_id.{f}' for f in self.KEY}, 'total': 1}},
+            {'$out': self.COLLECTION},
+        ]
+        list(entries.aggregate(pipeline))
+        self.collection.create_index([(f, ASCENDING) for f in self.KEY], unique=True)
+
+    def is_empty(self):
+        return self.collection.find_one({}, {'_id': 1}) is None
+
+    def count(self):
+        return self.collection.count_documents({})
+
+    @staticmethod
+    def split(starting=None, ending=None):
+        '''
+        Decide which parts of a period can be computed from snapshots.  Returns
+        a tuple with three items:  a query for the snapshots to use, a query for
+        the entries in partial months (or None if every month is complete),
+        and the start of the month that contains the starting date.
+
+        Arguments:
+            starting:  datetime of the first day in the period, or None
+            ending:  datetime of the last day in the period, or None
+        '''
+        snaps = {}
+        clauses = []
+        first = month_start(starting) if starting else None
+        if starting and starting != first:
+            # partial month at the start
+            snaps['month'] = {'$ne': first}
+            clauses.append({'date': {'$gte': first, '$lt': next_month(starting)}})
+        if ending:
+            # complete months end before the month of the day after the ending date
+            last = month_start(ending + timedelta(days=1))
+            snaps.setdefault('month', {})['$lt'] = last
+            clauses.append({'date': {'$gte': last}})
+        if not clauses:
+            return snaps, None, first
+        raw = {'$or': clauses} if len(clauses) > 1 else clauses[0]
+        if ending:
+            raw = {'$and': [raw, {'date': {'$lte': ending}}]}
+        return snaps, raw, first
@@ -0,0 +1,495 @@
+#
+# SQLite storage backend
+#
+# An implementation of the DB storage interface (the DB methods marked with
+# the @storage decorator) that keeps the records in a single SQLite file, for
+# installations that don't have a MongoDB server.  Records are returned as
+# the same MongoEngine Document objects used with MongoDB, with references
+# between entries and transactions already filled in.
+#
+
+from datetime import date, datetime
+import json
+import logging
+from pathlib import Path
+import re
+import sqlite3
+
+from bson import ObjectId
+
+from .DB import DB, Account, Entry, Transaction, RegExp, Category, Column, Action, Tag, Balance
+from .planner import plan_match
+from .util import UIDSet, Amount, cents
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dexter (
+    date TEXT NOT NULL,
+    schema INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS account (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    category TEXT NOT NULL,
+    abbrev TEXT,
+    parser TEXT,
+    comment TEXT
+);
+CREATE TABLE IF NOT EXISTS entry (
+    id TEXT PRIMARY KEY,
+    uid TEXT NOT NULL UNIQUE,
+    date TEXT NOT NULL,
+    description TEXT,
+    account TEXT NOT NULL,
+    col TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    tags TEXT NOT NULL DEFAULT '[]',
+    tref TEXT,
+    pos INTEGER
+);
+CREATE INDEX IF NOT EXISTS entry_account ON entry (account, col, date);
+CREATE INDEX IF NOT EXISTS entry_date ON entry (date);
+CREATE INDEX IF NOT EXISTS entry_tref ON entry (tref, pos);
+CREATE TABLE IF NOT EXISTS trans (
+    id TEXT PRIMARY KEY,
+    description TEXT NOT NULL,
+    comment TEXT,
+    tags TEXT NOT NULL DEFAULT '[]',
+    pdate TEXT,
+    pdebit TEXT,
+    pcredit TEXT,
+    pamount INTEGER
+);
+CREATE INDEX IF NOT EXISTS trans_pdate ON trans (pdate);
+CREATE INDEX IF NOT EXISTS trans_pdebit ON trans (pdebit, pdate);
+CREATE INDEX IF NOT EXISTS trans_pcredit ON trans (pcredit, pdate);
+CREATE TABLE IF NOT EXISTS regexp (
+    id TEXT PRIMARY KEY,
+    action TEXT NOT NULL,
+    expr TEXT NOT NULL,
+    repl TEXT NOT NULL,
+    acct TEXT NOT NULL
+);
+'''
+
+# Names of columns in the entry and trans tables that correspond to
+# select constraints (see Entry.constraints and Transaction.constraints)
+
+COLUMNS = {
+    Entry: {
+        'uid': 'uid', 'description': 'description', 'date': 'date',
+        'amount': 'amount', 'account': 'account', 'column': 'col',
+    },
+    Transaction: {
+        'description': 'description', 'comment': 'comment', 'date': 'pdate',
+        'amount': 'pamount', 'debit': 'pdebit', 'credit': 'pcredit',
+    },
+}
+
+ENTRY_FIELDS = 'id, uid, date, description, account, col, amount, tags, tref'
+TRANS_FIELDS = 'id, description, comment, tags, pdate, pdebit, pcredit, pamount'
+
+def iso(d):
+    '''
+    Convert a date (or datetime, or string with a date) to the string saved
+    in the database.
+    '''
+    if isinstance(d, str):
+        d = Entry._fields['date'].to_mongo(d)
+    if isinstance(d, datetime):
+        d = d.date()
+    return d.isoformat()
+
+def regexp(pattern, s):
+    '''
+    The REGEXP function for SQLite:  a case-insensitive search.
+    '''
+    return s is not None and re.search(pattern, s, re.I) is not None
+
+class SQLiteStore:
+    '''
+    A Dexter database in an SQLite file.  The database uses write-ahead
+    logging, and the tables have the same indexes as the MongoDB collections.
+    '''
+
+    def __init__(self, path, create=False):
+        '''
+        Open (or create) the database.
+
+        Arguments:
+            path:  the name of the database file
+            create:  if True erase the file if it exists and start a new database
+        '''
+        self.path = Path(path)
+        if create:
+            for p in [self.path, Path(f'{path}-wal'), Path(f'{path}-shm')]:
+                p.unlink(missing_ok=True)
+        elif not self.path.is_file():
+            raise ValueError(f'DB.open: no Dexter database named {self.path}')
+        logging.debug(f'SQLiteStore: opening {self.path}')
+        self.conn = sqlite3.connect(self.path)
+        self.conn.create_function('regexp', 2, regexp, deterministic=True)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        if create:
+            with self.conn:
+                self.conn.execute('INSERT INTO dexter VALUES (?, ?)', (datetime.now().isoformat(), DB.SCHEMA))
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def table_sizes(path):
+        '''
+        Return a dictionary with the number of rows in each table of a
+        database file (see DB.info).  The file is opened read-only.
+        '''
+        conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        try:
+            tables = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+            return {t: conn.execute(f'SELECT COUNT(*) FROM {t}').fetchone()[0] for t in tables}
+        finally:
+            conn.close()
+
+    # Accounts and regular expressions
+
+    def load_accounts(self):
+        cursor = self.conn.execute('SELECT id, name, category, abbrev, parser, comment FROM account')
+        return [
+            Account(id=ObjectId(r[0]), name=r[1], category=Category(r[2]), abbrev=r[3], parser=r[4], comment=r[5])
+            for r in cursor
+        ]
+
+    def load_regexps(self):
+        cursor = self.conn.execute('SELECT id, action, expr, repl, acct FROM regexp ORDER BY rowid')
+        return [RegExp(id=ObjectId(r[0]), action=Action(r[1]), expr=r[2], repl=r[3], acct=r[4]) for r in cursor]
+
+    def delete_regexps(self):
+        with self.conn:
+            n = self.conn.execute('DELETE FROM regexp').rowcount
+        DB.reload_regexps()
+        return n
+
+    def uids(self, compact=None):
+        lst = [r[0] for r in self.conn.execute('SELECT uid FROM entry')]
+        return UIDSet(lst) if compact else set(lst)
+
+    # Saving records
+
+    def save_records(self, lst):
+        '''
+        Save Account, RegExp, Entry, and Transaction objects.  New objects are
+        given ObjectIds, and all the rows are written in a single SQL transaction.
+        As with MongoDB, a Transaction is skipped if one of its entries can't
+        be saved.
+        '''
+        with self.conn:
+            for obj in lst:
+                if isinstance(obj, Transaction):
+                    self.save_transaction(obj)
+                else:
+                    self.save_row(obj)
+        if any(isinstance(obj, Account) for obj in lst):
+            DB.accounts.invalidate()
+        if any(isinstance(obj, RegExp) for obj in lst):
+            DB.reload_regexps()
+
+    def save_transaction(self, t):
+        if len(t.entries) == 0:
+            logging.debug(f'DB.save_records: transaction has no entries, skipping {t}')
+            return
+        new = t.pk is None
+        if new:
+            t.id = ObjectId()
+        self.conn.execute('SAVEPOINT trans')
+        added = [e for e in t.entries if e.pk is None]
+        for i, e in enumerate(t.entries):
+            e.tref = t
+            if not self.save_row(e, pos=i):
+                logging.error(f'DB: entry not saved, skipping {t}')
+                self.conn.execute('ROLLBACK TO trans')
+                self.conn.execute('RELEASE trans')
+                for x in added:
+                    x.id = None
+                if new:
+                    t.id = None
+                return
+        self.save_row(t)
+        self.conn.execute('RELEASE trans')
+
+    def save_row(self, obj, pos=None):
+        '''
+        Insert or update the row for one object.  Returns True if the
+        row was written.
+        '''
+        new = obj.pk is None
+        if new:
+            obj.id = ObjectId()
+        try:
+            obj.validate()
+            table, row = self.to_row(obj, pos)
+            names = ', '.join(row)
+            marks = ', '.join('?' * len(row))
+            updates = ', '.join(f'{k} = excluded.{k}' for k in row if k != 'id')
+            sql = f'INSERT INTO {table} ({names}) VALUES ({marks}) ON CONFLICT(id) DO UPDATE SET {updates}'
+            self.conn.execute(sql, tuple(row.values()))
+            return True
+        except Exception as err:
+            logging.error(f'DB: {err} saving {obj}')
+            if new:
+                obj.id = None
+            return False
+
+    @staticmethod
+    def to_row(obj, pos=None):
+        '''
+        Return the table name and a dictionary of column values for an object.
+        '''
+        if isinstance(obj, Entry):
+            return 'entry', {
+                'id': str(obj.pk), 'uid': obj.uid, 'date': iso(obj.date), 'description': obj.description,
+                'account': obj.account, 'col': obj.column.value, 'amount': cents(obj.amount),
+                'tags': json.dumps(list(obj.tags)), 'tref': str(obj.tref.pk) if obj.tref else None, 'pos': pos,
+            }
+        if isinstance(obj, Transaction):
+            return 'trans', {
+                'id': str(obj.pk), 'description': obj.description, 'comment': obj.comment,
+                'tags': json.dumps(list(obj.tags)), 'pdate': iso(obj.pdate) if obj.pdate else None,
+                'pdebit': obj.pdebit, 'pcredit': obj.pcredit,
+                'pamount': cents(obj.pamount) if obj.pamount is not None else None,
+            }
+        if isinstance(obj, Account):
+            return 'account', {
+                'id': str(obj.pk), 'name': obj.name, 'category': obj.category.value,
+                'abbrev': obj.abbrev, 'parser': obj.parser, 'comment': obj.comment,
+            }
+        if isinstance(obj, RegExp):
+            return 'regexp', {
+                'id': str(obj.pk), 'action': obj.action.value, 'expr': obj.expr, 'repl': obj.repl, 'acct': obj.acct,
+            }
+        raise ValueError(f'DB.save_records: cannot save {obj}')
+
+    # Queries
+
+    def select(self, collection, **constraints):
+        '''
+        Return a list of Entry or Transaction objects that match constraints
+        (see DB.select).  Patterns for account names are translated by the
+        query planner, so the query can use an index.
+        '''
+        logging.debug(f'SQLiteStore.select: {constraints}')
+        DB.plans = []
+        if collection not in [Entry, Transaction]:
+            raise ValueError('select: collection must be Entry or Transaction')
+        if constraints.get('update'):
+            raise ValueError('select: --update requires the MongoDB backend')
+        table = 'entry' if collection == Entry else 'trans'
+        fields = ENTRY_FIELDS if collection == Entry else TRANS_FIELDS
+        sql, params = self.where(collection, table, constraints)
+        sql = f'SELECT {fields} FROM {table}{sql} ORDER BY {COLUMNS[collection]["date"]}'
+        logging.debug(f'SQLiteStore.select: {sql} {params}')
+        rows = self.conn.execute(sql, params).fetchall()
+        return self.load_entries(rows) if collection == Entry else self.load_transactions(rows)
+
+    def where(self, collection, table, constraints):
+        '''
+        Helper function for select and frame.  Returns a WHERE clause for
+        a set of constraints and the list of parameters for the clause.
+        '''
+        columns = COLUMNS[collection]
+        where = []
+        params = []
+        for field, value in constraints.items():
+            if field in ['update', 'delete']:
+                continue
+            if field == 'tag':
+                neg = 'NOT ' if value.startswith('^') else ''
+                where.append(f'{neg}EXISTS (SELECT 1 FROM json_each({table}.tags) WHERE value REGEXP ?)')
+                params.append(value.removeprefix('^'))
+            elif field in ['start_date', 'end_date']:
+                op = '>=' if field == 'start_date' else '<='
+                where.append(f'{columns["date"]} {op} ?')
+                params.append(iso(value))
+            elif field in ['min_amount', 'max_amount']:
+                op = '>=' if field == 'min_amount' else '<='
+                where.append(f'{columns["amount"]} {op} ?')
+                params.append(cents(value))
+            elif field not in columns:
+                raise ValueError(f'select: unknown constraint: {field}')
+            elif field == 'date':
+                where.append(f'{columns[field]} = ?')
+                params.append(iso(value))
+            elif field == 'amount':
+                where.append(f'{columns[field]} = ?')
+                params.append(cents(value))
+            elif field == 'column':
+                where.append('col = ?')
+                params.append(Column(value).value if not isinstance(value, Column) else value.value)
+            elif columns[field] in ['account', 'pdebit', 'pcredit']:
+                sql, args = self.plan(collection, table, columns[field], value)
+                where.append(sql)
+                params += args
+            else:
+                where.append(f'{columns[field]} REGEXP ?')
+                params.append(value)
+        return (' WHERE ' + ' AND '.join(where) if where else ''), params
+
+    def distinct(self, collection, field):
+        '''
+        Return a list of the distinct values of a column (see DB.distinct).
+        '''
+        table = 'entry' if collection == Entry else 'trans'
+        return [r[0] for r in self.conn.execute(f'SELECT DISTINCT {field} FROM {table}')]
+
+    def frame(self, **constraints):
+        '''
+        Load the entries that match constraints into a Frame (see DB.frame).
+        '''
+        from .frame import Frame
+        DB.plans = []
+        sql, params = self.where(Entry, 'entry', constraints)
+        sql = f'SELECT date, amount, account, col AS column, tags FROM entry{sql}'
+        logging.debug(f'SQLiteStore.frame: {sql} {params}')
+        cursor = self.conn.execute(sql, params)
+        return Frame.from_records(
+            {'date': r[0], 'amount': r[1], 'account': r[2], 'column': r[3], 'tags': json.loads(r[4])}
+            for r in cursor
+        )
+
+    def plan(self, collection, table, column, pattern):
+        '''
+        Helper function for select.  Use the query planner to translate a pattern
+        for an account name into an SQL condition.  The distinct values of the
+        column come from DB.distinct, so they are cached with query results.
+        '''
+        if (name := DB.accounts.fullname(pattern)) and name != pattern:
+            pattern = re.escape(name)
+        values = DB.distinct(collection, column)
+        p = plan_match(column, pattern, values)
+        logging.info(f'select: {table}.{column} ~ {pattern!r}: {p.kind} {p.condition}')
+        DB.plans.append(p)
+        if names := p.condition.get('$in'):
+            return f'{column} IN ({", ".join("?" * len(names))})', names
+        if '$in' in p.condition:
+            return '0', []
+        if p.kind == 'prefix':
+            prefix = p.condition['$regex'][1:].replace('\\', '')
+            return f'{column} >= ? AND {column} < ?', [prefix, prefix + '\U0010ffff']
+        return f'{column} REGEXP ?', [pattern]
+
+    def load_entries(self, rows, transactions=None):
+        '''
+        Make Entry objects from rows of the entry table.  Each entry's tref is
+        set to its Transaction object, which is loaded with all its entries.
+        '''
+        if transactions is None:
+            ids = list({r[8] for r in rows if r[8]})
+            trows = self.fetch('trans', TRANS_FIELDS, 'id', ids)
+            transactions = {t.pk: t for t in self.load_transactions(trows)}
+            loaded = {e.pk: e for t in transactions.values() for e in t.entries}
+        else:
+            loaded = {}
+        res = []
+        for r in rows:
+            if (e := loaded.get(ObjectId(r[0]))) is None:
+                e = Entry(
+                    id=ObjectId(r[0]), uid=r[1], date=date.fromisoformat(r[2]), description=r[3],
+                    account=r[4], column=Column(r[5]), amount=Amount.from_cents(r[6]), tags=json.loads(r[7]),
+                )
+                if r[8]:
+                    e.tref = transactions.get(ObjectId(r[8]))
+                e._clear_changed_fields()
+            res.append(e)
+        return res
+
+    def load_transactions(self, rows):
+        '''
+        Make Transaction objects from rows of the trans table, with their
+        entries (fetched with one query).
+        '''
+        res = {}
+        for r in rows:
+            t = Transaction(
+                id=ObjectId(r[0]), description=r[1], comment=r[2], tags=json.loads(r[3]),
+                pdate=date.fromisoformat(r[4]) if r[4] else None, pdebit=r[5], pcredit=r[6],
+                pamount=Amount.from_cents(r[7]) if r[7] is not None else None,
+            )
+            res[str(t.pk)] = t
+        erows = self.fetch('entry', ENTRY_FIELDS, 'tref', list(res), order='tref, pos')
+        for e in self.load_entries(erows, {ObjectId(k): t for k, t in res.items()}):
+            e.tref.entries.append(e)
+        for t in res.values():
+            t._clear_changed_fields()
+        return list(res.values())
+
+    def fetch(self, table, fields, key, values, order=None):
+        '''
+        Fetch the rows where a column has one of a list of values.
+        '''
+        rows = []
+        for i in range(0, len(values), 500):
+            chunk = values[i:i+500]
+            sql = f'SELECT {fields} FROM {table} WHERE {key} IN ({", ".join("?" * len(chunk))})'
+            if order:
+                sql += f' ORDER BY {order}'
+            rows += self.conn.execute(sql, chunk).fetchall()
+        return rows
+
+    def prefetch(self, recs):
+        '''
+        References are filled in when records are loaded, so there is
+        nothing to prefetch.
+        '''
+        return list(recs)
+
+    # Balances
+
+    def column_sum(self, account, column, starting=None, ending=None, nobudget=False):
+        sql = 'SELECT SUM(amount) FROM entry WHERE account REGEXP ? AND col = ?'
+        params = [account, Column(column).value]
+        if starting:
+            sql += ' AND date >= ?'
+            params.append(iso(starting))
+        if ending:
+            sql += ' AND date <= ?'
+            params.append(iso(ending))
+        if nobudget:
+            sql += " AND NOT EXISTS (SELECT 1 FROM json_each(entry.tags) WHERE value = ?)"
+            params.append(Tag.B.value)
+        total = self.conn.execute(sql, params).fetchone()[0]
+        return Amount.from_cents(total or 0)
+
+    def balances(self, accounts, starting=None, ending=None, nobudget=False):
+        '''
+        Compute balances for a list of account patterns (see DB.balances) with
+        one query that groups amounts by account, column, and whether the date
+        is before the starting date.
+        '''
+        before = 'date < ?' if starting else '0'
+        sql = f'SELECT account, col, {before}, SUM(amount) FROM entry'
+        params = [iso(starting)] if starting else []
+        where = []
+        if ending:
+            where.append('date <= ?')
+            params.append(iso(ending))
+        if nobudget:
+            where.append('NOT EXISTS (SELECT 1 FROM json_each(entry.tags) WHERE value = ?)')
+            params.append(Tag.B.value)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' GROUP BY 1, 2, 3'
+
+        totals = {p: [0, 0, 0] for p in accounts}
+        patterns = [(p, re.compile(p, re.I)) for p in accounts]
+        for account, col, is_before, amount in self.conn.execute(sql, params):
+            for p, expr in patterns:
+                if not expr.search(account):
+                    continue
+                t = totals[p]
+                if is_before:
+                    t[0] += amount if col == Column.dr.value else -amount
+                elif col == Column.dr.value:
+                    t[1] += amount
+                else:
+                    t[2] += amount
+        return {p: Balance(*(Amount.from_cents(n) for n in t)) for p, t in totals.items()}
@@ -23,6 +23,7 @@ class cd:
 
 import calendar
 from datetime import date, datetime
+import re
 
 import logging
 from rich.logging import RichHandler
@@ -90,10 +91,103 @@ def parse_date(text):
     else:
         raise ValueError(f'parse_date: unable to parse {text}')
 
+    return complete_date(res.year, res.month, res.day)
+
+def complete_date(year, month, day):
+    '''
+    Make a date from the parts found by a parser.  If the format does not
+    have a year (the year is the strptime default, 1900) use the current
+    year if the month is not after the current month, otherwise last year.
+    '''
     today = date.today()
-    year = res.year if res.year > 1900 else today.year if res.month <= today.month else today.year - 1
+    year = year if year > 1900 else today.year if month <= today.month else today.year - 1
+
+    return date(year, month, day)
+
+def detect_date_format(text):
+    '''
+    Return the first format in date_formats that matches a string (the
+    format parse_date would use), or None if no format matches.
+    '''
+    for fmt in date_formats:
+        try:
+            datetime.strptime(text, fmt)
+            return fmt
+        except Exception:
+            pass
+    return None
 
-    return date(year, res.month, res.day)
+# Specialized parsers for the common formats in CSV files.  Each one is
+# a precompiled regular expression and a function that makes a date from
+# the groups of a match.  The expressions accept only strings that none of
+# the formats earlier in date_formats would match, so they give the same
+# result as parse_date.
+
+MONTHS = {m.lower(): i for i, m in enumerate(calendar.month_abbr) if m}
+
+DATE_PATTERNS = {
+    '%Y-%m-%d':  (re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})', re.ASCII), lambda y, m, d: (int(y), int(m), int(d))),
+    '%m/%d/%Y':  (re.compile(r'(\d{1,2})/(\d{1,2})/(\d{4})', re.ASCII), lambda m, d, y: (int(y), int(m), int(d))),
+    '%m/%d/%y':  (re.compile(r'(\d{1,2})/(\d{1,2})/(\d{2})', re.ASCII), lambda m, d, y: (int(y) + (1900 if int(y) >= 69 else 2000), int(m), int(d))),
+    '%Y%m%d':    (re.compile(r'(\d{4})(\d{2})(\d{2})', re.ASCII), lambda y, m, d: (int(y), int(m), int(d))),
+    '%b %d, %Y': (re.compile(r'([A-Za-z]{3}) (\d{1,2}), (\d{4})', re.ASCII), lambda b, d, y: (int(y), MONTHS[b.lower()], int(d))),
+}
+
+class DateParser:
+    '''
+    Parse a column of dates, e.g. the dates in a CSV file.  The format is
+    detected from the first SAMPLE values (which are parsed with parse_date).
+    If they all have the same format, the remaining values are parsed with a
+    precompiled regular expression for that format (or strptime with just
+    that format), and parse_date is used only for values that don't match.
+    If the sample has more than one format every value is parsed with
+    parse_date.  The fallbacks attribute counts values that didn't match
+    the detected format.
+    '''
+
+    SAMPLE = 5
+
+    def __init__(self):
+        self.format = None
+        self.fallbacks = 0
+        self._sample = []
+        self._parse = None
+
+    def __call__(self, text):
+        if self._parse is not None:
+            try:
+                return self._parse(text)
+            except (ValueError, TypeError, KeyError):
+                self.fallbacks += 1
+                return parse_date(text)
+        res = parse_date(text)
+        if len(self._sample) < self.SAMPLE:
+            self._sample.append(detect_date_format(text))
+            if len(self._sample) == self.SAMPLE:
+                self._choose()
+        return res
+
+    def _choose(self):
+        '''
+        Pick the routine to use for the rest of the column.
+        '''
+        formats = set(self._sample)
+        if len(formats) != 1:
+            logging.debug(f'DateParser: mixed formats {formats}')
+            return
+        self.format = fmt = formats.pop()
+        if fmt in DATE_PATTERNS:
+            expr, parts = DATE_PATTERNS[fmt]
+            def parse(text):
+                if (m := expr.fullmatch(text)) is None:
+                    raise ValueError(text)
+                return complete_date(*parts(*m.groups()))
+        else:
+            def parse(text):
+                res = datetime.strptime(text, fmt)
+                return complete_date(res.year, res.month, res.day)
+        logging.debug(f'DateParser: format {fmt}')
+        self._parse = parse
 
 def date_range(month, year=None):
     '''
@@ -105,3 +199,94 @@ def date_range(month, year=None):
     _, last = calendar.monthrange(y,m)
     return date(y,m,1), date(y,m,last)
 
+
+# UID sets
+
+class UIDSet:
+    '''
+    A compact set of Entry UIDs, used to check for duplicates when importing
+    records.  A UID is normally the MD5 hash of an entry, a string of 32 hex
+    digits, so each one is stored as 16 bytes in a single sorted bytes object
+    and membership is tested with a binary search.  Any UID that is not a
+    hex digest (e.g. from a restored database) is kept in a regular set.
+    '''
+
+    WIDTH = 16
+
+    def __init__(self, uids):
+        '''
+        Build the set.
+
+        Arguments:
+            uids:  an iterable of UID strings
+        '''
+        digests = []
+        self._other = set()
+        for uid in uids:
+            if (b := self._digest(uid)) is not None:
+                digests.append(b)
+            else:
+                self._other.add(uid)
+        digests.sort()
+        self._data = b''.join(digests)
+        self._n = len(digests)
+
+    def _digest(self, uid):
+        if len(uid) != 2*self.WIDTH or uid != uid.lower():
+            return None
+        try:
+            return bytes.fromhex(uid)
+        except ValueError:
+            return None
+
+    def __len__(self):
+        return self._n + len(self._other)
+
+    def __contains__(self, uid):
+        if (key := self._digest(uid)) is None:
+            return uid in self._other
+        w = self.WIDTH
+        lo, hi = 0, self._n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            x = self._data[mid*w:(mid+1)*w]
+            if x == key:
+                return True
+            if x < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return False
+
+# Dollar amounts
+
+def cents(x):
+    '''
+    Return the integer number of cents in a dollar amount.
+    '''
+    return x.cents if isinstance(x, Amount) else round(float(x) * 100)
+
+class Amount(float):
+    '''
+    A dollar amount that carries its exact value as an integer number of
+    cents.  An Amount can be used anywhere a float is expected (arithmetic
+    on Amounts returns a float), while sums and comparisons that need to be
+    exact can use the cents attribute.
+    '''
+
+    __slots__ = ('cents',)
+
+    def __new__(cls, value=0.0):
+        n = cents(value)
+        obj = super().__new__(cls, n / 100)
+        obj.cents = n
+        return obj
+
+    @classmethod
+    def from_cents(cls, n):
+        '''
+        Create an Amount from an integer number of cents.
+        '''
+        obj = super().__new__(cls, n / 100)
+        obj.cents = int(n)
+        return obj
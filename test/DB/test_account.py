@@ -1,9 +1,11 @@
 # Unit tests for the DB module
 
 import pytest
+import re
 
 from datetime import date
 from dexter.DB import DB, Document, Account, Category, Entry, Transaction, Column, Tag
+from dexter.directory import AccountDirectory
 
 class TestAccount:
     '''
@@ -123,3 +125,82 @@ class TestAccount:
         assert r'expenses:car:fuel$' in expenses
         assert 'expenses:car:fuel:electric' in expenses
 
+
+    @staticmethod
+    def baseline_expand(spec):
+        '''
+        The original version of DB.expand_node, a regular expression search
+        of the Account collection.
+        '''
+        node, n = re.match(r'(.*):(\d+)', spec).groups()
+        res = []
+        for acct in Account.objects(name__iregex=node):
+            m = re.search(node, acct.name, re.I)
+            post = acct.name[m.end():]
+            if post.count(':') < int(n):
+                res.append(acct.name + '$')
+            elif post.count(':') == int(n):
+                res.append(acct.name)
+        return res
+
+    specs = [
+        'expenses:1', 'expenses:2', 'food:1', 'chase:1', 'liabilities:1', 'bank:0', 'groc:0',
+        'Expenses:1', 'car:2', 'xpenses:car:1', 'es:car:f:1', ':car:1', 'expenses::1', 'e:2', 'a:0',
+        'exp.*:1', 'car|food:1', 'nothing:1',
+    ]
+
+    def test_expand_baseline(self, db):
+        '''
+        DB.expand_node should give the same patterns, in the same order, as
+        the original regular expression search of the Account collection.
+        '''
+        Account(name='expenses:car:fuel:gas', category=Category.E).save()
+        Account(name='expenses:car:carwash', category=Category.E).save()
+        for spec in self.specs:
+            assert DB.expand_node(spec) == self.baseline_expand(spec), spec
+
+    def test_expand_tree(self, db, monkeypatch):
+        '''
+        A plain string is expanded by visiting only the subtrees of the
+        matching nodes;  the regular expression scan is used only for
+        patterns with metacharacters.
+        '''
+        scans = []
+        scan = AccountDirectory._expand_regexp
+        def record(self, s, level):
+            scans.append(s)
+            return scan(self, s, level)
+        monkeypatch.setattr(AccountDirectory, '_expand_regexp', record)
+        for spec in self.specs:
+            node, n = spec.rsplit(':', 1)
+            assert DB.accounts.expand(node, int(n)) == scan(DB.accounts, node, int(n)), spec
+        assert scans == ['exp.*', 'car|food']
+
+    def test_directory_cache(self, db):
+        '''
+        Account lookups should be served by the in-memory directory, which
+        is loaded once and reloaded only after an Account is saved.
+        '''
+        DB.accounts.invalidate()
+        misses = DB.accounts.misses
+        for _ in range(10):
+            assert DB.abbrev('expenses:food:groceries') == 'groceries'
+            assert DB.fullname('dining') == 'expenses:food:restaurant'
+        assert DB.accounts.misses == misses + 1
+        assert DB.accounts.hits >= 19
+
+        Account(name='expenses:car:insurance', category=Category.E, abbrev='insurance').save()
+        assert DB.fullname('insurance') == 'expenses:car:insurance'
+        assert DB.accounts.misses == misses + 2
+
+    def test_account_tree(self, db):
+        '''
+        Test the methods that use the account tree:  prefix completion,
+        the accounts below a node, and totals for each node.
+        '''
+        assert DB.complete_account('expenses:f') == ['expenses:food', 'expenses:food:groceries', 'expenses:food:restaurant']
+        assert DB.complete_account('expenses:x') == []
+        assert DB.subaccounts('liabilities:chase') == ['liabilities:chase:visa']
+        totals = DB.rollup({'expenses:food:groceries': 10, 'expenses:food:restaurant': 5, 'expenses:car': 1})
+        assert totals['expenses:food'] == 15
+        assert totals['expenses'] == 16
@@ -0,0 +1,117 @@
+# Unit tests for the query result cache
+
+import pytest
+
+from dexter.cache import ResultCache
+from dexter.config import Config
+from dexter.DB import DB, Entry, Transaction, Column
+
+@pytest.fixture
+def cache(monkeypatch):
+    '''
+    Enable the result cache with room for 8 results.
+    '''
+    monkeypatch.setattr(Config.DB, 'cache_size', 8)
+    monkeypatch.setattr(DB, 'results', ResultCache(8))
+    return DB.results
+
+class TestCache:
+    '''
+    Results of select, column_sum, and balances are saved in the cache
+    and discarded by every method that writes entries or transactions.
+    '''
+
+    def test_lru(self, db, monkeypatch):
+        '''
+        Repeated queries are answered from the cache until a write invalidates
+        them, and the least recently used result is evicted when the cache
+        is full.
+        '''
+        monkeypatch.setattr(DB, 'results', ResultCache(2))
+        a = DB.select(Entry, account='groceries')
+        assert DB.select(Entry, account='groceries') == a
+        b = DB.balances(['groceries'])
+        assert DB.balances(['groceries']) is b
+        assert DB.results.stats['hits'] == 2
+        DB.column_sum('groceries', Column.dr)
+        assert len(DB.results) == 2 and DB.results.evictions == 1
+        e = a[0]
+        e.amount = e.amount + 1
+        DB.save_records([e])
+        assert len(DB.results) == 0
+        assert DB.balances(['groceries'])['groceries'].debits == b['groceries'].debits + 1
+
+    def test_materialized(self, db, cache):
+        '''
+        A cached select result is a list of documents, so using it again
+        does not send any commands to the server.  Each caller gets its own
+        copy of the list.
+        '''
+        DB.monitor.reset()
+        DB.monitor.count = True
+        a = DB.select(Entry, account='groceries')
+        trips = DB.monitor.round_trips
+        b = DB.select(Entry, account='groceries')
+        amounts = [x.amount for x in b]
+        DB.monitor.count = False
+        assert DB.monitor.round_trips == trips and len(amounts) == len(a)
+        assert isinstance(b, list) and b == a and b is not a
+        b.clear()
+        assert len(DB.select(Entry, account='groceries')) == len(a)
+
+    def test_plans(self, db, cache):
+        '''
+        The query plans of a select are restored when its result is found
+        in the cache.
+        '''
+        DB.select(Transaction, debit='groceries')
+        plans = [p.condition for p in DB.plans]
+        assert plans
+        DB.select(Entry, account='checking')
+        DB.select(Transaction, debit='groceries')
+        assert DB.results.hits == 1
+        assert [p.condition for p in DB.plans] == plans
+
+    def test_invalidate(self, db, cache):
+        '''
+        Every way of writing entries or transactions discards cached
+        results for both collections.
+        '''
+        t = Transaction.objects(description='Safeway')[0]
+        e, other = t.entries[0], t.entries[1]
+        writes = [
+            lambda: e.update(add_to_set__tags='#cached'),
+            lambda: DB.bulk_update(Entry, DB.query(Entry, account='groceries'), ('tag', '#bulk')),
+            lambda: DB.bulk_update(Transaction, DB.query(Transaction, description='Safeway'), ('comment', 'x')),
+            lambda: other.save(),
+            lambda: DB.save_records([t]),
+            lambda: t.delete(),
+            lambda: DB.bulk_delete(Entry, DB.query(Entry, uid=e.uid)),
+        ]
+        for write in writes:
+            DB.select(Entry, account='groceries')
+            DB.select(Transaction, description='Safeway')
+            assert len(DB.results) == 2
+            write()
+            assert len(DB.results) == 0
+        assert t.id not in [x.id for x in DB.select(Transaction, description='Safeway')]
+
+    def test_distinct(self, db, cache):
+        '''
+        The distinct values used to plan account constraints are read once
+        and reused, including by queries for updates, until entries are
+        written.
+        '''
+        def distinct():
+            return sum(n for (name, _, _), n in DB.monitor.commands.items() if name == 'distinct')
+        DB.monitor.reset()
+        DB.monitor.count = True
+        DB.select(Transaction, debit='groceries', credit='checking')
+        assert distinct() == 2
+        DB.select(Transaction, debit='groceries', credit='visa')
+        DB.query(Transaction, debit='groceries')
+        DB.select(Entry, account='groceries', update=('tag', '#distinct'))
+        assert distinct() == 3
+        DB.select(Entry, account='groceries')
+        assert distinct() == 4
+        DB.monitor.count = False
@@ -3,6 +3,7 @@
 import pytest
 
 from datetime import date
+from dexter.config import Config
 from dexter.DB import DB, Document, Account, Category, Entry, Transaction, Column, Tag
 
 class TestDB:
@@ -33,3 +34,29 @@ class TestDB:
         assert db.command('count','account')['n'] == 15
         assert db.command('count','entry')['n'] == 58
         assert db.command('count','transaction')['n'] == 25
+
+    def test_indexes(self, db):
+        '''
+        After creating indexes none of the declared indexes should be
+        missing, and the list should include the compound entry index.
+        '''
+        DB.create_indexes()
+        assert all(len(lst) == 0 for lst in DB.missing_indexes().values())
+        keys = [(coll, tuple(k)) for coll, _, k, _ in DB.index_info()]
+        assert ('entry', ('account', 'column', 'date')) in keys
+        assert ('transaction', ('pdate',)) in keys
+
+    def test_registry(self, db, tmp_path, monkeypatch):
+        '''
+        Database names found by a scan are saved in the registry file,
+        and a name in the registry that is no longer a Dexter database
+        is removed when it is checked.
+        '''
+        monkeypatch.setattr(Config.DB, 'registry', str(tmp_path / 'databases'))
+        DB.scan()
+        assert 'pytest' in DB.read_registry()
+        DB.dexters.add('no_such_db')
+        monkeypatch.setattr(DB, 'scanned', False)
+        assert not DB.exists('no_such_db')
+        assert 'no_such_db' not in DB.read_registry()
+        assert DB.exists('pytest')
@@ -18,6 +18,16 @@ class TestEntry:
         uids = DB.uids()
         assert len(uids) == db.command('count','entry')['n']
 
+    def test_compact_uids(self, db):
+        '''
+        The compact UID set should have the same members as the regular set
+        '''
+        uids = DB.uids()
+        compact = DB.uids(compact=True)
+        assert len(compact) == len(uids)
+        assert all(u in compact for u in uids)
+        assert '0' * 32 not in compact
+
     def test_select_entries(self, db):
         '''
         Test the select method, fetching individual entries that match constraints
@@ -113,6 +123,54 @@ class TestEntry:
         assert DB.balance('expenses:food', ending='2024-01-31') == -250
         assert DB.balance('expenses:food', ending='2024-01-31', nobudget=True) == 250
 
+    def test_select_plans(self, db):
+        '''
+        The query planner should replace account and tag patterns with
+        conditions that select the same entries as the regular expressions.
+        '''
+        for pattern, kind in [('expenses:food:groceries', 'exact'), ('expenses:food', 'prefix'), ('car|food', 'in'), ('dining', 'exact')]:
+            lst = DB.select(Entry, account=pattern)
+            assert DB.plans[0].kind == kind
+            expr = 'expenses:food:restaurant' if pattern == 'dining' else pattern
+            assert {e.id for e in lst} == {e.id for e in Entry.objects(account__iregex=expr)}
+        lst = DB.select(Entry, tag='^unpaired')
+        assert {e.id for e in lst} == {e.id for e in Entry.objects(tags__not__iregex='unpaired')}
+
+    def test_balances(self, db):
+        '''
+        The aggregation that computes several balances at once should agree
+        with the column sums for each account.
+        '''
+        accounts = ['expenses:food', 'groceries', 'checking']
+        start, end = date(2024,2,1), date(2024,2,29)
+        for nobudget in [False, True]:
+            dct = DB.balances(accounts, starting=start, ending=end, nobudget=nobudget)
+            for a in accounts:
+                b = dct[a]
+                assert b.starting == DB.balance(a, ending=date(2024,1,31), nobudget=nobudget)
+                assert b.debits == DB.column_sum(a, Column.dr, starting=start, ending=end, nobudget=nobudget)
+                assert b.credits == DB.column_sum(a, Column.cr, starting=start, ending=end, nobudget=nobudget)
+
+    def test_snapshots(self, db):
+        '''
+        Snapshots updated by save, update, and delete should have the same
+        totals as snapshots rebuilt from scratch.
+        '''
+        def totals():
+            return {(s['account'], s['month'], s['column'], s['budget']): s['total']
+                for s in DB.snapshots.collection.find() if s['total']}
+
+        e = Entry.objects(account='expenses:food:groceries').first()
+        e.amount += 10
+        e.date = date(2023,12,15)
+        e.save()
+        Entry.objects(account='expenses:food:restaurant').first().update(push__tags=Tag.B.value)
+        Entry.objects(account='expenses:car:fuel').first().delete()
+        DB.save_records([Entry(date=date(2024,3,1), account='expenses:travel', column=Column.dr, amount=50)])
+        incremental = totals()
+        DB.rebuild_snapshots()
+        assert totals() == incremental
+
     def test_entry_audit(self, db):
         '''
         Test the method that checks for inconsistencies in Entry objects.
@@ -141,3 +199,72 @@ class TestEntry:
             DB.validate_entry(e)
         assert "not linked to parent" in str(err.value)
 
+
+    def test_validate(self, db):
+        '''
+        The audit of the whole database should find no errors in the test
+        data, then find the errors introduced by changing documents.
+        '''
+        assert DB.validate(Transaction) == []
+        assert DB.validate(Entry) == []
+
+        t = Transaction.objects(description='Safeway')[0]
+        e = t.entries[0]
+        db.entry.update_one({'_id': e.id}, {'$set': {'amount': 20000}})
+        db.entry.update_one({'_id': t.entries[1].id}, {'$unset': {'tref': 1}})
+
+        assert [(x.id, r) for x, r in DB.validate(Transaction)] == [(t.id, 'unbalanced')]
+        assert [(x.id, r) for x, r in DB.validate(Entry)] == [(t.entries[1].id, 'missing tref in entry')]
+
+    def test_cents(self, db):
+        '''
+        Amounts are stored as integer numbers of cents, and older documents
+        with doubles are converted by the migration.
+        '''
+        e = Entry.objects(account='expenses:food:groceries').first()
+        assert isinstance(db.entry.find_one({'_id': e.id})['amount'], int)
+        assert e.amount.cents == round(e.amount * 100)
+
+        db.entry.update_one({'_id': e.id}, {'$set': {'amount': 0.1 + 0.2}})
+        DB.migrate_amounts()
+        assert db.entry.find_one({'_id': e.id})['amount'] == 30
+        assert Entry.objects(id=e.id).first().amount == 0.3
+
+    def test_upgrade(self, db):
+        '''
+        A database with an older schema can't be opened until it is upgraded,
+        and an upgrade in preview mode counts the values without changing them.
+        '''
+        e = Entry.objects(account='expenses:food:groceries').first()
+        db.entry.update_one({'_id': e.id}, {'$set': {'amount': 0.1 + 0.2}})
+        db.dexter.update_one({}, {'$set': {'schema': 1}})
+        with pytest.raises(ValueError):
+            DB.open('pytest')
+
+        DB.open('pytest', upgrade=True)
+        assert DB.upgrade(preview=True) == {'entry.amount': 1, 'transaction.pamount': 0}
+        assert isinstance(db.entry.find_one({'_id': e.id})['amount'], float)
+        assert DB.schema() == 1
+
+        assert DB.upgrade() == {'entry.amount': 1, 'transaction.pamount': 0}
+        assert db.entry.find_one({'_id': e.id})['amount'] == 30
+        assert DB.schema() == DB.SCHEMA
+        assert DB.upgrade() == {}
+        DB.open('pytest')
+
+    def test_explain(self, db):
+        '''
+        Queries are recorded while capture is on and explain reports how
+        each one was executed.
+        '''
+        DB.monitor.reset()
+        DB.monitor.capture = True
+        lst = list(DB.select(Entry, account='expenses:food'))
+        DB.balances(['groceries'])
+        plans = DB.explain()
+        assert not DB.monitor.capture
+        ops = [(q.collection, q.operation) for q, _ in plans]
+        assert ops.count(('entry', 'find')) == 1 and ('entry', 'distinct') in ops and ('snapshot', 'aggregate') in ops
+        q, plan = next(x for x in plans if x[0].operation == 'find' and x[0].collection == 'entry')
+        assert q.collection == 'entry' and q.returned == len(lst)
+        assert plan['index'] != 'COLLSCAN' and plan['examined'] == len(lst)
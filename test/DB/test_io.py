@@ -0,0 +1,136 @@
+# Unit tests for importing CSV files
+
+import logging
+import pytest
+import re
+
+from argparse import Namespace
+from dexter.config import Config, EXTRACTED_FIELDS, compile_specs, compile_extractor, find_toml_file, load_toml_file
+from dexter.DB import DB, Entry
+from dexter.io import import_records, parse_csv_transactions, iter_csv_transactions
+
+@pytest.fixture
+def colmaps(monkeypatch):
+    '''
+    Compile the column mappings in the configuration file that worker
+    processes will read.
+    '''
+    monkeypatch.setattr(Config.CSV, 'colmaps', {})
+    monkeypatch.setattr(Config.CSV, 'specs', {})
+    config = load_toml_file(find_toml_file(None))
+    for fmt, spec in config['csv'].items():
+        compile_specs(fmt, spec)
+    return Config.CSV.specs
+
+def write_csv(path, rows):
+    path.write_text('\n'.join(['Post Date,Description,Amount,Type'] + rows) + '\n')
+    return path
+
+def column_value(name, amount, description):
+    '''
+    Make a value for a CSV column, based on its name.
+    '''
+    if 'Date' in name:
+        return '01/05/2024'
+    if 'Amount' in name:
+        return amount
+    if name == 'Debit':
+        return amount.removeprefix('-') if amount.startswith('-') else ''
+    if name == 'Credit':
+        return '' if amount.startswith('-') else amount
+    if name in ['Type', 'Category']:
+        return 'Payment' if 'PAYMENT' in description else 'Sale'
+    return description
+
+class TestImport:
+    '''
+    Test the CSV import pipeline.
+    '''
+
+    def test_extractor(self, colmaps):
+        '''
+        For every configured format, the compiled extractor returns the same
+        values as calling the colmap functions with a dictionary for each row.
+        '''
+        assert colmaps
+        for fmt, specs in colmaps.items():
+            names = sorted({name for expr in specs.values() for name in re.findall(r'rec\["([^"]+)"\]', expr)})
+            header = ['Extra'] + names[::-1]
+            rows = [
+                [column_value(name, amount, description) for name in header]
+                for amount, description in [('-4.50', 'Coffee'), ('100.00', 'AUTOPAY PAYMENT'), ('12.25', 'Refund')]
+            ]
+            for card in [False, True] if 'payment' in specs else [False]:
+                extract = compile_extractor(fmt, header, card)
+                for row in rows:
+                    rec = dict(zip(header, row))
+                    expected = tuple(
+                        Config.CSV.colmaps[fmt][f](rec) if (f != 'payment' or card) else False
+                        for f in EXTRACTED_FIELDS
+                    )
+                    assert extract(row) == expected, (fmt, card, row)
+
+    def test_batches(self, db, colmaps, tmp_path, monkeypatch):
+        '''
+        Entries are generated one batch at a time, a duplicate in a later batch
+        is numbered after the ones in earlier batches, and the UIDs match the
+        ones assigned to the whole file at once.  Entries already in the
+        database are skipped.
+        '''
+        rows = ['01/10/2024,Coffee,-4.50,Sale'] * 3 + ['01/11/2024,Payment,100.00,Payment', '01/12/2024,Coffee,-4.50,Sale']
+        rows += ['Post Date,Description,Amount,Type', '01/10/2024,Coffee,-4.50,Sale']
+        fn = write_csv(tmp_path / 'visa.csv', rows)
+        args = (fn, 'chase', 'liabilities:chase:visa', None, None)
+        lst = parse_csv_transactions(*args, set())
+        assert [e.description for e in lst] == ['Coffee', 'Coffee (1)', 'Coffee (2)', 'Payment', 'Coffee', 'Coffee (3)']
+        assert lst[3].tags == ['#unpaired', '#payment']
+
+        batches = []
+        assign = DB.assign_uids
+        def record(recs, uids=None):
+            batches.append(len(recs))
+            return assign(recs, uids)
+        monkeypatch.setattr(DB, 'assign_uids', staticmethod(record))
+        gen = iter_csv_transactions(*args, set(), batch_size=2)
+        first = next(gen)
+        assert batches == [2]
+        res = [first] + list(gen)
+        assert batches == [2, 2, 2]
+        assert [e.uid for e in res] == [e.uid for e in lst]
+        assert [e.description for e in res] == [e.description for e in lst]
+
+        DB.save_records(lst[:2])
+        assert [e.description for e in iter_csv_transactions(*args, DB.uids())] == ['Payment', 'Coffee']
+
+    def test_jobs(self, db, colmaps, tmp_path, caplog):
+        '''
+        Parsing files in worker processes merges the entries from all the
+        files before saving them.  An entry in the second file with the same
+        UID as one in the first is numbered after it, so the result is the
+        same for any number of workers.
+        '''
+        files = [
+            write_csv(tmp_path / 'first.csv', ['01/10/2024,Coffee,-4.50,Sale', '01/11/2024,Payment,100.00,Payment']),
+            write_csv(tmp_path / 'second.csv', ['01/10/2024,Coffee,-4.50,Sale', '01/12/2024,Lunch,-12.00,Sale']),
+        ]
+        before = DB.uids()
+        results = []
+        for jobs in [2, 3]:
+            args = Namespace(
+                dbname='pytest', files=files, account='visa', start_date=None, end_date=None,
+                regexp=False, extract_text=False, preview=False, jobs=jobs, config=None,
+            )
+            caplog.clear()
+            with caplog.at_level(logging.INFO):
+                import_records(args)
+            new = list(DB.uids() - before)
+            entries = sorted((e.uid, e.date, e.description, e.amount, e.column, e.tags) for e in Entry.objects(uid__in=new))
+            messages = [(r.levelname, r.getMessage()) for r in caplog.records if r.levelno >= logging.INFO]
+            results.append((entries, messages))
+            DB.bulk_delete(Entry, {'uid': {'$in': new}})
+
+        assert results[0] == results[1]
+        entries, messages = results[0]
+        assert sorted(x[2] for x in entries) == ['Coffee', 'Coffee (1)', 'Lunch', 'Payment']
+        assert not [m for level, m in messages if level == 'ERROR']
+        assert ('INFO', 'import: 4 new records') in messages
@@ -0,0 +1,96 @@
+# Unit tests for DB.save_records
+
+import logging
+import pytest
+
+from collections import Counter
+from datetime import date
+from dexter.cache import ResultCache
+from dexter.DB import DB, Account, Category, Entry, Transaction, Column
+
+def entry(uid, amount, account='expenses:food:groceries', column=Column.dr):
+    return Entry(uid=uid, date=date(2024,3,2), description='Bulk', account=account, column=column, amount=amount)
+
+class TestSaveRecords:
+    '''
+    save_records writes each collection with one bulk write, after giving
+    new objects their ObjectIds.
+    '''
+
+    def test_links(self, db):
+        '''
+        Entries and their transaction are linked in both directions after
+        one bulk insert per collection.
+        '''
+        t = Transaction(description='Bulk')
+        t.entries = [entry('bulk-1', 20), entry('bulk-2', 20, 'assets:bank:checking', Column.cr)]
+        DB.monitor.reset()
+        DB.monitor.count = True
+        DB.save_records([t])
+        DB.monitor.count = False
+        inserts = Counter()
+        for (name, collection, _), n in DB.monitor.commands.items():
+            if name == 'insert':
+                inserts[collection] += n
+        assert inserts == {'entry': 1, 'transaction': 1}
+
+        assert t.id is not None and all(e.id is not None for e in t.entries)
+        assert db.transaction.find_one({'_id': t.id})['entries'] == [e.id for e in t.entries]
+        for e in t.entries:
+            assert db.entry.find_one({'_id': e.id})['tref'] == t.id
+        saved = Transaction.objects(id=t.id).first()
+        assert saved.pamount == 20 and saved.pdebit == 'expenses:food:groceries'
+
+    def test_duplicate(self, db, caplog):
+        '''
+        An entry with a duplicate UID is logged and skipped while the rest
+        of the batch is saved.  Objects that fail validation or have no
+        changes are not sent, so the error must be matched to the right
+        object.  A transaction with an entry that was not saved is skipped
+        and its other entries are unlinked.
+        '''
+        existing = Entry.objects(account='expenses:food:groceries').first()
+        unchanged = Entry.objects(account='assets:bank:checking').first()
+        invalid = Entry(uid='invalid', date=date(2024,3,2), account='expenses:food:groceries', amount=5)
+        first, dup, last = entry('new-1', 1), entry(existing.uid, 2), entry('new-2', 3)
+        with caplog.at_level(logging.ERROR):
+            DB.save_records([invalid, unchanged, first, dup, last])
+        errors = [r.getMessage() for r in caplog.records if r.levelno == logging.ERROR]
+        assert len(errors) == 2
+        assert errors[1].endswith(f'saving {dup}') and 'duplicate key' in errors[1]
+        assert first.id is not None and last.id is not None
+        assert dup.id is None and invalid.id is None
+        assert Entry.objects(uid__in=['new-1', 'new-2']).count() == 2
+        assert Entry.objects(uid=existing.uid).count() == 1
+
+        t = Transaction(description='Bulk')
+        t.entries = [entry(existing.uid, 4), entry('new-3', 4, 'assets:bank:checking', Column.cr)]
+        n = Transaction.objects.count()
+        DB.save_records([t])
+        assert t.id is None and Transaction.objects.count() == n
+        assert 'tref' not in db.entry.find_one({'uid': 'new-3'})
+
+    def test_updates(self, db, monkeypatch):
+        '''
+        Saving records updates the account directory and the monthly
+        snapshots and discards cached results.
+        '''
+        monkeypatch.setattr(DB, 'results', ResultCache(8))
+        before = DB.balances(['expenses:food'])
+        DB.select(Entry, account='groceries')
+        assert len(DB.results) == 2
+
+        acct = Account(name='expenses:food:snacks', category=Category.E, abbrev='snacks')
+        DB.save_records([acct, entry('snack-1', 7, 'expenses:food:snacks')])
+        assert len(DB.results) == 0
+        assert [a.name for a in DB.find_account('snacks')] == ['expenses:food:snacks']
+        assert DB.balances(['expenses:food'])['expenses:food'].debits == before['expenses:food'].debits + 7
+
+        def totals():
+            return {(s['account'], s['month'], s['column'], s['budget']): s['total']
+                for s in DB.snapshots.collection.find() if s['total']}
+
+        incremental = totals()
+        assert any(k[0] == 'expenses:food:snacks' for k in incremental)
+        DB.rebuild_snapshots()
+        assert totals() == incremental
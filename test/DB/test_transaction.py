@@ -121,3 +121,98 @@ class TestTransaction:
             DB.validate_transaction(t)
         assert "unbalanced" in str(err.value)
 
+
+    def test_prefetch(self, db):
+        '''
+        After prefetching, the tref of each entry and the entries of its
+        transaction should be documents instead of references, and the
+        entry should be the same object as the one in its transaction.
+        '''
+        lst = DB.prefetch(DB.select(Entry, account='groceries'))
+        assert len(lst) > 0
+        for e in lst:
+            t = e._data['tref']
+            assert isinstance(t, Transaction)
+            assert all(isinstance(x, Entry) for x in t._data['entries'])
+            assert any(x is e for x in t.entries)
+
+        lst = DB.prefetch(DB.select(Transaction, description='Safeway'))
+        for t in lst:
+            assert all(x._data['tref'] is t for x in t.entries)
+
+    def test_round_trips(self, db):
+        '''
+        Printing rows of prefetched entries should not make a query for each
+        row, while dereferencing each tref separately is reported as an N+1
+        pattern.
+        '''
+        DB.monitor.reset()
+        DB.monitor.count = True
+        lst = DB.prefetch(DB.select(Entry, account='groceries'))
+        rows = [e.row() for e in lst]
+        assert len(rows) > 1
+        assert DB.monitor.repeated(threshold=2) == []
+        trips = DB.monitor.round_trips
+        for e in Entry.objects(account='expenses:food:groceries'):
+            e.tref.description
+        DB.monitor.count = False
+        assert DB.monitor.round_trips > trips + len(lst)
+        n, name, collection, site, _ = DB.monitor.repeated(threshold=2)[0]
+        assert (name, collection) == ('find', 'transaction') and n >= len(lst)
+        assert site.startswith('test_transaction.py')
+
+    def test_bulk_update(self, db):
+        '''
+        Adding a tag with a bulk update should not add it again to records
+        that already have it, and preview mode should count without changing.
+        '''
+        query = DB.query(Transaction, description='Safeway')
+        n = db.transaction.count_documents(query)
+        assert DB.bulk_update(Transaction, query, ('tag', '#test'), preview=True) == (n, n)
+        assert DB.bulk_update(Transaction, query, ('tag', '#test')) == (n, n)
+        assert DB.bulk_update(Transaction, query, ('tag', '#test')) == (n, 0)
+        assert all(t.tags.count('#test') == 1 for t in Transaction.objects(description='Safeway'))
+
+    def test_bulk_delete(self, db):
+        '''
+        Deleting transactions unlinks their entries and tags them as unpaired.
+        '''
+        t = Transaction.objects(description='Safeway')[0]
+        eids = [e.id for e in t.entries]
+        query = DB.query(Transaction, description='Safeway', date=t.pdate)
+        preview = DB.bulk_delete(Transaction, query, preview=True)
+        assert Transaction.objects(id=t.id).count() == 1
+        counts = DB.bulk_delete(Transaction, query)
+        assert counts == preview
+        assert Transaction.objects(id=t.id).count() == 0
+        for e in Entry.objects(id__in=eids):
+            assert e.tref is None
+            assert Tag.U.value in e.tags
+
+    def test_bulk_delete_entry(self, db):
+        '''
+        Deleting an entry removes it from its transaction and leaves the
+        other entries linked.  With cascade the transaction is deleted and
+        the other entries are unlinked.
+        '''
+        t = Transaction.objects(description='Safeway')[0]
+        e, other = t.entries[0], t.entries[1]
+        query = DB.query(Entry, uid=e.uid)
+        preview = DB.bulk_delete(Entry, query, preview=True)
+        assert preview == {'transaction': 0, 'entry': 1, 'unlinked': 0, 'updated': 1}
+        assert DB.bulk_delete(Entry, query) == preview
+        t.reload()
+        assert [x.id for x in t.entries] == [other.id]
+        assert t.pdate == other.date
+        other.reload()
+        assert other.tref.id == t.id and Tag.U.value not in other.tags
+
+        t = Transaction.objects(description='Safeway')[1]
+        eids = [x.id for x in t.entries]
+        query = DB.query(Entry, uid=t.entries[0].uid)
+        preview = DB.bulk_delete(Entry, query, preview=True, cascade=True)
+        assert preview == {'transaction': 1, 'entry': 1, 'unlinked': len(eids) - 1, 'updated': 0}
+        assert DB.bulk_delete(Entry, query, cascade=True) == preview
+        assert Transaction.objects(id=t.id).count() == 0
+        for x in Entry.objects(id__in=eids[1:]):
+            assert x.tref is None and Tag.U.value in x.tags
@@ -1,9 +1,11 @@
 # Unit tests for the io module
 
+import io
 import pytest
 
 from dexter.io import parse_journal
 from dexter.DB import DB
+from dexter.util import DateParser, parse_date
 
 @pytest.fixture
 def iodb(scope='module'):
@@ -24,3 +26,36 @@ class TestIO:
 
     def test_one(self, iodb):
         assert 6*7 == 42
+
+    def test_date_parser(self):
+        '''
+        A DateParser should give the same results as parse_date, using the
+        format detected from the first values and parse_date for values in
+        other formats.
+        '''
+        column = ['1/5/2024', '1/12/2024', '12/31/2023', '2/29/2024', '3/1/2024', '4/7/24', 'Aug 8, 2024', '4/17/2024']
+        parse = DateParser()
+        assert [parse(s) for s in column] == [parse_date(s) for s in column]
+        assert parse.format == '%m/%d/%Y' and parse.fallbacks == 2
+        with pytest.raises(ValueError):
+            parse('2/30/2024')
+        parse = DateParser()
+        assert [parse(s) for s in column[5:] * 2] == [parse_date(s) for s in column[5:] * 2]
+        assert parse.format is None
+
+    def test_save_and_restore(self, iodb, monkeypatch):
+        '''
+        Save the database to a text file, erase it, and restore it from
+        the file.  Use a small batch size so there are several batches.
+        '''
+        counts = {c: iodb[c].count_documents({}) for c in DB.collections}
+        f = io.StringIO()
+        DB.save_as_json(f)
+        assert len(f.getvalue().splitlines()) == sum(counts.values())
+
+        DB.erase_database()
+        monkeypatch.setattr(DB, 'BATCH_SIZE', 10)
+        f.seek(0)
+        DB.restore_from_file(f)
+        assert {c: iodb[c].count_documents({}) for c in DB.collections} == counts
+        assert all(len(lst) == 0 for lst in DB.missing_indexes().values())
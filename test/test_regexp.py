@@ -6,6 +6,7 @@ from typing import NamedTuple
 
 from dexter.io import parse_journal, parse_csv_regexp
 from dexter.DB import DB, RegExp, Action
+from dexter.rules import RuleSet, compile_rule
 
 class Args(NamedTuple):
     files: list
@@ -104,3 +105,53 @@ class TestRegExp:
             assert e.acct == acct
 
     
+    def test_ruleset(self, redb, descriptions):
+        '''
+        The compiled rules are fetched once and reused until the RegExp
+        collection changes.
+        '''
+        rules = DB.rules()
+        assert len(rules.rules(Action.T)) == 5
+        for s in descriptions:
+            DB.find_first_regexp(s, Action.T)
+        assert DB.rules() is rules
+
+        DB.delete_regexps()
+        assert DB.rules() is not rules
+        assert DB.find_first_regexp(descriptions[0], Action.T) is None
+
+    def test_literals(self):
+        '''
+        Test the method that finds the longest required literal in a pattern.
+        '''
+        assert compile_rule('CHEVRON', '').literal == 'chevron'
+        assert compile_rule('.*COMCAST', '').literal == 'comcast'
+        assert compile_rule(r'Check # (\d+)', '').literal == 'check # '
+        assert compile_rule('(?:ABC)+x?', '').literal == 'abc'
+        assert compile_rule('SAFEWAY|FRED MEYER', '').literal == ''
+
+    def test_bad_rules(self):
+        '''
+        Rules with an invalid pattern or an unknown transform are skipped,
+        the other rules are still used.
+        '''
+        docs = [
+            RegExp(action=Action.T, expr='CHEVRON(', repl='Chevron', acct='car'),
+            RegExp(action=Action.T, expr='SAFEWAY', repl='{0.upper}', acct='food'),
+            RegExp(action=Action.T, expr='COSTCO', repl='Costco', acct='food'),
+        ]
+        rules = RuleSet(docs)
+        assert rules.skipped == docs[:2]
+        assert rules.find_first('COSTCO WHSE #0017', Action.T) is docs[2]
+        assert rules.find_first('CHEVRON 0092601', Action.T) is None
+
+    def test_index(self, redb, descriptions):
+        '''
+        The indexed search should find the same rules as a linear scan
+        while trying fewer of them.
+        '''
+        linear = RuleSet(RegExp.objects, indexed=False)
+        indexed = RuleSet(RegExp.objects)
+        for s in descriptions + ['MegaBox Store']:
+            assert linear.find_first(s, Action.T) == indexed.find_first(s, Action.T)
+        assert indexed.tried < linear.tried
@@ -0,0 +1,146 @@
+# Unit tests for the SQLite storage backend
+
+import pytest
+import sys
+
+from datetime import date
+from dexter.config import Config
+from dexter.DB import DB, Entry, Transaction, Column, Category
+from dexter.main import init_cli
+from dexter.io import parse_journal
+
+@pytest.fixture
+def sqldb(tmp_path, monkeypatch):
+    '''
+    Create an SQLite database in a temporary directory and load the
+    example data.
+    '''
+    monkeypatch.setattr(Config.DB, 'backend', 'sqlite')
+    monkeypatch.setattr(Config.DB, 'path', str(tmp_path / '{name}.sqlite'))
+    DB.init()
+    DB.create('pytest')
+    accts, trans = parse_journal('test/fixtures/demo.journal', set(), set())
+    DB.save_records(accts)
+    DB.save_records(trans)
+    yield DB.store
+    DB.store.close()
+    DB.store = None
+
+def dex(monkeypatch, *argv):
+    '''
+    Run a dex command with the arguments in argv.
+    '''
+    monkeypatch.setattr(sys, 'argv', ['dex', '--dbname', 'pytest', *argv])
+    args = init_cli()
+    args.dispatch(args)
+
+class TestSQLite:
+    '''
+    The SQLite backend should give the same results as MongoDB for the
+    methods in the storage interface.
+    '''
+
+    def test_open(self, sqldb):
+        assert DB.exists('pytest')
+        assert sqldb.conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert len(DB.accounts.accounts()) == 15
+        assert len(DB.uids()) == 58
+        DB.open('pytest')
+        assert len(DB.select(Transaction)) == 25
+
+    def test_select(self, sqldb):
+        lst = DB.select(Entry, account='expenses:food', start_date=date(2024,1,5))
+        assert len(lst) > 0
+        assert all(e.account.startswith('expenses:food') and e.date >= date(2024,1,5) for e in lst)
+        assert DB.plans[0].kind == 'prefix'
+        for e in lst:
+            if e.tref:
+                assert e in e.tref.entries
+        assert all(t.pdebit == 'expenses:food:groceries' for t in DB.select(Transaction, debit='groceries'))
+
+    def test_balances(self, sqldb):
+        accounts = ['expenses:food', 'groceries', 'checking']
+        start, end = date(2024,2,1), date(2024,2,29)
+        dct = DB.balances(accounts, starting=start, ending=end)
+        for a in accounts:
+            b = dct[a]
+            assert b.starting == DB.balance(a, ending=date(2024,1,31))
+            assert b.debits == DB.column_sum(a, Column.dr, starting=start, ending=end)
+            assert b.credits == DB.column_sum(a, Column.cr, starting=start, ending=end)
+
+    def test_duplicate(self, sqldb):
+        '''
+        A transaction with an entry that has a duplicate UID is not saved.
+        '''
+        t = DB.select(Transaction)[0]
+        uid = t.entries[0].uid
+        new = Transaction(description='copy')
+        for e in t.entries:
+            new.entries.append(Entry(uid=e.uid, date=e.date, account=e.account, column=e.column, amount=e.amount))
+        DB.save_records([new])
+        assert new.id is None
+        assert len(DB.select(Transaction)) == 25
+        assert uid in DB.uids()
+
+    def test_frame(self, sqldb):
+        '''
+        Totals computed from a frame should match the entries they came from.
+        '''
+        np = pytest.importorskip('numpy')
+        lst = DB.select(Entry, account='expenses')
+        f = DB.frame(account='expenses')
+        assert len(f) == len(lst)
+        assert f.amount.dtype == np.int64 and f.date.dtype == np.dtype('datetime64[D]')
+        totals = f.by_account()
+        for a in totals:
+            assert totals[a] == sum(e.cents if e.column == Column.dr else -e.cents for e in lst if e.account == a)
+        months, sums = f.by_period('M')
+        assert sums.sum() == sum(totals.values())
+        assert str(months[0]) == str(min(e.date for e in lst))[:7]
+        dates, running = f.running_balance()
+        assert running[-1] == sum(totals.values())
+        assert all(dates[:-1] <= dates[1:])
+        budget = f.has_tag('#budget')
+        assert budget.sum() == sum('#budget' in e.tags for e in lst)
+        assert len(f.subset(~budget)) == len(lst) - budget.sum()
+
+    def test_commands(self, sqldb, monkeypatch, capsys):
+        '''
+        Commands that read records work with SQLite, and commands that are
+        implemented only for MongoDB fail with a ValueError before they
+        change anything.
+        '''
+        dex(monkeypatch, 'report', 'groceries')
+        out = capsys.readouterr().out
+        assert 'groceries' in out and 'Safeway' in out
+
+        dex(monkeypatch, 'report', '--grouped', 'food:1')
+        out = capsys.readouterr().out
+        assert 'groceries' in out and 'total' in out
+
+        dex(monkeypatch, 'info')
+        out = capsys.readouterr().out
+        assert 'pytest' in out and 'entry' in out
+        assert DB.info()['pytest']['entry'] == 58
+
+        dex(monkeypatch, 'select', '--entry', '--account', 'groceries')
+        assert 'Entries' in capsys.readouterr().out
+
+        for argv in [
+            ['audit'],
+            ['select', '--entry', '--account', 'groceries', '--delete'],
+            ['select', '--account', 'groceries', '--update', 'description', 'x'],
+            ['save', 'out.json'],
+            ['restore', 'out.json'],
+            ['index'],
+            ['snapshot'],
+        ]:
+            with pytest.raises(ValueError, match='requires the MongoDB backend'):
+                dex(monkeypatch, *argv)
+
+        e = DB.select(Entry, account='groceries')[0]
+        for op in [e.delete, e.tref.delete, lambda: e.update(pull__tags='#pending'), DB.accounts.accounts()[0].delete]:
+            with pytest.raises(ValueError, match='requires the MongoDB backend'):
+                op()
+        assert len(DB.select(Entry)) == 58
+        assert len(DB.select(Transaction)) == 25